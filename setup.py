@@ -25,7 +25,6 @@ setup(
         'mayo>=0.2.1,<0.3',
         'requests>=1,<2',
         "catchy>=0.2.0,<0.3",
-        "beautifulsoup4>=4.1.3,<5",
         "spur.local>=0.3.6,<0.4",
         "dodge>=0.1.5,<0.2",
         "six>=1.4.1,<2.0"
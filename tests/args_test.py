@@ -2,7 +2,7 @@ import contextlib
 import argparse
 import os
 
-from nose.tools import istest, assert_equal
+from nose.tools import istest, assert_equal, assert_raises
 import six
 
 import whack.args
@@ -57,6 +57,23 @@ def hyphens_are_replaced_by_underscores_in_environment_variable_name():
     assert_equal("Hello!", args.the_title)
 
 
+@istest
+def value_from_environment_is_checked_against_choices():
+    with _updated_env({"WHACK_COLOUR": "purple"}):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--colour", action=env_default, choices=["red", "blue"])
+        assert_raises(SystemExit, lambda: parser.parse_args([]))
+        args = parser.parse_args(["--colour", "red"])
+    assert_equal("red", args.colour)
+    
+@istest
+def value_from_environment_is_used_if_it_is_a_valid_choice():
+    with _updated_env({"WHACK_COLOUR": "blue"}):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--colour", action=env_default, choices=["red", "blue"])
+        args = parser.parse_args([])
+    assert_equal("blue", args.colour)
+
 class Namespace(object):
     pass
 
@@ -3,7 +3,6 @@ import json
 import os
 
 from nose.tools import istest, assert_equal
-from catchy import NoCachingStrategy
 
 from whack.tempdir import create_temporary_dir
 from whack.files import sh_script_description, plain_file, read_file
@@ -11,7 +10,10 @@ from whack.sources import PackageSource
 from whack.builder import Builder
 from whack.packagerequests import create_package_request
 from whack.errors import FileNotFoundError
+from whack.caching import NoFileCachingStrategy, DirectoryFileCacher
 from whack.downloads import Downloader
+from whack.files import write_file
+from . import httpserver
     
 
 @istest
@@ -55,12 +57,31 @@ def error_is_raised_if_build_script_is_missing():
                 lambda: build(request, target_dir),
             )
 
+
+@istest
+def prefetch_fetches_downloads_into_cache_without_building():
+    with create_temporary_dir() as server_root:
+        write_file(os.path.join(server_root, "nginx.tar.gz"), "nginx")
+        with httpserver.start_static_http_server(server_root) as http_server:
+            downloads = "{0} nginx.tar.gz\n".format(http_server.static_url("nginx.tar.gz"))
+            with _package_source("exit 1", {}, downloads=downloads) as package_source:
+                with create_temporary_dir() as cache_dir:
+                    cacher = DirectoryFileCacher(cache_dir)
+                    builder = Builder(Downloader(cacher))
+                    
+                    builder.prefetch(create_package_request(package_source, {}))
+                    
+                    assert_equal(1, len(cacher.entries()))
+
+
 @contextlib.contextmanager
-def _package_source(build_script, description):
+def _package_source(build_script, description, downloads=None):
     files = [
         plain_file("whack/whack.json", json.dumps(description)),
         sh_script_description("whack/build", build_script),
     ]
+    if downloads is not None:
+        files.append(plain_file("whack/downloads", downloads))
     with create_temporary_dir(files) as package_source_dir:
         yield PackageSource.local(package_source_dir)
         
@@ -74,6 +95,6 @@ def assert_raises(error_class, args, func):
 
 
 def build(*args, **kwargs):
-    cacher = NoCachingStrategy()
+    cacher = NoFileCachingStrategy()
     builder = Builder(Downloader(cacher))
     return builder.build(*args, **kwargs)
@@ -0,0 +1,515 @@
+import os
+import time
+import threading
+import contextlib
+
+from nose.tools import istest, assert_equal
+import catchy
+
+from whack.caching import DirectoryCacher, ContentAddressedCacher, \
+    DirectoryFileCacher, CacheBudget, LocalCachingFactory
+from whack.locks import ReadWriteFileLock, SingleFlightLocks
+from whack.blobs import BlobStore
+from whack.stats import default_counters
+from whack.tempdir import create_temporary_dir
+from whack.files import write_files, write_file, plain_file, read_file, symlink, \
+    sh_script_description
+
+
+@istest
+def fetching_missing_entry_is_cache_miss():
+    with create_temporary_dir() as cache_dir:
+        cacher = DirectoryCacher(cache_dir)
+        with create_temporary_dir() as target_dir:
+            assert not cacher.fetch("nginx", target_dir).cache_hit
+
+
+@istest
+def directory_put_into_cache_can_be_fetched():
+    with create_temporary_dir() as cache_dir:
+        cacher = DirectoryCacher(cache_dir)
+        _put(cacher, "nginx", [plain_file("sbin/nginx", "Hello")])
+        
+        with create_temporary_dir() as target_dir:
+            assert cacher.fetch("nginx", target_dir).cache_hit
+            assert_equal("Hello", read_file(os.path.join(target_dir, "sbin/nginx")))
+
+
+@istest
+def entries_written_by_catchy_can_be_fetched():
+    with create_temporary_dir() as cache_dir:
+        _put(catchy.DirectoryCacher(cache_dir), "nginx", [plain_file("sbin/nginx", "Hello")])
+        
+        cacher = DirectoryCacher(cache_dir)
+        with create_temporary_dir() as target_dir:
+            assert cacher.fetch("nginx", target_dir).cache_hit
+            assert_equal("Hello", read_file(os.path.join(target_dir, "sbin/nginx")))
+
+
+@istest
+def modifying_fetched_files_does_not_modify_cache_when_materializing_by_reflink():
+    with create_temporary_dir() as cache_dir:
+        cacher = DirectoryCacher(cache_dir, materialization="reflink")
+        _put(cacher, "nginx", [plain_file("sbin/nginx", "Hello")])
+        
+        with create_temporary_dir() as target_dir:
+            cacher.fetch("nginx", target_dir)
+            write_files(target_dir, [plain_file("sbin/nginx", "Goodbye")])
+        
+        with create_temporary_dir() as target_dir:
+            cacher.fetch("nginx", target_dir)
+            assert_equal("Hello", read_file(os.path.join(target_dir, "sbin/nginx")))
+
+
+@istest
+def files_are_hard_linked_when_materializing_by_hardlink():
+    with create_temporary_dir() as cache_dir:
+        cacher = DirectoryCacher(cache_dir, materialization="hardlink")
+        _put(cacher, "nginx", [plain_file("sbin/nginx", "Hello")])
+        
+        with create_temporary_dir() as target_dir:
+            cacher.fetch("nginx", target_dir)
+            assert_equal(
+                os.stat(os.path.join(cache_dir, "nginx/sbin/nginx")).st_ino,
+                os.stat(os.path.join(target_dir, "sbin/nginx")).st_ino,
+            )
+            assert_equal(1, cacher.materialization_counts["hardlink"])
+
+
+@istest
+def content_addressed_cacher_fetches_directory_put_into_cache():
+    with _content_addressed_cacher() as cacher:
+        _put(cacher, "nginx", [
+            plain_file("sbin/nginx", "Hello"),
+            sh_script_description("bin/run", "echo Hello"),
+            symlink("bin/nginx", "../sbin/nginx"),
+        ])
+        
+        with create_temporary_dir() as target_dir:
+            assert cacher.fetch("nginx", target_dir).cache_hit
+            assert_equal("Hello", read_file(os.path.join(target_dir, "sbin/nginx")))
+            assert_equal("Hello", read_file(os.path.join(target_dir, "bin/nginx")))
+            assert_equal("../sbin/nginx", os.readlink(os.path.join(target_dir, "bin/nginx")))
+            assert os.access(os.path.join(target_dir, "bin/run"), os.X_OK)
+
+
+@istest
+def content_addressed_cacher_misses_entries_that_have_not_been_put():
+    with _content_addressed_cacher() as cacher:
+        with create_temporary_dir() as target_dir:
+            assert not cacher.fetch("nginx", target_dir).cache_hit
+
+
+@istest
+def identical_files_are_stored_once_by_content_addressed_cacher():
+    with create_temporary_dir() as cache_dir:
+        blobs_dir = os.path.join(cache_dir, "blobs")
+        cacher = ContentAddressedCacher(os.path.join(cache_dir, "packages"), BlobStore(blobs_dir))
+        _put(cacher, "nginx-1", [plain_file("sbin/nginx", "Hello"), plain_file("conf", "1")])
+        _put(cacher, "nginx-2", [plain_file("sbin/nginx", "Hello"), plain_file("conf", "2")])
+        
+        assert_equal(3, len(_all_files(blobs_dir)))
+        with create_temporary_dir() as target_dir:
+            cacher.fetch("nginx-2", target_dir)
+            assert_equal("2", read_file(os.path.join(target_dir, "conf")))
+
+
+@istest
+def modifying_files_fetched_by_reflink_from_content_addressed_cacher_does_not_modify_cache():
+    with _content_addressed_cacher(materialization="reflink") as cacher:
+        _put(cacher, "nginx", [plain_file("sbin/nginx", "Hello")])
+        
+        with create_temporary_dir() as target_dir:
+            cacher.fetch("nginx", target_dir)
+            write_files(target_dir, [plain_file("sbin/nginx", "Goodbye")])
+        
+        with create_temporary_dir() as target_dir:
+            cacher.fetch("nginx", target_dir)
+            assert_equal("Hello", read_file(os.path.join(target_dir, "sbin/nginx")))
+
+
+@istest
+def files_are_hard_linked_to_read_only_blobs_when_materializing_by_hardlink():
+    with create_temporary_dir() as cache_dir:
+        blob_store = BlobStore(os.path.join(cache_dir, "blobs"))
+        cacher = ContentAddressedCacher(
+            os.path.join(cache_dir, "packages"),
+            blob_store,
+            materialization="hardlink",
+        )
+        _put(cacher, "nginx-1", [plain_file("sbin/nginx", "Hello")])
+        _put(cacher, "nginx-2", [plain_file("sbin/nginx", "Hello")])
+        
+        with create_temporary_dir() as first_dir:
+            with create_temporary_dir() as second_dir:
+                cacher.fetch("nginx-1", first_dir)
+                cacher.fetch("nginx-2", second_dir)
+                first_stat = os.stat(os.path.join(first_dir, "sbin/nginx"))
+                assert_equal(first_stat.st_ino, os.stat(os.path.join(second_dir, "sbin/nginx")).st_ino)
+                assert not first_stat.st_mode & 0o222
+                assert_equal(2, cacher.materialization_counts["hardlink"])
+
+
+@istest
+def content_addressed_cacher_misses_entries_with_missing_blobs():
+    with create_temporary_dir() as cache_dir:
+        blobs_dir = os.path.join(cache_dir, "blobs")
+        cacher = ContentAddressedCacher(os.path.join(cache_dir, "packages"), BlobStore(blobs_dir))
+        _put(cacher, "nginx", [plain_file("sbin/nginx", "Hello")])
+        for path in _all_files(blobs_dir):
+            os.remove(path)
+        
+        with create_temporary_dir() as target_dir:
+            assert not cacher.fetch("nginx", target_dir).cache_hit
+
+
+@istest
+def content_addressed_cacher_contains_entries_that_have_been_put():
+    with _content_addressed_cacher() as cacher:
+        _put(cacher, "nginx", [plain_file("sbin/nginx", "Hello")])
+        
+        assert cacher.contains("nginx")
+        assert not cacher.contains("apache2")
+
+
+@istest
+def content_addressed_cacher_does_not_contain_entries_with_missing_blobs():
+    with create_temporary_dir() as cache_dir:
+        blobs_dir = os.path.join(cache_dir, "blobs")
+        cacher = ContentAddressedCacher(os.path.join(cache_dir, "packages"), BlobStore(blobs_dir))
+        _put(cacher, "nginx", [plain_file("sbin/nginx", "Hello")])
+        for path in _all_files(blobs_dir):
+            os.remove(path)
+        
+        assert not cacher.contains("nginx")
+
+
+@istest
+def content_addressed_cacher_fetches_entries_written_by_directory_cacher():
+    with create_temporary_dir() as cache_dir:
+        packages_dir = os.path.join(cache_dir, "packages")
+        _put(DirectoryCacher(packages_dir), "nginx", [plain_file("sbin/nginx", "Hello")])
+        
+        cacher = ContentAddressedCacher(packages_dir, BlobStore(os.path.join(cache_dir, "blobs")))
+        with create_temporary_dir() as target_dir:
+            assert cacher.fetch("nginx", target_dir).cache_hit
+            assert_equal("Hello", read_file(os.path.join(target_dir, "sbin/nginx")))
+
+
+@istest
+def files_fetched_from_file_cacher_can_be_modified_without_modifying_cache():
+    with create_temporary_dir() as cache_dir:
+        cacher = DirectoryFileCacher(cache_dir)
+        _put_file(cacher, cache_dir, "one", "1", accessed=100)
+        
+        with create_temporary_dir() as target_dir:
+            path = os.path.join(target_dir, "one")
+            cacher.fetch("one", path)
+            os.chmod(path, 0o755)
+            with open(path, "w") as target_file:
+                target_file.write("2")
+        
+        with create_temporary_dir() as target_dir:
+            path = os.path.join(target_dir, "one")
+            cacher.fetch("one", path)
+            assert_equal("1", read_file(path))
+            assert not os.stat(os.path.join(cache_dir, "one")).st_mode & 0o222
+
+
+@istest
+def files_are_hard_linked_from_file_cacher_when_materializing_by_hardlink():
+    with create_temporary_dir() as cache_dir:
+        cacher = DirectoryFileCacher(cache_dir, materialization="hardlink")
+        _put_file(cacher, cache_dir, "one", "1", accessed=100)
+        
+        with create_temporary_dir() as target_dir:
+            path = os.path.join(target_dir, "one")
+            cacher.fetch("one", path)
+            assert_equal(os.stat(os.path.join(cache_dir, "one")).st_ino, os.stat(path).st_ino)
+
+
+@istest
+def least_recently_used_entries_are_evicted_when_over_entry_budget():
+    with create_temporary_dir() as cache_dir:
+        cacher = DirectoryFileCacher(cache_dir)
+        _put_file(cacher, cache_dir, "one", "1", accessed=100)
+        _put_file(cacher, cache_dir, "two", "2", accessed=300)
+        _put_file(cacher, cache_dir, "three", "3", accessed=200)
+        
+        collection = cacher.collect_garbage(CacheBudget(max_entries=2))
+        
+        assert_equal(["one"], collection.evicted)
+        assert_equal(1, collection.freed_bytes)
+        assert_equal(["three", "two"], _cache_ids(cacher))
+
+
+@istest
+def fetching_entry_marks_it_as_recently_used():
+    with create_temporary_dir() as cache_dir:
+        cacher = DirectoryFileCacher(cache_dir)
+        _put_file(cacher, cache_dir, "one", "1", accessed=100)
+        _put_file(cacher, cache_dir, "two", "2", accessed=200)
+        
+        with create_temporary_dir() as target_dir:
+            cacher.fetch("one", os.path.join(target_dir, "one"))
+        cacher.collect_garbage(CacheBudget(max_entries=1))
+        
+        assert_equal(["one"], _cache_ids(cacher))
+
+
+@istest
+def entries_are_evicted_until_cache_is_within_byte_budget():
+    with create_temporary_dir() as cache_dir:
+        cacher = DirectoryFileCacher(cache_dir)
+        _put_file(cacher, cache_dir, "one", "1" * 100, accessed=100)
+        _put_file(cacher, cache_dir, "two", "2" * 100, accessed=200)
+        _put_file(cacher, cache_dir, "three", "3" * 100, accessed=300)
+        
+        cacher.collect_garbage(CacheBudget(max_bytes=150))
+        
+        assert_equal(["three"], _cache_ids(cacher))
+
+
+@istest
+def pinned_entries_are_not_evicted():
+    with create_temporary_dir() as cache_dir:
+        cacher = DirectoryFileCacher(cache_dir)
+        _put_file(cacher, cache_dir, "one", "1", accessed=100)
+        _put_file(cacher, cache_dir, "two", "2", accessed=200)
+        cacher.pin("one")
+        
+        cacher.collect_garbage(CacheBudget(max_entries=1))
+        
+        assert_equal(["one"], _cache_ids(cacher))
+        assert_equal(1, cacher.stats().pinned_entries)
+
+
+@istest
+def unpinned_entries_can_be_evicted():
+    with create_temporary_dir() as cache_dir:
+        cacher = DirectoryFileCacher(cache_dir)
+        _put_file(cacher, cache_dir, "one", "1", accessed=100)
+        _put_file(cacher, cache_dir, "two", "2", accessed=200)
+        cacher.pin("one")
+        cacher.pin("one", pinned=False)
+        
+        cacher.collect_garbage(CacheBudget(max_entries=1))
+        
+        assert_equal(["two"], _cache_ids(cacher))
+
+
+@istest
+def cache_is_collected_after_put_when_cacher_has_budget():
+    with create_temporary_dir() as cache_dir:
+        cacher = DirectoryFileCacher(cache_dir, budget=CacheBudget(max_entries=1))
+        _put_file(cacher, cache_dir, "one", "1", accessed=100)
+        _put_file(cacher, cache_dir, "two", "2", accessed=200)
+        
+        assert_equal(["two"], _cache_ids(cacher))
+
+
+@istest
+def cache_is_not_collected_after_put_while_another_process_is_using_cache():
+    with create_temporary_dir() as cache_dir:
+        lock = ReadWriteFileLock(os.path.join(cache_dir, "cache.lock"))
+        cacher = DirectoryFileCacher(
+            os.path.join(cache_dir, "downloads"),
+            budget=CacheBudget(max_entries=1),
+            lock=lock,
+        )
+        downloads_dir = os.path.join(cache_dir, "downloads")
+        _put_file(cacher, downloads_dir, "one", "1", accessed=100)
+        with ReadWriteFileLock(os.path.join(cache_dir, "cache.lock")).shared():
+            _put_file(cacher, downloads_dir, "two", "2", accessed=200)
+            assert_equal(["one", "two"], _cache_ids(cacher))
+
+
+@istest
+def stats_count_bytes_shared_between_entries_once():
+    with create_temporary_dir() as cache_dir:
+        cacher = ContentAddressedCacher(
+            os.path.join(cache_dir, "packages"),
+            BlobStore(os.path.join(cache_dir, "blobs")),
+        )
+        _put(cacher, "nginx-1", [plain_file("sbin/nginx", "Hello"), plain_file("conf", "1")])
+        _put(cacher, "nginx-2", [plain_file("sbin/nginx", "Hello"), plain_file("conf", "2")])
+        
+        stats = cacher.stats()
+        assert_equal(2, stats.entries)
+        assert_equal(7, stats.total_bytes)
+
+
+@istest
+def blobs_are_removed_once_no_entries_use_them():
+    with create_temporary_dir() as cache_dir:
+        blobs_dir = os.path.join(cache_dir, "blobs")
+        cacher = ContentAddressedCacher(os.path.join(cache_dir, "packages"), BlobStore(blobs_dir))
+        _put(cacher, "nginx-1", [plain_file("sbin/nginx", "Hello"), plain_file("conf", "1")])
+        _put(cacher, "nginx-2", [plain_file("sbin/nginx", "Hello"), plain_file("conf", "2")])
+        _set_last_accessed(os.path.join(cache_dir, "packages/nginx-1.manifest"), 100)
+        
+        collection = cacher.collect_garbage(CacheBudget(max_entries=1))
+        
+        assert_equal(["nginx-1"], collection.evicted)
+        assert_equal(1, collection.freed_bytes)
+        assert_equal(2, len(_all_files(blobs_dir)))
+        with create_temporary_dir() as target_dir:
+            assert cacher.fetch("nginx-2", target_dir).cache_hit
+            assert_equal("Hello", read_file(os.path.join(target_dir, "sbin/nginx")))
+
+
+@istest
+def entries_written_by_directory_cacher_can_be_evicted_by_content_addressed_cacher():
+    with create_temporary_dir() as cache_dir:
+        packages_dir = os.path.join(cache_dir, "packages")
+        _put(DirectoryCacher(packages_dir), "nginx", [plain_file("sbin/nginx", "Hello")])
+        
+        cacher = ContentAddressedCacher(packages_dir, BlobStore(os.path.join(cache_dir, "blobs")))
+        collection = cacher.collect_garbage(CacheBudget(max_entries=0))
+        
+        assert_equal(["nginx"], collection.evicted)
+        assert_equal([], os.listdir(packages_dir))
+
+
+@istest
+def files_left_behind_by_failed_writes_are_removed_by_garbage_collection():
+    with create_temporary_dir() as cache_dir:
+        cacher = DirectoryFileCacher(cache_dir)
+        write_files(cache_dir, [plain_file("one.1234.part", "1")])
+        
+        collection = cacher.collect_garbage()
+        
+        assert_equal(1, collection.freed_bytes)
+        assert_equal([], os.listdir(cache_dir))
+
+
+@istest
+def concurrent_creates_of_same_file_only_create_it_once():
+    with create_temporary_dir() as cache_dir:
+        cacher = DirectoryFileCacher(
+            os.path.join(cache_dir, "downloads"),
+            single_flight_locks=SingleFlightLocks(os.path.join(cache_dir, "locks")),
+        )
+        creations = []
+        
+        def create(path):
+            creations.append(path)
+            time.sleep(0.2)
+            write_files(os.path.dirname(path), [plain_file(os.path.basename(path), "1")])
+        
+        with create_temporary_dir() as target_dir:
+            threads = [
+                threading.Thread(
+                    target=cacher.fetch_or_create,
+                    args=("one", os.path.join(target_dir, str(index)), create),
+                )
+                for index in range(3)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            
+            assert_equal(1, len(creations))
+            for index in range(3):
+                assert_equal("1", read_file(os.path.join(target_dir, str(index))))
+
+
+def _put_file(cacher, cacher_dir, cache_id, contents, accessed):
+    def create(path):
+        write_files(os.path.dirname(path), [plain_file(os.path.basename(path), contents)])
+    
+    with create_temporary_dir() as target_dir:
+        cacher.fetch_or_create(cache_id, os.path.join(target_dir, cache_id), create)
+    indicator_path = os.path.join(cacher_dir, "{0}.cached".format(cache_id))
+    if os.path.exists(indicator_path):
+        _set_last_accessed(indicator_path, accessed)
+
+
+def _set_last_accessed(path, accessed):
+    os.utime(path, (accessed, accessed))
+
+
+@istest
+def each_cache_created_by_local_caching_factory_uses_its_own_budget():
+    with _xdg_cache_home():
+        factory = LocalCachingFactory(budgets={"downloads": CacheBudget(max_entries=1)})
+        downloads = factory.create_file_cacher("downloads")
+        packages = factory.create("packages")
+        for cache_id in ["one", "two"]:
+            with create_temporary_dir() as target_dir:
+                downloads.fetch_or_create(
+                    cache_id,
+                    os.path.join(target_dir, "file"),
+                    lambda path: write_file(path, cache_id),
+                )
+            _put(packages, cache_id, [plain_file("README", cache_id)])
+        
+        assert_equal(1, downloads.stats().entries)
+        assert_equal(2, packages.stats().entries)
+
+
+@istest
+def fetching_from_content_addressed_cacher_counts_materialized_files():
+    with _content_addressed_cacher(materialization="hardlink") as cacher:
+        default_counters.reset()
+        _put(cacher, "nginx", [plain_file("sbin/nginx", "Hello"), plain_file("README", "Hi")])
+        
+        with create_temporary_dir() as target_dir:
+            cacher.fetch("nginx", target_dir)
+        
+        counters = default_counters.values()
+        assert_equal(2, counters["materialize.files"])
+        assert_equal(7, counters["materialize.bytes"])
+        assert_equal(2, counters["materialize.hardlink"])
+
+
+@istest
+def storing_blobs_is_counted_separately_from_hashing_sources():
+    with _content_addressed_cacher() as cacher:
+        default_counters.reset()
+        _put(cacher, "nginx", [plain_file("sbin/nginx", "Hello")])
+        
+        counters = default_counters.values()
+        assert_equal(1, counters["blobs.hash.files"])
+        assert_equal(5, counters["blobs.hash.bytes"])
+        assert "hash.files" not in counters
+
+
+@contextlib.contextmanager
+def _xdg_cache_home():
+    original_env = os.environ.copy()
+    with create_temporary_dir() as cache_home:
+        os.environ["XDG_CACHE_HOME"] = cache_home
+        try:
+            yield cache_home
+        finally:
+            os.environ.clear()
+            os.environ.update(original_env)
+
+
+def _cache_ids(cacher):
+    return sorted(entry.cache_id for entry in cacher.entries())
+
+
+@contextlib.contextmanager
+def _content_addressed_cacher(materialization="reflink"):
+    with create_temporary_dir() as cache_dir:
+        yield ContentAddressedCacher(
+            os.path.join(cache_dir, "packages"),
+            BlobStore(os.path.join(cache_dir, "blobs")),
+            materialization=materialization,
+        )
+
+
+def _all_files(root):
+    return [
+        os.path.join(dir_path, filename)
+        for dir_path, dir_names, filenames in os.walk(root)
+        for filename in filenames
+    ]
+
+
+def _put(cacher, cache_id, files):
+    with create_temporary_dir(files) as source_dir:
+        cacher.put(cache_id, source_dir)
@@ -1,8 +1,8 @@
 import os
 
 from nose.tools import istest, assert_equal
-from catchy import NoCachingStrategy
 
+from whack.caching import NoFileCachingStrategy, DirectoryFileCacher
 from whack.downloads import read_downloads_string, Download, Downloader, DownloadError
 from whack import files
 from whack.tempdir import create_temporary_dir
@@ -39,7 +39,7 @@ def filename_can_be_explicitly_set_after_url():
 
 @istest
 def downloader_can_download_files_over_http():
-    downloader = Downloader(NoCachingStrategy())
+    downloader = Downloader(NoFileCachingStrategy())
     
     with create_temporary_dir() as server_root:
         files.write_file(os.path.join(server_root, "hello"), "Hello there!")
@@ -51,9 +51,29 @@ def downloader_can_download_files_over_http():
                 assert_equal("Hello there!", files.read_file(download_path))
 
 
+@istest
+def downloads_are_reused_from_cache():
+    with create_temporary_dir() as cache_dir:
+        downloader = Downloader(DirectoryFileCacher(cache_dir))
+        
+        with create_temporary_dir() as server_root:
+            files.write_file(os.path.join(server_root, "hello"), "Hello there!")
+            with httpserver.start_static_http_server(server_root) as http_server:
+                url = http_server.static_url("hello")
+                with create_temporary_dir() as download_dir:
+                    downloader.download(url, os.path.join(download_dir, "file"))
+                
+                os.remove(os.path.join(server_root, "hello"))
+                
+                with create_temporary_dir() as download_dir:
+                    download_path = os.path.join(download_dir, "file")
+                    downloader.download(url, download_path)
+                    assert_equal("Hello there!", files.read_file(download_path))
+
+
 @istest
 def download_fails_if_http_request_returns_404():
-    downloader = Downloader(NoCachingStrategy())
+    downloader = Downloader(NoFileCachingStrategy())
     
     with create_temporary_dir() as server_root:
         with httpserver.start_static_http_server(server_root) as http_server:
@@ -65,3 +85,51 @@ def download_fails_if_http_request_returns_404():
                     assert False
                 except DownloadError:
                     pass
+
+
+@istest
+def all_downloads_in_downloads_file_are_fetched_into_target_dir():
+    downloader = Downloader(NoFileCachingStrategy(), max_workers=3, max_workers_per_host=2)
+    
+    with create_temporary_dir() as server_root:
+        with httpserver.start_static_http_server(server_root) as http_server:
+            with create_temporary_dir() as build_dir:
+                downloads = []
+                for index in range(5):
+                    name = "file-{0}".format(index)
+                    files.write_file(os.path.join(server_root, name), name)
+                    url = http_server.static_url(name)
+                    downloads.append("{0} copy-{1}".format(url, name))
+                downloads_file_path = os.path.join(build_dir, "downloads")
+                files.write_file(downloads_file_path, "\n".join(downloads))
+                
+                downloader.fetch_downloads(downloads_file_path, {}, build_dir)
+                
+                for index in range(5):
+                    assert_equal(
+                        "file-{0}".format(index),
+                        files.read_file(os.path.join(build_dir, "copy-file-{0}".format(index)))
+                    )
+
+
+@istest
+def error_for_first_failed_download_in_downloads_file_is_raised():
+    downloader = Downloader(NoFileCachingStrategy())
+    
+    with create_temporary_dir() as server_root:
+        with httpserver.start_static_http_server(server_root) as http_server:
+            with create_temporary_dir() as build_dir:
+                files.write_file(os.path.join(server_root, "present"), "Hello there!")
+                urls = [
+                    http_server.static_url("present"),
+                    http_server.static_url("first-missing"),
+                    http_server.static_url("second-missing"),
+                ]
+                downloads_file_path = os.path.join(build_dir, "downloads")
+                files.write_file(downloads_file_path, "\n".join(urls))
+                
+                try:
+                    downloader.fetch_downloads(downloads_file_path, {}, build_dir)
+                    assert False
+                except DownloadError as error:
+                    assert_equal("File not found: {0}".format(urls[1]), str(error))
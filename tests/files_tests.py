@@ -0,0 +1,99 @@
+import os
+import stat
+import json
+import threading
+import contextlib
+
+from nose.tools import istest, assert_equal
+
+from whack.files import \
+    copy_dir, plain_file, sh_script_description, symlink, \
+    directory_description, read_file, write_json_atomically
+from whack.tempdir import create_temporary_dir
+
+
+@istest
+def copying_dir_copies_files_in_nested_directories():
+    with _copy_of([plain_file("one/two/three", "3")]) as target_dir:
+        assert_equal("3", read_file(os.path.join(target_dir, "one/two/three")))
+
+
+@istest
+def copying_dir_preserves_permissions_of_files():
+    with _copy_of([sh_script_description("hello", "echo hello")]) as target_dir:
+        mode = os.stat(os.path.join(target_dir, "hello")).st_mode
+        assert_equal(0o755, stat.S_IMODE(mode))
+
+
+@istest
+def copying_dir_copies_symlinks_as_symlinks():
+    files = [
+        plain_file("one/message", "Hello"),
+        symlink("one/link", "message"),
+        symlink("dir-link", "one"),
+    ]
+    with _copy_of(files) as target_dir:
+        assert_equal("message", os.readlink(os.path.join(target_dir, "one/link")))
+        assert_equal("one", os.readlink(os.path.join(target_dir, "dir-link")))
+        assert_equal("Hello", read_file(os.path.join(target_dir, "dir-link/link")))
+
+
+@istest
+def copying_dir_copies_empty_directories():
+    with _copy_of([directory_description("empty")]) as target_dir:
+        assert os.path.isdir(os.path.join(target_dir, "empty"))
+
+
+@istest
+def copying_dir_can_copy_read_only_directories():
+    with create_temporary_dir([plain_file("one/message", "Hello")]) as source_dir:
+        os.chmod(os.path.join(source_dir, "one"), 0o555)
+        with create_temporary_dir() as parent_dir:
+            target_dir = os.path.join(parent_dir, "target")
+            copy_dir(source_dir, target_dir)
+            assert_equal("Hello", read_file(os.path.join(target_dir, "one/message")))
+            os.chmod(os.path.join(target_dir, "one"), 0o755)
+
+
+@istest
+def copying_dir_replaces_files_in_existing_destination():
+    with create_temporary_dir([plain_file("message", "Hello")]) as source_dir:
+        with create_temporary_dir([plain_file("message", "Goodbye")]) as target_dir:
+            copy_dir(source_dir, target_dir)
+            assert_equal("Hello", read_file(os.path.join(target_dir, "message")))
+
+
+@istest
+def copying_dir_reports_number_of_files_and_bytes_copied():
+    files = [plain_file("one", "1"), plain_file("two/three", "333")]
+    with create_temporary_dir(files) as source_dir:
+        with create_temporary_dir() as target_dir:
+            result = copy_dir(source_dir, target_dir)
+            assert_equal(2, result.files)
+            assert_equal(4, result.bytes)
+
+
+@istest
+def json_written_atomically_from_several_threads_is_never_partially_written():
+    with create_temporary_dir() as temp_dir:
+        path = os.path.join(temp_dir, "cache/digests.json")
+        values = [dict((str(key), thread) for key in range(1000)) for thread in range(8)]
+        threads = [
+            threading.Thread(target=write_json_atomically, args=(path, value))
+            for value in values
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        assert json.loads(read_file(path)) in values
+        assert_equal(["digests.json"], os.listdir(os.path.dirname(path)))
+
+
+@contextlib.contextmanager
+def _copy_of(files):
+    with create_temporary_dir(files) as source_dir:
+        with create_temporary_dir() as target_dir:
+            copy_dir(source_dir, target_dir)
+            yield target_dir
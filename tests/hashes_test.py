@@ -6,7 +6,7 @@ import uuid
 import six
 from nose.tools import istest, assert_equal, assert_not_equal
 
-from whack.hashes import Hasher, integer_to_ascii
+from whack.hashes import Hasher, MerkleHasher, FileDigestCache, integer_to_ascii
 
 
 @istest
@@ -73,6 +73,126 @@ def hash_of_directories_are_different_if_they_have_different_file_contents():
         assert_not_equal(first_hash, second_hash)
 
 
+@istest
+def hash_of_directory_is_hash_of_paths_and_contents_of_files_sorted_by_path():
+    with TestRunner() as test_runner:
+        files = {
+            "a/b": "one",
+            "a-b/c": "two",
+            "a.txt": "three",
+        }
+        directory_hash = test_runner.hash_for_files(files)
+        
+        hasher = Hasher()
+        for path in sorted(files):
+            hasher.update(path)
+            hasher.update(files[path])
+        
+        assert_equal(hasher.ascii_digest(), directory_hash)
+
+
+@istest
+def files_that_are_not_valid_text_can_be_hashed():
+    with TestRunner() as test_runner:
+        first_hash = test_runner.hash_for_files({"hello": b"\xff\x00"})
+        second_hash = test_runner.hash_for_files({"hello": b"\xfe\x00"})
+        
+        assert_not_equal(first_hash, second_hash)
+
+
+@istest
+def hash_of_directory_is_the_same_when_file_digests_are_cached():
+    with TestRunner() as test_runner:
+        files_dir = test_runner.create_files({"hello": "Hello world!"})
+        test_runner.make_old(files_dir, "hello")
+        uncached_hash = test_runner.hash_for_dir(files_dir)
+        
+        cache = test_runner.file_digest_cache()
+        assert_equal(uncached_hash, test_runner.hash_for_dir(files_dir, cache))
+        assert_equal(uncached_hash, test_runner.hash_for_dir(files_dir, cache))
+
+
+@istest
+def cached_file_digest_is_used_if_size_mtime_and_inode_are_unchanged():
+    with TestRunner() as test_runner:
+        files_dir = test_runner.create_files({"hello": "Hello world!"})
+        test_runner.make_old(files_dir, "hello")
+        cache = test_runner.file_digest_cache()
+        original_hash = test_runner.hash_for_dir(files_dir, cache)
+        
+        test_runner.rewrite_preserving_stat(files_dir, "hello", "Jello world!")
+        
+        assert_equal(original_hash, test_runner.hash_for_dir(files_dir, cache))
+        assert_not_equal(original_hash, test_runner.hash_for_dir(files_dir))
+
+
+@istest
+def file_is_rehashed_if_mtime_changes():
+    with TestRunner() as test_runner:
+        files_dir = test_runner.create_files({"hello": "Hello world!"})
+        test_runner.make_old(files_dir, "hello")
+        cache = test_runner.file_digest_cache()
+        test_runner.hash_for_dir(files_dir, cache)
+        
+        test_runner.create_files({"hello": "Jello world!"}, root=files_dir)
+        
+        assert_equal(
+            test_runner.hash_for_dir(files_dir),
+            test_runner.hash_for_dir(files_dir, cache),
+        )
+
+
+@istest
+def merkle_hash_of_directories_are_the_same_if_they_have_the_same_files():
+    with TestRunner() as test_runner:
+        files = {"hello": "Hello world!", "one/two/three": "3"}
+        first_hash = test_runner.merkle_hash_for_files(files)
+        second_hash = test_runner.merkle_hash_for_files(files)
+        
+        assert_equal(first_hash, second_hash)
+
+
+@istest
+def merkle_hash_of_directories_are_different_if_files_are_in_different_subdirectories():
+    with TestRunner() as test_runner:
+        first_hash = test_runner.merkle_hash_for_files({"one/hello": "Hello world!"})
+        second_hash = test_runner.merkle_hash_for_files({"two/hello": "Hello world!"})
+        
+        assert_not_equal(first_hash, second_hash)
+
+
+@istest
+def merkle_hash_of_directories_are_different_if_they_have_different_file_contents():
+    with TestRunner() as test_runner:
+        first_hash = test_runner.merkle_hash_for_files({"one/hello": "Hello world!"})
+        second_hash = test_runner.merkle_hash_for_files({"one/hello": "Goodbye world!"})
+        
+        assert_not_equal(first_hash, second_hash)
+
+
+@istest
+def merkle_hash_is_independent_of_number_of_workers():
+    with TestRunner() as test_runner:
+        files = dict(("{0}/{1}".format(i % 3, i), str(i)) for i in range(20))
+        files_dir = test_runner.create_files(files)
+        
+        assert_equal(
+            test_runner.merkle_hash_for_dir(files_dir, workers=1),
+            test_runner.merkle_hash_for_dir(files_dir, workers=8),
+        )
+
+
+@istest
+def merkle_hash_is_different_from_original_hash():
+    with TestRunner() as test_runner:
+        files_dir = test_runner.create_files({"hello": "Hello world!"})
+        
+        assert_not_equal(
+            test_runner.hash_for_dir(files_dir),
+            test_runner.merkle_hash_for_dir(files_dir),
+        )
+
+
 @istest
 def integer_to_ascii_converts_integer_to_alphanumeric_string():
     cases = [
@@ -95,19 +215,49 @@ class TestRunner(object):
     
     def hash_for_files(self, files):
         files_dir = self.create_files(files)
-        
-        hasher = Hasher()
+        return self.hash_for_dir(files_dir)
+    
+    def hash_for_dir(self, files_dir, file_digest_cache=None):
+        hasher = Hasher(file_digest_cache)
         hasher.update_with_dir(files_dir)
         return hasher.ascii_digest()
     
-    def create_files(self, files):
-        root = os.path.join(self._test_dir, str(uuid.uuid4()))
+    def merkle_hash_for_files(self, files):
+        files_dir = self.create_files(files)
+        return self.merkle_hash_for_dir(files_dir)
+    
+    def merkle_hash_for_dir(self, files_dir, workers=None):
+        hasher = MerkleHasher(workers=workers)
+        hasher.update_with_dir(files_dir)
+        return hasher.ascii_digest()
+    
+    def file_digest_cache(self):
+        return FileDigestCache(os.path.join(self._test_dir, str(uuid.uuid4())))
+    
+    def make_old(self, root, name):
+        path = os.path.join(root, name)
+        os.utime(path, (1000000000, 1000000000))
+    
+    def rewrite_preserving_stat(self, root, name, contents):
+        path = os.path.join(root, name)
+        stat = os.stat(path)
+        with open(path, "w") as f:
+            f.write(contents)
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+    
+    def create_files(self, files, root=None):
+        if root is None:
+            root = os.path.join(self._test_dir, str(uuid.uuid4()))
         for name, contents in six.iteritems(files):
             path = os.path.join(root, name)
             parent_dir = os.path.dirname(path)
             if not os.path.exists(parent_dir):
                 os.makedirs(parent_dir)
-            with open(path, "w") as f:
+            if isinstance(contents, bytes):
+                mode = "wb"
+            else:
+                mode = "w"
+            with open(path, mode) as f:
                 f.write(contents)
         return root
     
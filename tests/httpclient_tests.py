@@ -0,0 +1,69 @@
+import os
+
+from nose.tools import istest, assert_equal
+
+from whack.httpclient import HttpClient, HttpError
+from whack.tempdir import create_temporary_dir
+from whack import files
+from . import httpserver
+
+
+@istest
+def download_writes_body_to_path_and_counts_bytes_received():
+    http_client = HttpClient()
+    
+    with create_temporary_dir() as server_root:
+        files.write_file(os.path.join(server_root, "hello"), "Hello there!")
+        with httpserver.start_static_http_server(server_root) as http_server:
+            with create_temporary_dir() as download_dir:
+                download_path = os.path.join(download_dir, "hello")
+                http_client.download(http_server.static_url("hello"), download_path)
+                http_client.download(http_server.static_url("hello"), download_path)
+                
+                assert_equal("Hello there!", files.read_file(download_path))
+                assert_equal(2, http_client.requests)
+                assert_equal(24, http_client.bytes_received)
+
+
+@istest
+def download_raises_error_with_status_code_if_request_is_unsuccessful():
+    http_client = HttpClient()
+    
+    with create_temporary_dir() as server_root:
+        with httpserver.start_static_http_server(server_root) as http_server:
+            with create_temporary_dir() as download_dir:
+                url = http_server.static_url("hello")
+                try:
+                    http_client.download(url, os.path.join(download_dir, "hello"))
+                    assert False
+                except HttpError as error:
+                    assert_equal(404, error.status_code)
+                    assert_equal(url, error.url)
+
+
+@istest
+def get_counts_bytes_received():
+    http_client = HttpClient()
+    
+    with create_temporary_dir() as server_root:
+        files.write_file(os.path.join(server_root, "hello"), "Hello there!")
+        with httpserver.start_static_http_server(server_root) as http_server:
+            response = http_client.get(http_server.static_url("hello"))
+            
+            assert_equal("Hello there!", response.text)
+            assert_equal(1, http_client.requests)
+            assert_equal(12, http_client.bytes_received)
+
+
+@istest
+def get_counts_bytes_of_streamed_response_as_they_are_read():
+    http_client = HttpClient()
+    
+    with create_temporary_dir() as server_root:
+        files.write_file(os.path.join(server_root, "hello"), "Hello there!")
+        with httpserver.start_static_http_server(server_root) as http_server:
+            response = http_client.get(http_server.static_url("hello"), stream=True)
+            assert_equal(0, http_client.bytes_received)
+            
+            assert_equal(b"Hello there!", b"".join(response.iter_content(chunk_size=4)))
+            assert_equal(12, http_client.bytes_received)
@@ -35,3 +35,4 @@ class Server(object):
     def __exit__(self, *args):
         self._server.shutdown()
         self._thread.join()
+        self._server.server_close()
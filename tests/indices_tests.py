@@ -1,7 +1,16 @@
-from nose.tools import istest, assert_equal
+import os
+import contextlib
+import json
+import time
 
-from whack.indices import read_index_string
+from nose.tools import istest, assert_equal, assert_raises
+
+from whack.indices import read_index, read_index_string, IndexCache, MemoizedIndexCache, \
+    find_in_indices, IndexMissCache
 from whack.platform import Platform
+from whack.tempdir import create_temporary_dir
+from whack.files import write_file
+from .httpserver import start_static_http_server
 
 
 @istest
@@ -14,6 +23,17 @@ def can_find_source_entry_if_link_text_is_exactly_desired_name():
     assert_equal("nginx.whack-source", index_entry.name)
 
 
+@istest
+def references_in_link_text_and_href_are_unescaped():
+    index = read_index_string(
+        "http://example.com",
+        _html('<a href="nginx.tar.gz?a=1&amp;b=2">nginx&#46;whack&#x2d;source</a>')
+    )
+    index_entry = index.find_package_source_by_name("nginx")
+    assert_equal("nginx.whack-source", index_entry.name)
+    assert_equal("http://example.com/nginx.tar.gz?a=1&b=2", index_entry.url)
+
+
 @istest
 def can_find_source_entry_if_href_is_exactly_desired_name():
     index = read_index_string(
@@ -146,6 +166,353 @@ def package_entries_without_os_name_are_ignored():
     assert_equal(None, index_entry)
 
 
+@istest
+def package_entry_matching_by_link_text_is_preferred_to_entry_matching_by_href():
+    index = read_index_string(
+        "http://example.com",
+        _html(
+            '<a href="/nginx_linux_x86-64_glibc-2.13_abc.whack-package">first</a>' +
+            '<a href="/second">nginx_linux_x86-64_glibc-2.13_abc.whack-package</a>'
+        )
+    )
+
+    index_entry = index.find_package(params_hash="abc", platform=_platform)
+    assert_equal("http://example.com/second", index_entry.url)
+
+
+@istest
+def first_matching_package_entry_is_used():
+    index = read_index_string(
+        "http://example.com",
+        _html(
+            '<a href="/first">nginx_linux_x86-64_glibc-2.14_abc.whack-package</a>' +
+            '<a href="/second">nginx_linux_x86-64_glibc-2.12_abc.whack-package</a>' +
+            '<a href="/third">nginx_linux_x86-64_glibc-2.13_abc.whack-package</a>'
+        )
+    )
+
+    index_entry = index.find_package(params_hash="abc", platform=_platform)
+    assert_equal("http://example.com/second", index_entry.url)
+
+
+@istest
+def entities_in_link_text_are_unescaped():
+    index = read_index_string(
+        "http://example.com",
+        _html('<a href="/nginx.whack-source"><b>nginx</b>&#46;whack&#x2d;source</a>')
+    )
+    index_entry = index.find_package_source_by_name("nginx")
+    assert_equal("http://example.com/nginx.whack-source", index_entry.url)
+
+
+@istest
+def can_find_package_in_json_index():
+    index = read_index_string(
+        "http://example.com/index.json",
+        json.dumps({"entries": [
+            {
+                "name": "nginx_linux_x86-64_glibc-2.13_abc.whack-package",
+                "url": "packages/nginx.whack-package",
+                "size": 42,
+                "hash": "sha1:da39a3ee5e6b4b0d3255bfef95601890afd80709",
+            },
+        ]}),
+        content_type="application/json; charset=utf-8",
+    )
+    index_entry = index.find_package(params_hash="abc", platform=_platform)
+    assert_equal("http://example.com/packages/nginx.whack-package", index_entry.url)
+    assert_equal(42, index_entry.size)
+    assert_equal("sha1:da39a3ee5e6b4b0d3255bfef95601890afd80709", index_entry.hash)
+
+
+@istest
+def platform_of_json_index_entry_is_used_in_preference_to_platform_in_name():
+    index = read_index_string(
+        "http://example.com/index.json",
+        json.dumps({"entries": [
+            {
+                "name": "nginx_linux_x86-64_glibc-2.13_abc.whack-package",
+                "url": "nginx.whack-package",
+                "platform": {"osName": "linux", "architecture": "i686", "libc": "glibc-2.13"},
+            },
+        ]}),
+        content_type="application/json",
+    )
+    index_entry = index.find_package(params_hash="abc", platform=_platform)
+    assert_equal(None, index_entry)
+
+
+@istest
+def json_index_is_detected_by_content_type_when_read_over_http():
+    with _index_server() as (server, cache_dir):
+        entries = [{"name": "nginx.whack-source", "url": "nginx.tar.gz"}]
+        write_file(
+            os.path.join(server.root, "index.json"),
+            json.dumps({"entries": entries}),
+        )
+        
+        for index_cache in [None, IndexCache(cache_dir)]:
+            index = read_index(server.static_url("index.json"), index_cache)
+            index_entry = index.find_package_source_by_name("nginx")
+            assert_equal(server.static_url("nginx.tar.gz"), index_entry.url)
+
+
+@istest
+def index_is_read_from_cache_without_request_if_ttl_has_not_expired():
+    with _index_server() as (server, cache_dir):
+        index_cache = IndexCache(cache_dir, ttl=3600)
+        _write_index(server, '<a href="nginx.whack-source">nginx.whack-source</a>')
+        read_index(server.static_url("index.html"), index_cache)
+        
+        os.remove(os.path.join(server.root, "index.html"))
+        
+        index = read_index(server.static_url("index.html"), index_cache)
+        assert_equal(
+            "nginx.whack-source",
+            index.find_package_source_by_name("nginx").name
+        )
+
+
+@istest
+def cached_index_is_revalidated_if_ttl_has_expired():
+    with _index_server() as (server, cache_dir):
+        index_cache = IndexCache(cache_dir, ttl=0)
+        _write_index(server, '<a href="nginx.whack-source">nginx.whack-source</a>')
+        read_index(server.static_url("index.html"), index_cache)
+        
+        _write_index(server, '<a href="apache.whack-source">apache.whack-source</a>')
+        os.utime(os.path.join(server.root, "index.html"), (2000000000, 2000000000))
+        
+        index = read_index(server.static_url("index.html"), index_cache)
+        assert_equal(None, index.find_package_source_by_name("nginx"))
+        assert_equal(
+            "apache.whack-source",
+            index.find_package_source_by_name("apache").name
+        )
+
+
+@istest
+def memoized_index_cache_reads_each_index_once():
+    with _index_server() as (server, cache_dir):
+        index_cache = MemoizedIndexCache()
+        _write_index(server, '<a href="nginx.whack-source">nginx.whack-source</a>')
+        read_index(server.static_url("index.html"), index_cache)
+        
+        os.remove(os.path.join(server.root, "index.html"))
+        
+        index = read_index(server.static_url("index.html"), index_cache)
+        assert_equal(
+            "nginx.whack-source",
+            index.find_package_source_by_name("nginx").name
+        )
+
+
+@istest
+def cached_index_is_used_if_index_cannot_be_reached():
+    with create_temporary_dir() as cache_dir:
+        index_cache = IndexCache(os.path.join(cache_dir, "indices"))
+        with _index_server() as (server, _):
+            _write_index(server, '<a href="nginx.whack-source">nginx.whack-source</a>')
+            index_uri = server.static_url("index.html")
+            read_index(index_uri, index_cache)
+        
+        index = read_index(index_uri, index_cache)
+        assert_equal(
+            "nginx.whack-source",
+            index.find_package_source_by_name("nginx").name
+        )
+
+
+@istest
+def memoized_index_can_be_read_after_locks_are_reset():
+    with _index_server() as (server, cache_dir):
+        index_cache = MemoizedIndexCache()
+        _write_index(server, '<a href="nginx.whack-source">nginx.whack-source</a>')
+        # As if held by a thread that doesn't exist after forking
+        index_cache._lock.acquire()
+        index_cache.reset_locks()
+        
+        index = read_index(server.static_url("index.html"), index_cache)
+        assert_equal(
+            "nginx.whack-source",
+            index.find_package_source_by_name("nginx").name
+        )
+
+
+@istest
+def entry_from_first_index_in_order_is_used_even_if_later_index_responds_first():
+    index_cache = _FakeIndexCache({
+        "first": (0.2, ["nginx.whack-source"]),
+        "second": (0, ["nginx.whack-source"]),
+    })
+    entry = find_in_indices(["first", "second"], _find_nginx, index_cache)
+    assert_equal("first/nginx.whack-source", entry.url)
+
+
+@istest
+def later_indices_are_used_if_earlier_indices_have_no_entry():
+    index_cache = _FakeIndexCache({
+        "first": (0, []),
+        "second": (0, ["nginx.whack-source"]),
+    })
+    entry = find_in_indices(["first", "second"], _find_nginx, index_cache)
+    assert_equal("second/nginx.whack-source", entry.url)
+
+
+@istest
+def none_is_returned_if_no_index_has_entry():
+    index_cache = _FakeIndexCache({"first": (0, []), "second": (0, [])})
+    assert_equal(None, find_in_indices(["first", "second"], _find_nginx, index_cache))
+
+
+@istest
+def indices_are_read_concurrently():
+    index_cache = _FakeIndexCache({
+        "first": (0.3, []),
+        "second": (0.3, []),
+        "third": (0.3, ["nginx.whack-source"]),
+    })
+    start_time = time.time()
+    find_in_indices(["first", "second", "third"], _find_nginx, index_cache)
+    assert time.time() - start_time < 0.8
+
+
+@istest
+def later_indices_are_not_waited_for_once_entry_is_found():
+    index_cache = _FakeIndexCache({
+        "first": (0, ["nginx.whack-source"]),
+        "second": (5, ["nginx.whack-source"]),
+    })
+    start_time = time.time()
+    find_in_indices(["first", "second"], _find_nginx, index_cache, timeout=10)
+    assert time.time() - start_time < 1
+
+
+@istest
+def index_that_does_not_respond_within_timeout_is_skipped():
+    index_cache = _FakeIndexCache({
+        "first": (5, ["nginx.whack-source"]),
+        "second": (0, ["nginx.whack-source"]),
+    })
+    entry = find_in_indices(["first", "second"], _find_nginx, index_cache, timeout=0.1)
+    assert_equal("second/nginx.whack-source", entry.url)
+
+
+@istest
+def each_index_is_given_its_own_timeout():
+    index_cache = _FakeIndexCache({
+        "first": (5, []),
+        "second": (5, []),
+        "third": (0.2, ["nginx.whack-source"]),
+    })
+    start_time = time.time()
+    entry = find_in_indices(["first", "second", "third"], _find_nginx, index_cache, timeout=0.5)
+    assert_equal("third/nginx.whack-source", entry.url)
+    assert time.time() - start_time < 2
+
+
+@istest
+def none_is_returned_if_every_index_times_out():
+    index_cache = _FakeIndexCache({"first": (5, ["nginx.whack-source"])})
+    assert_equal(None, find_in_indices(["first"], _find_nginx, index_cache, timeout=0.1))
+
+
+@istest
+def errors_from_indices_after_entry_is_found_are_ignored():
+    index_cache = _FakeIndexCache({
+        "first": (0, ["nginx.whack-source"]),
+        "second": (0, None),
+    })
+    entry = find_in_indices(["first", "second"], _find_nginx, index_cache)
+    assert_equal("first/nginx.whack-source", entry.url)
+
+
+@istest
+def errors_from_indices_before_entry_is_found_are_raised():
+    index_cache = _FakeIndexCache({
+        "first": (0, None),
+        "second": (0, ["nginx.whack-source"]),
+    })
+    assert_raises(
+        ValueError,
+        lambda: find_in_indices(["first", "second"], _find_nginx, index_cache)
+    )
+
+
+@istest
+def index_is_not_read_again_for_lookup_that_found_nothing():
+    with _index_server() as (server, cache_dir):
+        index_cache = IndexCache(os.path.join(cache_dir, "indices"))
+        miss_cache = IndexMissCache(os.path.join(cache_dir, "misses"), index_cache, ttl=3600)
+        _write_index(server, '<a href="apache.whack-source">apache.whack-source</a>')
+        index_uri = server.static_url("index.html")
+        
+        assert_equal(None, _find_nginx_with_miss_cache(index_uri, index_cache, miss_cache))
+        os.remove(os.path.join(server.root, "index.html"))
+        assert_equal(None, _find_nginx_with_miss_cache(index_uri, index_cache, miss_cache))
+
+
+@istest
+def index_is_read_again_once_miss_has_expired():
+    with _index_server() as (server, cache_dir):
+        index_cache = IndexCache(os.path.join(cache_dir, "indices"))
+        miss_cache = IndexMissCache(os.path.join(cache_dir, "misses"), index_cache, ttl=0.01)
+        _write_index(server, '<a href="apache.whack-source">apache.whack-source</a>')
+        index_uri = server.static_url("index.html")
+        
+        _find_nginx_with_miss_cache(index_uri, index_cache, miss_cache)
+        time.sleep(0.02)
+        _write_index(server, '<a href="nginx.whack-source">nginx.whack-source</a>')
+        os.utime(os.path.join(server.root, "index.html"), (2000000000, 2000000000))
+        
+        entry = _find_nginx_with_miss_cache(index_uri, index_cache, miss_cache)
+        assert_equal("nginx.whack-source", entry.name)
+
+
+@istest
+def misses_are_forgotten_when_cached_index_changes():
+    with _index_server() as (server, cache_dir):
+        index_cache = IndexCache(os.path.join(cache_dir, "indices"))
+        miss_cache = IndexMissCache(os.path.join(cache_dir, "misses"), index_cache, ttl=3600)
+        _write_index(server, '<a href="apache.whack-source">apache.whack-source</a>')
+        index_uri = server.static_url("index.html")
+        
+        _find_nginx_with_miss_cache(index_uri, index_cache, miss_cache)
+        _write_index(server, '<a href="nginx.whack-source">nginx.whack-source</a>')
+        os.utime(os.path.join(server.root, "index.html"), (2000000000, 2000000000))
+        read_index(index_uri, index_cache)
+        
+        entry = _find_nginx_with_miss_cache(index_uri, index_cache, miss_cache)
+        assert_equal("nginx.whack-source", entry.name)
+
+
+def _find_nginx_with_miss_cache(index_uri, index_cache, miss_cache):
+    return find_in_indices(
+        [index_uri],
+        _find_nginx,
+        index_cache,
+        miss_cache=miss_cache,
+        lookup_key="nginx",
+    )
+
+
+class _FakeIndexCache(object):
+    def __init__(self, indices):
+        self._indices = indices
+    
+    def read(self, index_uri):
+        delay, names = self._indices[index_uri]
+        time.sleep(delay)
+        if names is None:
+            raise ValueError("Could not read index")
+        links = "".join('<a href="{0}">{0}</a>'.format(name) for name in names)
+        return read_index_string(index_uri + "/", _html(links))
+
+
+def _find_nginx(index):
+    return index.find_package_source_by_name("nginx")
+
+
 _platform = Platform(
     os_name="linux",
     architecture="x86-64",
@@ -163,3 +530,15 @@ def _html(content):
         </body>
         </html>
     """.format(content)
+
+
+def _write_index(server, content):
+    write_file(os.path.join(server.root, "index.html"), _html(content))
+
+
+@contextlib.contextmanager
+def _index_server():
+    with create_temporary_dir() as server_root:
+        with create_temporary_dir() as cache_dir:
+            with start_static_http_server(server_root) as server:
+                yield server, cache_dir
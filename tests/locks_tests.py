@@ -0,0 +1,84 @@
+import os
+import sys
+import subprocess
+
+from nose.tools import istest, assert_equal
+
+from whack.locks import ReadWriteFileLock, SingleFlightLocks
+from whack.tempdir import create_temporary_dir
+
+
+@istest
+def shared_lock_can_be_held_by_many_holders_at_once():
+    with create_temporary_dir() as lock_dir:
+        lock_path = os.path.join(lock_dir, "cache.lock")
+        with ReadWriteFileLock(lock_path).shared():
+            with ReadWriteFileLock(lock_path).shared():
+                pass
+
+
+@istest
+def exclusive_lock_cannot_be_acquired_while_shared_lock_is_held():
+    with create_temporary_dir() as lock_dir:
+        lock_path = os.path.join(lock_dir, "cache.lock")
+        with ReadWriteFileLock(lock_path).shared():
+            with ReadWriteFileLock(lock_path).exclusive(blocking=False) as acquired:
+                assert_equal(False, acquired)
+
+
+@istest
+def exclusive_lock_can_be_acquired_once_shared_lock_is_released():
+    with create_temporary_dir() as lock_dir:
+        lock_path = os.path.join(lock_dir, "cache.lock")
+        with ReadWriteFileLock(lock_path).shared():
+            pass
+        with ReadWriteFileLock(lock_path).exclusive(blocking=False) as acquired:
+            assert_equal(True, acquired)
+
+
+@istest
+def lock_file_directory_is_created_if_missing():
+    with create_temporary_dir() as lock_dir:
+        lock_path = os.path.join(lock_dir, "whack/cache.lock")
+        with ReadWriteFileLock(lock_path).exclusive() as acquired:
+            assert_equal(True, acquired)
+
+
+@istest
+def single_flight_lock_is_held_by_one_holder_per_key():
+    with create_temporary_dir() as lock_dir:
+        locks = SingleFlightLocks(lock_dir)
+        with locks.hold("nginx"):
+            with locks.hold("nginx", blocking=False) as acquired:
+                assert_equal(False, acquired)
+            with locks.hold("apache2", blocking=False) as acquired:
+                assert_equal(True, acquired)
+
+
+@istest
+def single_flight_lock_held_by_crashed_process_can_be_acquired():
+    with create_temporary_dir() as lock_dir:
+        holder = subprocess.Popen(
+            [
+                sys.executable, "-c",
+                "import sys, time\n"
+                "from whack.locks import SingleFlightLocks\n"
+                "with SingleFlightLocks(sys.argv[1]).hold('nginx'):\n"
+                "    print('locked')\n"
+                "    sys.stdout.flush()\n"
+                "    time.sleep(60)\n",
+                lock_dir,
+            ],
+            stdout=subprocess.PIPE,
+        )
+        try:
+            assert_equal(b"locked\n", holder.stdout.readline())
+            with SingleFlightLocks(lock_dir).hold("nginx", blocking=False) as acquired:
+                assert_equal(False, acquired)
+        finally:
+            holder.kill()
+            holder.wait()
+            holder.stdout.close()
+        
+        with SingleFlightLocks(lock_dir).hold("nginx", blocking=False) as acquired:
+            assert_equal(True, acquired)
@@ -0,0 +1,48 @@
+from nose.tools import istest, assert_equal, assert_raises
+
+from whack.manifests import read_install_manifest_string, PackageInstall, InvalidManifest
+
+
+@istest
+def each_install_has_source_target_and_params():
+    installs = read_install_manifest_string("""[
+        {"source": "nginx", "target": "/opt/nginx", "params": {"version": "1.2.4"}},
+        {"source": "apache2", "target": "/opt/apache2"}
+    ]""")
+    
+    assert_equal([
+        PackageInstall("nginx", "/opt/nginx", {"version": "1.2.4"}),
+        PackageInstall("apache2", "/opt/apache2", {}),
+    ], installs)
+
+
+@istest
+def error_is_raised_if_install_is_missing_target():
+    assert_raises(
+        InvalidManifest,
+        lambda: read_install_manifest_string('[{"source": "nginx"}]')
+    )
+
+
+@istest
+def error_is_raised_if_manifest_is_not_a_list():
+    assert_raises(
+        InvalidManifest,
+        lambda: read_install_manifest_string('{"source": "nginx", "target": "/opt/nginx"}')
+    )
+
+
+@istest
+def error_is_raised_if_manifest_is_not_json():
+    assert_raises(InvalidManifest, lambda: read_install_manifest_string("nginx /opt/nginx"))
+
+
+@istest
+def error_is_raised_if_target_is_used_more_than_once():
+    assert_raises(
+        InvalidManifest,
+        lambda: read_install_manifest_string("""[
+            {"source": "nginx", "target": "/opt/web"},
+            {"source": "apache2", "target": "/opt/web/"}
+        ]""")
+    )
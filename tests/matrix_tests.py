@@ -0,0 +1,55 @@
+from nose.tools import istest, assert_equal
+
+from whack.matrix import expand_param_grid, admitted_workers, BuildMatrixError
+
+
+@istest
+def param_grid_is_expanded_to_every_combination_of_values():
+    combinations = expand_param_grid({"version": ["1", "2"], "ssl": ["on", "off"]})
+    
+    assert_equal([
+        {"ssl": "on", "version": "1"},
+        {"ssl": "on", "version": "2"},
+        {"ssl": "off", "version": "1"},
+        {"ssl": "off", "version": "2"},
+    ], combinations)
+
+
+@istest
+def fixed_params_are_included_in_every_combination():
+    combinations = expand_param_grid({"version": ["1", "2"]}, {"prefix": "/opt"})
+    
+    assert_equal([
+        {"prefix": "/opt", "version": "1"},
+        {"prefix": "/opt", "version": "2"},
+    ], combinations)
+
+
+@istest
+def empty_param_grid_has_single_combination_of_fixed_params():
+    assert_equal([{"prefix": "/opt"}], expand_param_grid({}, {"prefix": "/opt"}))
+
+
+@istest
+def workers_are_unchanged_if_memory_per_build_is_not_set():
+    assert_equal(8, admitted_workers(8, available_memory=1024))
+
+
+@istest
+def workers_are_limited_by_available_memory():
+    assert_equal(3, admitted_workers(8, memory_per_build=1024, available_memory=3 * 1024 + 512))
+
+
+@istest
+def at_least_one_worker_is_admitted():
+    assert_equal(1, admitted_workers(8, memory_per_build=1024, available_memory=512))
+
+
+@istest
+def build_matrix_error_describes_each_failure():
+    error = BuildMatrixError([({"version": "1", "ssl": "on"}, "ValueError: oops")])
+    
+    assert_equal(
+        "Failed to build 1 package(s):\nssl=on version=1: ValueError: oops",
+        str(error),
+    )
@@ -0,0 +1,185 @@
+import os
+import subprocess
+import contextlib
+
+from nose.tools import istest, assert_equal
+import mayo
+
+from whack.mirrors import SourceControlMirrors
+from whack.caching import DirectoryCacher
+from whack.locks import SingleFlightLocks
+from whack.tempdir import create_temporary_dir
+from whack.files import read_file, write_files, plain_file, delete_dir
+
+
+@istest
+def source_tree_of_default_branch_is_archived():
+    with _git_repo([plain_file("README", "Hello")]) as repo:
+        with _mirrors() as mirrors:
+            with create_temporary_dir() as temp_dir:
+                destination_dir = os.path.join(temp_dir, "source")
+                mirrors.archive(repo.uri, destination_dir)
+                
+                assert_equal("Hello", read_file(os.path.join(destination_dir, "README")))
+                assert not os.path.exists(os.path.join(destination_dir, ".git"))
+
+
+@istest
+def source_tree_is_reused_without_updating_mirror_if_commit_has_not_changed():
+    with _git_repo([plain_file("README", "Hello")]) as repo:
+        with create_temporary_dir() as cache_dir:
+            mirrors = _create_mirrors(cache_dir)
+            _archive(mirrors, repo.uri)
+            delete_dir(os.path.join(cache_dir, "mirrors"))
+            
+            assert_equal("Hello", _archive(mirrors, repo.uri)["README"])
+            assert not os.path.exists(os.path.join(cache_dir, "mirrors"))
+
+
+@istest
+def new_commits_are_fetched_into_existing_mirror():
+    with _git_repo([plain_file("README", "Hello")]) as repo:
+        with _mirrors() as mirrors:
+            _archive(mirrors, repo.uri)
+            repo.commit([plain_file("README", "Goodbye")])
+            
+            assert_equal("Goodbye", _archive(mirrors, repo.uri)["README"])
+
+
+@istest
+def revision_can_be_tag_or_branch():
+    with _git_repo([plain_file("README", "1")]) as repo:
+        repo.git(["tag", "-a", "v1", "-m", "v1"])
+        repo.git(["branch", "stable"])
+        repo.commit([plain_file("README", "2")])
+        
+        with _mirrors() as mirrors:
+            assert_equal("1", _archive(mirrors, repo.uri + "#v1")["README"])
+            assert_equal("1", _archive(mirrors, repo.uri + "#stable")["README"])
+            assert_equal("2", _archive(mirrors, repo.uri)["README"])
+
+
+@istest
+def revision_can_be_commit_id():
+    with _git_repo([plain_file("README", "1")]) as repo:
+        commit = repo.head()
+        repo.commit([plain_file("README", "2")])
+        
+        with _mirrors() as mirrors:
+            assert_equal("1", _archive(mirrors, "{0}#{1}".format(repo.uri, commit))["README"])
+
+
+@istest
+def source_tree_is_archived_from_mirror_if_remote_is_unavailable():
+    with _git_repo([plain_file("README", "Hello")]) as repo:
+        with create_temporary_dir() as cache_dir:
+            mirrors = _create_mirrors(cache_dir)
+            _archive(mirrors, repo.uri)
+            delete_dir(os.path.join(cache_dir, "source-trees"))
+            repo.make_unavailable()
+            
+            assert_equal("Hello", _archive(mirrors, repo.uri)["README"])
+
+
+@istest
+def branches_are_preferred_to_tags_with_same_name_whether_or_not_remote_is_available():
+    with _git_repo([plain_file("README", "1")]) as repo:
+        repo.git(["tag", "release"])
+        repo.git(["branch", "release"])
+        repo.git(["checkout", "--quiet", "release"])
+        repo.commit([plain_file("README", "2")])
+        
+        with create_temporary_dir() as cache_dir:
+            mirrors = _create_mirrors(cache_dir)
+            assert_equal("2", _archive(mirrors, repo.uri + "#release")["README"])
+            delete_dir(os.path.join(cache_dir, "source-trees"))
+            repo.make_unavailable()
+            
+            assert_equal("2", _archive(mirrors, repo.uri + "#release")["README"])
+
+
+@istest
+def files_ignored_by_git_archive_are_included():
+    with _git_repo([
+        plain_file(".gitattributes", "secret export-ignore\nREADME export-subst\n"),
+        plain_file("secret", "Shh"),
+        plain_file("README", "$Format:%H$"),
+    ]) as repo:
+        with _mirrors() as mirrors:
+            files = _archive(mirrors, repo.uri)
+            
+            assert_equal("Shh", files["secret"])
+            assert_equal("$Format:%H$", files["README"])
+
+
+@istest
+def default_revision_is_the_same_as_without_mirror():
+    with _git_repo([plain_file("README", "1")]) as repo:
+        repo.git(["checkout", "--quiet", "-b", "other"])
+        repo.commit([plain_file("README", "2")])
+        
+        with _mirrors() as mirrors:
+            with create_temporary_dir() as temp_dir:
+                destination_dir = os.path.join(temp_dir, "source")
+                mayo.archive(repo.uri, destination_dir)
+                expected = read_file(os.path.join(destination_dir, "README"))
+            
+            assert_equal("1", expected)
+            assert_equal(expected, _archive(mirrors, repo.uri)["README"])
+
+
+def _archive(mirrors, source_name):
+    with create_temporary_dir() as temp_dir:
+        destination_dir = os.path.join(temp_dir, "source")
+        mirrors.archive(source_name, destination_dir)
+        return dict(
+            (filename, read_file(os.path.join(destination_dir, filename)))
+            for filename in os.listdir(destination_dir)
+        )
+
+
+@contextlib.contextmanager
+def _mirrors():
+    with create_temporary_dir() as cache_dir:
+        yield _create_mirrors(cache_dir)
+
+
+def _create_mirrors(cache_dir):
+    return SourceControlMirrors(
+        os.path.join(cache_dir, "mirrors"),
+        DirectoryCacher(os.path.join(cache_dir, "source-trees")),
+        single_flight_locks=SingleFlightLocks(os.path.join(cache_dir, "locks")),
+    )
+
+
+@contextlib.contextmanager
+def _git_repo(files):
+    with create_temporary_dir() as repo_dir:
+        repo = GitRepo(repo_dir)
+        repo.git(["init", "--quiet"])
+        repo.git(["symbolic-ref", "HEAD", "refs/heads/master"])
+        repo.commit(files)
+        yield repo
+
+
+class GitRepo(object):
+    def __init__(self, path):
+        self.path = path
+        self.uri = "git+file://{0}".format(path)
+    
+    def commit(self, files):
+        write_files(self.path, files)
+        self.git(["add", "."])
+        self.git(["commit", "--quiet", "-m", "Update"])
+    
+    def make_unavailable(self):
+        os.rename(os.path.join(self.path, ".git"), os.path.join(self.path, ".git-unavailable"))
+    
+    def head(self):
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=self.path).decode("ascii").strip()
+    
+    def git(self, command):
+        subprocess.check_call(
+            ["git", "-c", "user.name=whack", "-c", "user.email=whack@example.com"] + command,
+            cwd=self.path,
+        )
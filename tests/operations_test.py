@@ -5,13 +5,19 @@ import contextlib
 from nose.tools import istest, assert_equal
 
 from whack.operations import Operations
+from whack.packagerequests import create_package_request
+from whack.matrix import BuildMatrixError
 from whack.sources import PackageSource
 from whack.providers import create_package_provider
 from whack.deployer import PackageDeployer
 from . import testing
 from whack.tempdir import create_temporary_dir
-from whack.caching import NoCacheCachingFactory
+from whack.caching import NoCacheCachingFactory, DirectoryCacher
+from whack.manifests import PackageInstall
+from whack.files import read_file, write_file, write_files, plain_file, mkdir_p
 from whack import local
+from whack.stats import default_counters
+import dodge
 
 
 test = istest
@@ -99,6 +105,165 @@ chmod +x $INSTALL_DIR/bin/hello
     assert_equal(b"Hello there\n", output)
     
 
+@test
+def install_many_installs_each_package_into_its_target():
+    operations = Operations(
+        SimplePackageSourceFetcher(),
+        ParamsWritingPackageProvider(),
+        PackageDeployer(),
+    )
+    with _temporary_package_source("") as package_source_dir:
+        with create_temporary_dir() as install_dir:
+            operations.install_many([
+                PackageInstall(package_source_dir, os.path.join(install_dir, str(index)), {"index": str(index)})
+                for index in range(8)
+            ], workers=4)
+            
+            for index in range(8):
+                assert_equal(str(index), read_file(os.path.join(install_dir, str(index), "index")))
+                assert os.path.exists(os.path.join(install_dir, str(index), "run"))
+
+
+@test
+def install_many_raises_error_of_first_failed_install_in_order():
+    operations = Operations(
+        SimplePackageSourceFetcher(),
+        ParamsWritingPackageProvider(),
+        PackageDeployer(),
+    )
+    with _temporary_package_source("") as package_source_dir:
+        with create_temporary_dir() as install_dir:
+            installs = [
+                PackageInstall(package_source_dir, os.path.join(install_dir, "0"), {"fail": "first"}),
+                PackageInstall(package_source_dir, os.path.join(install_dir, "1")),
+                PackageInstall(package_source_dir, os.path.join(install_dir, "2"), {"fail": "second"}),
+            ]
+            try:
+                operations.install_many(installs)
+                assert False, "Expected ValueError"
+            except ValueError as error:
+                assert_equal("first", str(error))
+            assert os.path.exists(os.path.join(install_dir, "1", "run"))
+
+
+@test
+def build_matrix_writes_tarball_for_each_combination_of_params():
+    operations = Operations(
+        SimplePackageSourceFetcher(),
+        DescribingPackageProvider(),
+        PackageDeployer(),
+    )
+    with _temporary_package_source("") as package_source_dir:
+        with create_temporary_dir() as tarball_dir:
+            tarballs = operations.build_matrix(
+                package_source_dir,
+                tarball_dir,
+                {"version": ["1", "2"], "ssl": ["on", "off"]},
+                params={"prefix": "/opt"},
+                workers=2,
+            )
+            
+            assert_equal(4, len(tarballs))
+            assert_equal(4, len(set(tarball.path for tarball in tarballs)))
+            for tarball in tarballs:
+                assert os.path.exists(tarball.path)
+
+
+@test
+def build_matrix_hashes_source_before_starting_build_processes():
+    operations = Operations(
+        SimplePackageSourceFetcher(),
+        DescribingPackageProvider(),
+        PackageDeployer(),
+    )
+    with _temporary_package_source("") as package_source_dir:
+        with create_temporary_dir() as tarball_dir:
+            default_counters.reset()
+            operations.build_matrix(package_source_dir, tarball_dir, {"version": ["1", "2"]})
+            
+            assert default_counters.values().get("hash.files", 0) > 0
+
+
+@test
+def build_matrix_uses_cached_packages_without_building():
+    with _temporary_package_source("") as package_source_dir:
+        with create_temporary_dir() as cacher_dir:
+            cacher = DirectoryCacher(cacher_dir)
+            cached_params = {"version": "1", "fail": "should be cached"}
+            with create_temporary_dir() as package_dir:
+                DescribingPackageProvider().provide_package(
+                    _package_request(package_source_dir, {"version": "1"}),
+                    package_dir,
+                )
+                cached_request = _package_request(package_source_dir, cached_params)
+                cacher.put(cached_request.name(), package_dir)
+            
+            operations = Operations(
+                SimplePackageSourceFetcher(),
+                DescribingPackageProvider(),
+                PackageDeployer(),
+                caches={"packages": cacher},
+            )
+            with create_temporary_dir() as tarball_dir:
+                tarballs = operations.build_matrix(
+                    package_source_dir,
+                    tarball_dir,
+                    {"version": ["1"]},
+                    params={"fail": "should be cached"},
+                )
+                
+                assert_equal(1, len(tarballs))
+                assert os.path.exists(tarballs[0].path)
+
+
+@test
+def build_matrix_reports_every_failed_combination():
+    operations = Operations(
+        SimplePackageSourceFetcher(),
+        DescribingPackageProvider(),
+        PackageDeployer(),
+    )
+    with _temporary_package_source("") as package_source_dir:
+        with create_temporary_dir() as tarball_dir:
+            try:
+                operations.build_matrix(
+                    package_source_dir,
+                    tarball_dir,
+                    {"fail": ["first", "second"], "version": ["1"]},
+                )
+                assert False, "Expected BuildMatrixError"
+            except BuildMatrixError as error:
+                assert "fail=first version=1: ValueError: first" in str(error)
+                assert "fail=second version=1: ValueError: second" in str(error)
+
+
+class ParamsWritingPackageProvider(object):
+    def provide_package(self, package_request, package_dir):
+        params = package_request.params()
+        if "fail" in params:
+            raise ValueError(params["fail"])
+        mkdir_p(package_dir)
+        write_files(package_dir, [
+            plain_file(key, value)
+            for key, value in params.items()
+        ])
+        return True
+
+
+class DescribingPackageProvider(ParamsWritingPackageProvider):
+    def provide_package(self, package_request, package_dir):
+        ParamsWritingPackageProvider.provide_package(self, package_request, package_dir)
+        write_file(
+            os.path.join(package_dir, ".whack-package.json"),
+            dodge.dumps(package_request.describe())
+        )
+        return True
+
+
+def _package_request(package_source_dir, params):
+    return create_package_request(PackageSource.local(package_source_dir), params)
+
+
 @contextlib.contextmanager
 def _temporary_install(build, params=None):
     with _temporary_package_source(build) as package_source_dir:
@@ -1,6 +1,11 @@
 from nose.tools import istest, assert_equal
 
-from whack.platform import PlatformGenerator, Platform
+import os
+
+from whack.platform import \
+    PlatformGenerator, PlatformProbe, PlatformFileCache, Platform, \
+    generate_platform
+from whack.tempdir import create_temporary_dir
 
 
 @istest
@@ -21,6 +26,39 @@ def libc_version_is_derived_from_getconf_gnu_libc_version():
     assert_equal(platform.libc, "glibc-2.13")
 
 
+@istest
+def probe_reads_platform_from_uname_and_confstr_without_running_commands():
+    probe = PlatformProbe(system=System(), fallback=None)
+    assert_equal(
+        Platform(os_name="linux", architecture="x86-64", libc="glibc-2.13"),
+        probe.platform(),
+    )
+
+
+@istest
+def probe_uses_fallback_if_libc_version_cannot_be_read():
+    fallback = PlatformGenerator(shell=Shell())
+    probe = PlatformProbe(system=System(libc=None), fallback=fallback)
+    assert_equal("glibc-2.13", probe.platform().libc)
+
+
+@istest
+def probe_stores_fallback_result_in_cache_keyed_by_kernel_release():
+    with create_temporary_dir() as cache_dir:
+        cache = PlatformFileCache(cache_dir)
+        fallback = PlatformGenerator(shell=Shell())
+        PlatformProbe(system=System(libc=None), fallback=fallback, cache=cache).platform()
+        
+        probe = PlatformProbe(system=System(libc=None), fallback=None, cache=cache)
+        assert_equal("glibc-2.13", probe.platform().libc)
+        assert_equal(["3.2.0-4-amd64"], os.listdir(cache_dir))
+
+
+@istest
+def generate_platform_returns_the_same_platform_on_each_call():
+    assert generate_platform() is generate_platform()
+
+
 @istest
 def can_use_other_glibc_if_minor_version_is_the_same():
     assert _platform_with_libc("glibc-2.13").can_use(_platform_with_libc("glibc-2.12"))
@@ -97,6 +135,18 @@ class Shell(object):
         return self._results[tuple(command)]
 
 
+class System(object):
+    def __init__(self, libc="glibc 2.13"):
+        self._libc = libc
+        
+    def uname(self):
+        return ("Linux", "localhost", "3.2.0-4-amd64", "#1 SMP", "x86_64")
+        
+    def confstr(self, name):
+        assert_equal("CS_GNU_LIBC_VERSION", name)
+        return self._libc
+
+
 class ExecutionResult(object):
     def __init__(self, output):
         self.output = output
@@ -2,15 +2,19 @@ import os
 import os.path
 import tempfile
 import uuid
+import time
+import threading
 
 from nose.tools import istest, assert_equal
 
 from whack.sources import PackageSource
 from whack.providers import CachingPackageProvider
 from catchy import DirectoryCacher
+import whack.caching
 from whack.files import delete_dir
 from whack.packagerequests import create_package_request
 from whack.files import mkdir_p
+from whack.locks import SingleFlightLocks
 
 
 @istest
@@ -44,13 +48,69 @@ class CachingProviderTests(object):
     
         assert_equal(2, self._number_of_builds())
     
-    def _get_package(self, params):
-        target_dir = os.path.join(self._test_dir, str(uuid.uuid4()))
+    @istest
+    def concurrent_requests_for_same_package_only_build_once(self):
+        self._underlying_provider = FakeProvider(build_seconds=0.2)
         package_source_dir = os.path.join(self._test_dir, str(uuid.uuid4()))
+        threads = [
+            threading.Thread(
+                target=self._get_package,
+                args=({"VERSION": "2.4"}, ),
+                kwargs={"package_source_dir": package_source_dir},
+            )
+            for index in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        assert_equal(1, self._number_of_builds())
+    
+    @istest
+    def prefetch_does_nothing_if_package_is_cached(self):
+        self._cacher = whack.caching.DirectoryCacher(os.path.join(self._test_dir, "cache"))
+        self._get_package(params={})
+        self._prefetch_package(params={})
+        
+        assert_equal(1, self._number_of_builds())
+        assert_equal(0, len(self._underlying_provider.prefetches))
+    
+    @istest
+    def prefetch_uses_underlying_provider_if_package_is_not_cached(self):
+        self._cacher = whack.caching.DirectoryCacher(os.path.join(self._test_dir, "cache"))
+        self._prefetch_package(params={})
+        
+        assert_equal(1, len(self._underlying_provider.prefetches))
+        assert_equal([], self._cacher.entries())
+    
+    @istest
+    def package_provided_by_prefetch_is_cached(self):
+        self._cacher = whack.caching.DirectoryCacher(os.path.join(self._test_dir, "cache"))
+        self._underlying_provider = FakeProvider(prefetch_provides_package=True)
+        self._prefetch_package(params={})
+        self._get_package(params={})
+        
+        assert_equal(0, self._number_of_builds())
+    
+    def _prefetch_package(self, params):
         package_provider = CachingPackageProvider(
             cacher=self._cacher,
             underlying_provider=self._underlying_provider,
         )
+        package_source_dir = os.path.join(self._test_dir, str(uuid.uuid4()))
+        request = create_package_request(PackageSource.local(package_source_dir), params)
+        package_provider.prefetch_package(request)
+    
+    def _get_package(self, params, package_source_dir=None):
+        target_dir = os.path.join(self._test_dir, str(uuid.uuid4()))
+        if package_source_dir is None:
+            package_source_dir = os.path.join(self._test_dir, str(uuid.uuid4()))
+        package_provider = CachingPackageProvider(
+            cacher=self._cacher,
+            underlying_provider=self._underlying_provider,
+            single_flight_locks=SingleFlightLocks(os.path.join(self._test_dir, "locks")),
+        )
         request = create_package_request(PackageSource.local(package_source_dir), params)
         package_provider.provide_package(request, target_dir)
 
@@ -59,10 +119,20 @@ class CachingProviderTests(object):
 
 
 class FakeProvider(object):
-    def __init__(self):
+    def __init__(self, build_seconds=0, prefetch_provides_package=False):
         self.requests = []
+        self.prefetches = []
+        self._build_seconds = build_seconds
+        self._prefetch_provides_package = prefetch_provides_package
     
     def provide_package(self, package_request, package_dir):
+        time.sleep(self._build_seconds)
         mkdir_p(package_dir)
         self.requests.append(package_request)
         return True
+    
+    def prefetch_package(self, package_request, package_dir):
+        self.prefetches.append(package_request)
+        if self._prefetch_provides_package:
+            mkdir_p(package_dir)
+        return self._prefetch_provides_package
@@ -7,10 +7,11 @@ from nose.tools import istest, assert_equal, assert_raises
 
 from whack.sources import \
     PackageSourceFetcher, PackageSourceNotFound, SourceHashMismatch, \
-    PackageSource, create_source_tarball
+    PackageSource, create_source_tarball, UnsupportedSourceHashVersion
 from whack.tempdir import create_temporary_dir
 from whack.files import read_file, write_files, plain_file
 from whack.tarballs import create_tarball
+from whack.caching import DirectoryCacher
 from whack.errors import FileNotFoundError
 from .httpserver import start_static_http_server
 from .indexserver import start_index_server
@@ -67,6 +68,27 @@ def can_fetch_package_source_from_whack_source_uri():
         _assert_package_source_can_be_written_to_target_dir(create_source)
 
 
+@istest
+def can_fetch_package_source_with_merkle_source_hash_from_whack_source_uri():
+    with _temporary_static_server() as server:
+        def create_source(package_source_dir):
+            write_files(package_source_dir, [
+                plain_file("whack/whack.json", json.dumps({"sourceHashVersion": 2})),
+            ])
+            package_source = PackageSource.local(package_source_dir)
+            source_tarball = create_source_tarball(package_source, server.root)
+            filename = os.path.relpath(source_tarball.path, server.root)
+            return server.static_url(filename)
+            
+        _assert_package_source_can_be_written_to_target_dir(create_source)
+
+
+@istest
+def error_is_raised_if_source_hash_version_is_not_supported():
+    with _source_package_with_description({"sourceHashVersion": 3}) as package_source:
+        assert_raises(UnsupportedSourceHashVersion, package_source.source_hash)
+
+
 @istest
 def error_is_raised_if_hash_is_not_correct():
     with _temporary_static_server() as server:
@@ -81,6 +103,50 @@ def error_is_raised_if_hash_is_not_correct():
             )
 
 
+@istest
+def package_source_from_http_server_is_fetched_again_even_if_cached():
+    with _temporary_static_server() as server:
+        tarball_path = os.path.join(server.root, "package.tar.gz")
+        package_uri = server.static_url("package.tar.gz")
+        with _source_tree_caching_fetcher() as source_fetcher:
+            _create_source_tarball_named(tarball_path, "Bob")
+            with source_fetcher.fetch(package_uri):
+                pass
+            _create_source_tarball_named(tarball_path, "Jim")
+            
+            with source_fetcher.fetch(package_uri) as package_source:
+                assert_equal("Jim", read_file(os.path.join(package_source.path, "whack/name")))
+
+
+@istest
+def cached_package_source_is_used_if_http_server_cannot_be_reached():
+    with _source_tree_caching_fetcher() as source_fetcher:
+        with _temporary_static_server() as server:
+            _create_source_tarball_named(os.path.join(server.root, "package.tar.gz"), "Bob")
+            package_uri = server.static_url("package.tar.gz")
+            with source_fetcher.fetch(package_uri):
+                pass
+        
+        with source_fetcher.fetch(package_uri) as package_source:
+            assert_equal("Bob", read_file(os.path.join(package_source.path, "whack/name")))
+
+
+@istest
+def whack_source_from_http_server_is_fetched_from_source_tree_cache_once_cached():
+    with _temporary_static_server() as server:
+        with _create_temporary_package_source_dir() as package_source_dir:
+            source_tarball = create_source_tarball(PackageSource.local(package_source_dir), server.root)
+        package_uri = server.static_url(os.path.relpath(source_tarball.path, server.root))
+        
+        with _source_tree_caching_fetcher() as source_fetcher:
+            with source_fetcher.fetch(package_uri):
+                pass
+            os.remove(source_tarball.path)
+            
+            with source_fetcher.fetch(package_uri) as package_source:
+                assert_equal("Bob", read_file(os.path.join(package_source.path, "whack/name")))
+
+
 @istest
 def can_fetch_package_source_using_url_from_html_index():
     with start_index_server() as index_server:
@@ -217,6 +283,19 @@ def _fetch_source(package_source_uri, indices=None):
     return source_fetcher.fetch(package_source_uri)
 
 
+@contextlib.contextmanager
+def _source_tree_caching_fetcher():
+    with create_temporary_dir() as cache_dir:
+        yield PackageSourceFetcher(
+            source_tree_cacher=DirectoryCacher(os.path.join(cache_dir, "source-trees")),
+        )
+
+
+def _create_source_tarball_named(tarball_path, name):
+    with create_temporary_dir([plain_file("whack/name", name)]) as package_source_dir:
+        create_tarball(tarball_path, package_source_dir)
+
+
 @contextlib.contextmanager
 def _temporary_static_server():
     with create_temporary_dir() as server_root:
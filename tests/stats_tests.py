@@ -0,0 +1,65 @@
+import os
+import json
+
+from nose.tools import istest, assert_equal
+
+from whack.stats import Counters, collect_stats, write_stats_json, add_to_cumulative_stats
+from whack.httpclient import HttpClient
+from whack.tempdir import create_temporary_dir
+
+
+@istest
+def counters_are_incremented_by_one_by_default():
+    counters = Counters()
+    counters.increment("packages.cache_hits")
+    counters.increment("packages.cache_hits")
+    counters.increment("hash.bytes", 42)
+    
+    assert_equal({"packages.cache_hits": 2, "hash.bytes": 42}, counters.values())
+
+
+@istest
+def timed_blocks_add_elapsed_seconds():
+    counters = Counters()
+    with counters.time("deploy"):
+        pass
+    
+    assert "deploy.seconds" in counters.values()
+
+
+@istest
+def collected_stats_include_http_client_counters():
+    counters = Counters()
+    counters.increment("downloads.cache_misses")
+    
+    stats = collect_stats(counters, HttpClient())
+    
+    assert_equal(1, stats["downloads.cache_misses"])
+    assert_equal(0, stats["http.requests"])
+
+
+@istest
+def stats_json_contains_counters():
+    with create_temporary_dir() as stats_dir:
+        path = os.path.join(stats_dir, "stats.json")
+        write_stats_json(path, {"packages.cache_hits": 1})
+        
+        assert_equal({"counters": {"packages.cache_hits": 1}}, _read_json(path))
+
+
+@istest
+def cumulative_stats_are_summed_across_runs():
+    with create_temporary_dir() as stats_dir:
+        path = os.path.join(stats_dir, "stats.json")
+        add_to_cumulative_stats(path, {"packages.cache_hits": 1})
+        add_to_cumulative_stats(path, {"packages.cache_hits": 2, "packages.cache_misses": 1})
+        
+        assert_equal(
+            {"runs": 2, "counters": {"packages.cache_hits": 3, "packages.cache_misses": 1}},
+            _read_json(path),
+        )
+
+
+def _read_json(path):
+    with open(path) as json_file:
+        return json.load(json_file)
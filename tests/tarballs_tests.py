@@ -0,0 +1,215 @@
+import os
+import hashlib
+import contextlib
+
+from nose.tools import istest, assert_equal, assert_raises
+
+from whack.tarballs import create_tarball, extract_tarball, \
+    compressions, UnsupportedCompression, TarballVerificationError
+from whack.tempdir import create_temporary_dir
+from whack.files import plain_file, read_file, write_file
+from whack.httpclient import HttpError
+from whack import local
+from whack.tracing import default_tracer
+from .httpserver import start_static_http_server
+
+
+@istest
+def tarball_on_http_server_is_extracted_with_leading_components_stripped():
+    with create_temporary_dir() as server_root:
+        with create_temporary_dir([plain_file("one/message", "Hello")]) as source_dir:
+            create_tarball(os.path.join(server_root, "package.tar.gz"), source_dir)
+        
+        with start_static_http_server(server_root) as server:
+            with create_temporary_dir() as target_dir:
+                url = server.static_url("package.tar.gz")
+                extract_tarball(url, target_dir, strip_components=1)
+                assert_equal("Hello", read_file(os.path.join(target_dir, "one/message")))
+
+
+@istest
+def error_is_raised_if_tarball_is_missing_from_http_server():
+    with create_temporary_dir() as server_root:
+        with start_static_http_server(server_root) as server:
+            with create_temporary_dir() as target_dir:
+                url = server.static_url("package.tar.gz")
+                assert_raises(
+                    HttpError,
+                    lambda: extract_tarball(url, target_dir, strip_components=1)
+                )
+
+
+@istest
+def tarball_on_http_server_is_extracted_if_size_and_hash_match():
+    with _tarball_on_http_server() as (url, tarball_bytes):
+        with create_temporary_dir() as target_dir:
+            extract_tarball(
+                url,
+                target_dir,
+                strip_components=1,
+                size=len(tarball_bytes),
+                hash="sha1:{0}".format(hashlib.sha1(tarball_bytes).hexdigest()),
+            )
+            assert_equal("Hello", read_file(os.path.join(target_dir, "one/message")))
+
+
+@istest
+def error_is_raised_if_size_of_tarball_on_http_server_does_not_match():
+    with _tarball_on_http_server() as (url, tarball_bytes):
+        with create_temporary_dir() as target_dir:
+            assert_raises(
+                TarballVerificationError,
+                lambda: extract_tarball(url, target_dir, strip_components=1, size=len(tarball_bytes) + 1)
+            )
+            assert_equal([], os.listdir(target_dir))
+
+
+@istest
+def error_is_raised_if_hash_of_tarball_on_http_server_does_not_match():
+    with _tarball_on_http_server() as (url, tarball_bytes):
+        with create_temporary_dir() as target_dir:
+            assert_raises(
+                TarballVerificationError,
+                lambda: extract_tarball(
+                    url,
+                    target_dir,
+                    strip_components=1,
+                    hash="sha1:da39a3ee5e6b4b0d3255bfef95601890afd80709",
+                )
+            )
+            assert_equal([], os.listdir(target_dir))
+
+
+@istest
+def verified_tarball_on_http_server_is_extracted_alongside_existing_files():
+    with _tarball_on_http_server() as (url, tarball_bytes):
+        with create_temporary_dir([plain_file("existing", "Hi")]) as target_dir:
+            extract_tarball(url, target_dir, strip_components=1, size=len(tarball_bytes))
+            
+            assert_equal(["existing", "one"], sorted(os.listdir(target_dir)))
+            assert_equal("Hello", read_file(os.path.join(target_dir, "one/message")))
+
+
+@istest
+def error_is_raised_if_hash_of_local_tarball_does_not_match():
+    with create_temporary_dir() as temp_dir:
+        tarball_path = os.path.join(temp_dir, "package.tar.gz")
+        with create_temporary_dir([plain_file("one/message", "Hello")]) as source_dir:
+            create_tarball(tarball_path, source_dir)
+        
+        with create_temporary_dir() as target_dir:
+            assert_raises(
+                TarballVerificationError,
+                lambda: extract_tarball(
+                    tarball_path,
+                    target_dir,
+                    strip_components=1,
+                    hash="sha1:da39a3ee5e6b4b0d3255bfef95601890afd80709",
+                )
+            )
+
+
+@istest
+def error_is_raised_if_tarball_on_http_server_is_invalid():
+    with create_temporary_dir() as server_root:
+        write_file(os.path.join(server_root, "package.tar.gz"), "Not a tarball")
+        with start_static_http_server(server_root) as server:
+            with create_temporary_dir() as target_dir:
+                url = server.static_url("package.tar.gz")
+                assert_raises(
+                    local.RunProcessError,
+                    lambda: extract_tarball(url, target_dir, strip_components=1)
+                )
+
+
+@istest
+def tarballs_can_be_created_and_extracted_with_each_compression():
+    for compression in compressions:
+        _assert_round_trip(compression)
+
+
+@istest
+def compression_level_can_be_specified():
+    _assert_round_trip("gzip:1")
+    _assert_round_trip("parallel-gzip:9")
+
+
+@istest
+def parallel_gzip_tarballs_are_valid_gzip_files():
+    with create_temporary_dir() as server_root:
+        message = "Hello " * 500000
+        with create_temporary_dir([plain_file("one/message", message)]) as source_dir:
+            tarball_path = os.path.join(server_root, "package.tar.gz")
+            create_tarball(tarball_path, source_dir, compression="parallel-gzip")
+        
+        local.run(["gzip", "--test", tarball_path])
+        with create_temporary_dir() as target_dir:
+            extract_tarball(tarball_path, target_dir, strip_components=1)
+            assert_equal(message, read_file(os.path.join(target_dir, "one/message")))
+
+
+@istest
+def error_is_raised_if_compression_is_unsupported():
+    with create_temporary_dir() as source_dir:
+        for compression in ["zip", "gzip:10", "gzip:best", "none:1"]:
+            assert_raises(
+                UnsupportedCompression,
+                lambda: create_tarball(
+                    os.path.join(source_dir, "package.tar"),
+                    source_dir,
+                    compression=compression,
+                )
+            )
+
+
+@istest
+def tar_processes_are_traced():
+    default_tracer.enable()
+    try:
+        with create_temporary_dir() as server_root:
+            with create_temporary_dir([plain_file("one/message", "Hello")]) as source_dir:
+                create_tarball(os.path.join(server_root, "package.tar.gz"), source_dir)
+            
+            with start_static_http_server(server_root) as server:
+                with create_temporary_dir() as target_dir:
+                    extract_tarball(server.static_url("package.tar.gz"), target_dir, strip_components=1)
+    finally:
+        default_tracer.enabled = False
+    
+    tar_commands = [
+        event["args"]["argv"][:2]
+        for event in default_tracer.events()
+        if event["name"] == "run" and event["args"]["argv"][0] == "tar"
+    ]
+    assert ["tar", "cf"] in tar_commands
+    assert ["tar", "xzf"] in tar_commands
+
+
+def _assert_round_trip(compression):
+    with create_temporary_dir() as server_root:
+        with create_temporary_dir([plain_file("one/message", "Hello")]) as source_dir:
+            tarball_path = os.path.join(server_root, "package.tar")
+            create_tarball(tarball_path, source_dir, compression=compression)
+        
+        with create_temporary_dir() as target_dir:
+            extract_tarball(tarball_path, target_dir, strip_components=1)
+            assert_equal("Hello", read_file(os.path.join(target_dir, "one/message")))
+        
+        with start_static_http_server(server_root) as server:
+            with create_temporary_dir() as target_dir:
+                url = server.static_url("package.tar")
+                extract_tarball(url, target_dir, strip_components=1)
+                assert_equal("Hello", read_file(os.path.join(target_dir, "one/message")))
+
+
+@contextlib.contextmanager
+def _tarball_on_http_server():
+    with create_temporary_dir() as server_root:
+        tarball_path = os.path.join(server_root, "package.tar.gz")
+        with create_temporary_dir([plain_file("one/message", "Hello")]) as source_dir:
+            create_tarball(tarball_path, source_dir)
+        with open(tarball_path, "rb") as tarball_file:
+            tarball_bytes = tarball_file.read()
+        
+        with start_static_http_server(server_root) as server:
+            yield server.static_url("package.tar.gz"), tarball_bytes
@@ -0,0 +1,73 @@
+import os
+import json
+
+from nose.tools import istest, assert_equal, assert_raises
+
+from whack.tracing import Tracer
+from whack.tempdir import create_temporary_dir
+
+
+@istest
+def spans_are_not_recorded_when_tracing_is_disabled():
+    tracer = Tracer()
+    with tracer.span("build"):
+        pass
+    
+    assert_equal([], tracer.events())
+
+
+@istest
+def spans_are_recorded_as_complete_events_when_tracing_is_enabled():
+    tracer = Tracer()
+    tracer.enable()
+    with tracer.span("run", category="process", argv=["tar", "xf", "nginx.tar"]):
+        pass
+    
+    event, = tracer.events()
+    assert_equal("run", event["name"])
+    assert_equal("process", event["cat"])
+    assert_equal("X", event["ph"])
+    assert_equal(os.getpid(), event["pid"])
+    assert_equal({"argv": ["tar", "xf", "nginx.tar"]}, event["args"])
+    assert event["dur"] >= 0
+
+
+@istest
+def spans_that_raise_exceptions_record_error():
+    tracer = Tracer()
+    tracer.enable()
+    
+    def run():
+        with tracer.span("build"):
+            raise ValueError()
+    
+    assert_raises(ValueError, run)
+    event, = tracer.events()
+    assert_equal({"error": "ValueError"}, event["args"])
+
+
+@istest
+def nested_spans_are_recorded_inner_first():
+    tracer = Tracer()
+    tracer.enable()
+    with tracer.span("get_package"):
+        with tracer.span("build"):
+            pass
+    
+    assert_equal(["build", "get_package"], [event["name"] for event in tracer.events()])
+
+
+@istest
+def trace_is_written_in_chrome_trace_event_format():
+    tracer = Tracer()
+    tracer.enable()
+    with tracer.span("build"):
+        pass
+    
+    with create_temporary_dir() as trace_dir:
+        path = os.path.join(trace_dir, "trace.json")
+        tracer.write(path)
+        with open(path) as trace_file:
+            trace = json.load(trace_file)
+    
+    assert_equal(["build"], [event["name"] for event in trace["traceEvents"]])
@@ -42,6 +42,74 @@ def param_without_equal_sign_has_value_of_empty_string():
     _test_install_arg_parse(argv, params=expected_params)
 
 
+@istest
+def cache_size_can_have_unit_suffix():
+    argv = ["whack", "cache", "gc", "--cache-max-size", "2G", "--cache-max-entries", "10"]
+    _test_install_arg_parse(argv, cache_max_size=2 * 1024 ** 3, cache_max_entries=10)
+
+
+@istest
+def each_cache_can_be_given_its_own_limits():
+    argv = [
+        "whack", "cache", "gc",
+        "--packages-cache-max-size", "10G",
+        "--downloads-cache-max-entries", "5",
+        "--source-trees-cache-max-size", "1M",
+    ]
+    _test_install_arg_parse(
+        argv,
+        packages_cache_max_size=10 * 1024 ** 3,
+        packages_cache_max_entries=None,
+        downloads_cache_max_entries=5,
+        source_trees_cache_max_size=1024 ** 2,
+    )
+
+
+@istest
+def cache_limits_can_be_set_in_environment():
+    with _updated_env({"WHACK_DOWNLOADS_CACHE_MAX_SIZE": "2G"}):
+        argv = ["whack", "cache", "gc"]
+        _test_install_arg_parse(argv, downloads_cache_max_size=2 * 1024 ** 3)
+
+
+@istest
+def cache_pin_command_accepts_params():
+    argv = ["whack", "cache", "pin", "apps/hello", "-p", "version=1.2.4", "--unpin"]
+    _test_install_arg_parse(
+        argv,
+        cache_command="pin",
+        package_source="apps/hello",
+        params={"version": "1.2.4"},
+        pinned=False,
+    )
+
+
+@istest
+def prefetch_command_accepts_params():
+    argv = ["whack", "prefetch", "apps/hello", "-p", "version=1.2.4"]
+    _test_install_arg_parse(argv, package_source="apps/hello", params={"version": "1.2.4"})
+
+
+@istest
+def build_matrix_command_collects_param_grid():
+    argv = [
+        "whack", "build-matrix", "apps/hello", "tarballs",
+        "--param-grid", "version=1.2.4,1.2.5",
+        "--param-grid", "ssl=on,off",
+        "-p", "prefix=/opt",
+        "--memory-per-build", "512M",
+    ]
+    _test_install_arg_parse(
+        argv,
+        package_source="apps/hello",
+        package_tarball_dir="tarballs",
+        param_grid={"version": ["1.2.4", "1.2.5"], "ssl": ["on", "off"]},
+        params={"prefix": "/opt"},
+        memory_per_build=512 * 1024 ** 2,
+        workers=None,
+    )
+
+
 def _test_install_arg_parse(argv, **expected_kwargs):
     args = cli.parse_args(argv)
     
@@ -49,6 +117,17 @@ def _test_install_arg_parse(argv, **expected_kwargs):
         assert_equal(value, getattr(args, key))
 
 
+@contextlib.contextmanager
+def _updated_env(env):
+    original_env = os.environ.copy()
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(original_env)
+
+
 class CliOperations(object):
     def __init__(self, indices=None, enable_build=True):
         self._indices = indices
@@ -11,6 +11,11 @@ def env_default(prefix):
             
             if default is not None:
                 required=False
+                # argparse only checks choices for values given on the
+                # command line, so check the value from the environment
+                # when argparse converts it
+                if kwargs.get("choices") is not None:
+                    kwargs["type"] = _choice_type(kwargs.get("type"), kwargs["choices"], name)
                 
             super(type(self), self).__init__(default=default, required=required, **kwargs)
         
@@ -23,5 +28,20 @@ def env_default(prefix):
             setattr(namespace, self.dest, values)
             
     return EnvDefault
-            
+
+
+def _choice_type(convert, choices, env_name):
+    def convert_choice(value):
+        if convert is not None:
+            value = convert(value)
+        if value not in choices:
+            raise argparse.ArgumentTypeError(
+                "invalid choice: {0!r} (choose from {1}, or change {2})".format(
+                    value,
+                    ", ".join(map(repr, choices)),
+                    env_name,
+                )
+            )
+        return value
     
+    return convert_choice
@@ -0,0 +1,67 @@
+import os
+import stat
+import binascii
+
+from .files import mkdir_p, materialize_file, temporary_sibling_path
+from .hashes import file_digest
+
+
+# Stores file contents keyed by their digest so that identical files in
+# different cache entries are only stored once. Blobs are read-only since
+# they may be hard linked into place.
+class BlobStore(object):
+    def __init__(self, blobs_dir):
+        self._blobs_dir = blobs_dir
+
+    def put(self, source_path):
+        # Counted separately from the hashing of package sources
+        digest = file_digest(source_path, counter="blobs.hash")
+        blob_id = "{0}-{1:o}".format(
+            binascii.hexlify(digest).decode("ascii"),
+            _read_only_mode(os.stat(source_path).st_mode),
+        )
+        path = self.path(blob_id)
+        if os.path.exists(path):
+            return blob_id
+
+        mkdir_p(os.path.dirname(path))
+        staged_path = temporary_sibling_path(path)
+        try:
+            # Never hard link into the store, since the source may be modified
+            materialize_file(source_path, staged_path, "reflink")
+            os.chmod(staged_path, _read_only_mode(os.stat(source_path).st_mode))
+            os.rename(staged_path, path)
+        finally:
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+        return blob_id
+
+    def contains(self, blob_id):
+        return os.path.exists(self.path(blob_id))
+
+    def size(self, blob_id):
+        try:
+            return os.stat(self.path(blob_id)).st_size
+        except OSError:
+            return 0
+
+    def sweep(self, referenced_blob_ids):
+        # Removes blobs that aren't referenced, along with anything left
+        # behind by failed writes
+        freed_bytes = 0
+        if os.path.isdir(self._blobs_dir):
+            for prefix in os.listdir(self._blobs_dir):
+                prefix_dir = os.path.join(self._blobs_dir, prefix)
+                for name in os.listdir(prefix_dir):
+                    if name not in referenced_blob_ids:
+                        path = os.path.join(prefix_dir, name)
+                        freed_bytes += os.stat(path).st_size
+                        os.remove(path)
+        return freed_bytes
+
+    def path(self, blob_id):
+        return os.path.join(self._blobs_dir, blob_id[:2], blob_id)
+
+
+def _read_only_mode(mode):
+    return stat.S_IMODE(mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
@@ -7,6 +7,7 @@ from .files import mkdir_p, write_file
 from .errors import FileNotFoundError
 from .env import params_to_env
 from . import local
+from .tracing import default_tracer
 
 
 class Builder(object):
@@ -14,8 +15,16 @@ class Builder(object):
         self._downloader = downloader
         
     def build(self, package_request, package_dir):
-        with create_temporary_dir() as build_dir:
-            self._build_in_dir(package_request, build_dir, package_dir)
+        with default_tracer.span("build", package=package_request.name()):
+            with create_temporary_dir() as build_dir:
+                self._build_in_dir(package_request, build_dir, package_dir)
+    
+    def prefetch(self, package_request):
+        with default_tracer.span("prefetch_downloads", package=package_request.name()):
+            with create_temporary_dir() as build_dir:
+                package_request.write_source_to(build_dir)
+                build_env = params_to_env(package_request.params())
+                self._fetch_downloads(build_dir, build_env)
 
 
     def _build_in_dir(self, package_request, build_dir, package_dir):
@@ -40,7 +49,8 @@ class Builder(object):
             build_script_path, # build_script is executed
             WHACK_ROOT # WHACK_ROOT is passed as the first argument to build_script
         ]
-        local.run(build_command, cwd=build_dir, update_env=build_env)
+        with default_tracer.span("build_script"):
+            local.run(build_command, cwd=build_dir, update_env=build_env)
         write_file(
             os.path.join(package_dir, ".whack-package.json"),
             dodge.dumps(package_request.describe())
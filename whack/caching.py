@@ -1,20 +1,676 @@
 import os
+import stat
+import json
+from multiprocessing.pool import ThreadPool
 
-from catchy import xdg_directory_cacher, NoCachingStrategy
+from catchy.status import CacheHit, CacheMiss
 
+from .files import mkdir_p, materialize_dir, materialize_file, \
+    delete_dir, scandir, MaterializationResult, count_materialization, \
+    temporary_sibling_path, temporary_suffix, write_json_atomically
+from .blobs import BlobStore
+from .hashes import FileDigestCache
+from .indices import IndexCache, IndexMissCache
+from .mirrors import SourceControlMirrors
+from .locks import ReadWriteFileLock, NoLock, SingleFlightLocks, NoSingleFlightLocks
+from .xdg import xdg_cache_dir
 
-def create_cacher_factory(caching_enabled):
+
+# The caches that can each be given their own budget
+cache_names = ["packages", "downloads", "source-trees"]
+
+
+def create_cacher_factory(caching_enabled, materializations=None, budgets=None):
     if not caching_enabled:
         return NoCacheCachingFactory()
     else:
-        return LocalCachingFactory()
+        return LocalCachingFactory(materializations, budgets=budgets)
 
 
 class NoCacheCachingFactory(object):
     def create(self, name):
         return NoCachingStrategy()
-        
+    
+    def create_file_cacher(self, name):
+        return NoFileCachingStrategy()
+    
+    def create_file_digest_cache(self):
+        return None
+    
+    def create_index_cache(self, ttl):
+        return None
+    
+    def create_index_miss_cache(self, ttl):
+        return None
+    
+    def create_single_flight_locks(self, name):
+        return NoSingleFlightLocks()
+    
+    def create_source_mirrors(self):
+        return None
+
+
+class NoCachingStrategy(object):
+    def fetch(self, cache_id, target):
+        return CacheMiss()
+    
+    def contains(self, cache_id):
+        return False
+    
+    def put(self, cache_id, source):
+        pass
+
 
 class LocalCachingFactory(object):
+    def __init__(self, materializations=None, budgets=None):
+        if materializations is None:
+            materializations = {}
+        if budgets is None:
+            budgets = {}
+        self._materializations = materializations
+        self._budgets = budgets
+    
     def create(self, name):
-        return xdg_directory_cacher(os.path.join("whack", name))
+        materialization = self._materializations.get(name) or "reflink"
+        return ContentAddressedCacher(
+            xdg_cache_dir(name),
+            BlobStore(xdg_cache_dir("{0}-blobs".format(name))),
+            materialization=materialization,
+            budget=self._budgets.get(name),
+            lock=self._lock(),
+        )
+    
+    def create_file_cacher(self, name):
+        return DirectoryFileCacher(
+            xdg_cache_dir(name),
+            materialization=self._materializations.get(name) or "reflink",
+            budget=self._budgets.get(name),
+            lock=self._lock(),
+            single_flight_locks=self.create_single_flight_locks(name),
+        )
+    
+    def create_file_digest_cache(self):
+        return FileDigestCache(xdg_cache_dir("file-digests"))
+    
+    def create_index_cache(self, ttl):
+        return IndexCache(xdg_cache_dir("indices"), ttl=ttl)
+    
+    def create_index_miss_cache(self, ttl):
+        if not ttl:
+            return None
+        return IndexMissCache(
+            xdg_cache_dir("index-misses"),
+            IndexCache(xdg_cache_dir("indices")),
+            ttl=ttl,
+        )
+    
+    def create_single_flight_locks(self, name):
+        return SingleFlightLocks(xdg_cache_dir(os.path.join("locks", name)))
+    
+    def create_source_mirrors(self):
+        return SourceControlMirrors(
+            xdg_cache_dir("mirrors"),
+            self.create("source-trees"),
+            single_flight_locks=self.create_single_flight_locks("mirrors"),
+        )
+    
+    def _lock(self):
+        return ReadWriteFileLock(xdg_cache_dir("cache.lock"))
+
+
+class CacheBudget(object):
+    def __init__(self, max_bytes=None, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+    
+    def is_exceeded(self, entries, total_bytes):
+        return (
+            (self.max_entries is not None and entries > self.max_entries) or
+            (self.max_bytes is not None and total_bytes > self.max_bytes)
+        )
+
+
+class CacheEntry(object):
+    # blob_sizes maps each piece of storage used by the entry to its size.
+    # Entries that share storage share the same keys.
+    def __init__(self, cache_id, last_accessed, pinned, blob_sizes):
+        self.cache_id = cache_id
+        self.last_accessed = last_accessed
+        self.pinned = pinned
+        self.blob_sizes = blob_sizes
+
+
+class CacheStats(object):
+    def __init__(self, entries, pinned_entries, total_bytes):
+        self.entries = entries
+        self.pinned_entries = pinned_entries
+        self.total_bytes = total_bytes
+
+
+class GarbageCollection(object):
+    def __init__(self, evicted, freed_bytes):
+        self.evicted = evicted
+        self.freed_bytes = freed_bytes
+
+
+def cache_stats(entries):
+    return CacheStats(
+        entries=len(entries),
+        pinned_entries=len([entry for entry in entries if entry.pinned]),
+        total_bytes=sum(_unique_blob_sizes(entries).values()),
+    )
+
+
+def _select_evictions(entries, budget):
+    # Evict unpinned entries, least recently used first, until the cache is
+    # within budget. Storage shared between entries is only freed once
+    # every entry using it has been evicted.
+    blob_sizes = _unique_blob_sizes(entries)
+    references = {}
+    for entry in entries:
+        for blob_id in entry.blob_sizes:
+            references[blob_id] = references.get(blob_id, 0) + 1
+    
+    remaining_entries = len(entries)
+    total_bytes = sum(blob_sizes.values())
+    evictions = []
+    unpinned_entries = [entry for entry in entries if not entry.pinned]
+    for entry in sorted(unpinned_entries, key=lambda entry: entry.last_accessed):
+        if not budget.is_exceeded(remaining_entries, total_bytes):
+            break
+        evictions.append(entry)
+        remaining_entries -= 1
+        for blob_id in entry.blob_sizes:
+            references[blob_id] -= 1
+            if references[blob_id] == 0:
+                total_bytes -= blob_sizes[blob_id]
+    
+    return evictions
+
+
+def _unique_blob_sizes(entries):
+    blob_sizes = {}
+    for entry in entries:
+        blob_sizes.update(entry.blob_sizes)
+    return blob_sizes
+
+
+# Cachers that can be inspected and garbage collected. Entries are read and
+# written while holding the lock shared, so that entries are only removed
+# while no other process is using the cache.
+class _EvictingCacher(object):
+    def entries(self):
+        with self._lock.shared():
+            return self._entries()
+    
+    def stats(self):
+        return cache_stats(self.entries())
+    
+    def pin(self, cache_id, pinned=True):
+        pin_path = _pin_marker(self._path(cache_id))
+        if pinned:
+            mkdir_p(self._cacher_dir)
+            open(pin_path, "w").close()
+        else:
+            _remove_if_exists(pin_path)
+    
+    def collect_garbage(self, budget=None, blocking=True):
+        if budget is None:
+            budget = self._budget
+        
+        with self._lock.exclusive(blocking=blocking) as acquired:
+            if not acquired:
+                return None
+            
+            evictions = []
+            if budget is not None:
+                evictions = _select_evictions(self._entries(), budget)
+            freed_bytes = 0
+            for entry in evictions:
+                freed_bytes += self._evict(entry)
+            freed_bytes += self._sweep()
+            return GarbageCollection(
+                evicted=[entry.cache_id for entry in evictions],
+                freed_bytes=freed_bytes,
+            )
+    
+    def _collect_garbage_if_over_budget(self):
+        # Another process is using the cache, so leave collecting garbage
+        # until later rather than waiting
+        if self._budget is not None:
+            self.collect_garbage(blocking=False)
+    
+    def _entry(self, cache_id, marker_path, blob_sizes):
+        return CacheEntry(
+            cache_id=cache_id,
+            last_accessed=os.stat(marker_path).st_mtime,
+            pinned=os.path.exists(_pin_marker(self._path(cache_id))),
+            blob_sizes=blob_sizes,
+        )
+    
+    def _sweep(self):
+        return _remove_temporary_paths(self._cacher_dir)
+    
+    def _path(self, cache_id):
+        return os.path.join(self._cacher_dir, cache_id)
+
+
+# Uses the same layout as catchy.DirectoryCacher, so existing caches are
+# still used. Cached directories are materialized using the given mode,
+# which falls back to copying files if the mode isn't supported.
+class DirectoryCacher(_EvictingCacher):
+    def __init__(self, cacher_dir, materialization="reflink", budget=None, lock=None):
+        if lock is None:
+            lock = NoLock()
+        self._cacher_dir = cacher_dir
+        self._materialization = materialization
+        self._budget = budget
+        self._lock = lock
+        self.materialization_counts = {}
+    
+    def fetch(self, cache_id, target):
+        with self._lock.shared():
+            return self._fetch(cache_id, target)
+    
+    def _fetch(self, cache_id, target):
+        path = self._path(cache_id)
+        if os.path.exists(_cache_indicator(path)):
+            result = materialize_dir(path, target, self._materialization)
+            for method, count in result.methods.items():
+                self.materialization_counts[method] = \
+                    self.materialization_counts.get(method, 0) + count
+            _touch(_cache_indicator(path))
+            return CacheHit()
+        else:
+            return CacheMiss()
+    
+    def contains(self, cache_id):
+        return os.path.exists(_cache_indicator(self._path(cache_id)))
+    
+    def put(self, cache_id, source):
+        with self._lock.shared():
+            self._put(cache_id, source)
+        self._collect_garbage_if_over_budget()
+    
+    def _put(self, cache_id, source):
+        path = self._path(cache_id)
+        if os.path.exists(_cache_indicator(path)):
+            return
+        
+        mkdir_p(self._cacher_dir)
+        staged_path = temporary_sibling_path(path)
+        try:
+            # Never hard link into the cache, since the source may be modified
+            materialize_dir(source, staged_path, "reflink")
+            try:
+                os.rename(staged_path, path)
+            except OSError:
+                if os.path.exists(_cache_indicator(path)):
+                    # Somebody else has already written to the cache
+                    return
+                else:
+                    # Left behind by a failed write
+                    delete_dir(path)
+                    os.rename(staged_path, path)
+            open(_cache_indicator(path), "w").close()
+        finally:
+            delete_dir(staged_path)
+    
+    def _entries(self):
+        return [
+            self._entry(cache_id, _cache_indicator(self._path(cache_id)), {
+                cache_id: _dir_size(self._path(cache_id)),
+            })
+            for cache_id in _cache_ids(self._cacher_dir, _cache_indicator_suffix)
+        ]
+    
+    def _evict(self, entry):
+        path = self._path(entry.cache_id)
+        os.remove(_cache_indicator(path))
+        delete_dir(path)
+        return entry.blob_sizes[entry.cache_id]
+
+
+# Stores each directory as a manifest of its files, with the contents of
+# the files kept in a blob store. Directories that share files, such as
+# variants of the same package, only store those files once. Entries
+# written by DirectoryCacher can still be fetched.
+class ContentAddressedCacher(_EvictingCacher):
+    def __init__(self, cacher_dir, blob_store, materialization="reflink", workers=8,
+            budget=None, lock=None):
+        if lock is None:
+            lock = NoLock()
+        self._cacher_dir = cacher_dir
+        self._blob_store = blob_store
+        self._materialization = materialization
+        self._workers = workers
+        self._budget = budget
+        self._lock = lock
+        self._directory_cacher = DirectoryCacher(cacher_dir, materialization=materialization)
+        self.materialization_counts = self._directory_cacher.materialization_counts
+    
+    def fetch(self, cache_id, target):
+        with self._lock.shared():
+            return self._fetch(cache_id, target)
+    
+    def _fetch(self, cache_id, target):
+        manifest_path = self._manifest_path(cache_id)
+        manifest = _read_manifest(manifest_path)
+        if manifest is None:
+            return self._directory_cacher._fetch(cache_id, target)
+        
+        entries = manifest["entries"]
+        # Blobs may have been removed from the store, in which case the
+        # entry can't be used
+        if not all(map(self._blob_store.contains, _manifest_blob_ids(manifest))):
+            return CacheMiss()
+        
+        self._materialize(entries, target)
+        _touch(manifest_path)
+        return CacheHit()
+    
+    def contains(self, cache_id):
+        with self._lock.shared():
+            manifest = _read_manifest(self._manifest_path(cache_id))
+            if manifest is None:
+                return self._directory_cacher.contains(cache_id)
+            else:
+                return all(map(self._blob_store.contains, _manifest_blob_ids(manifest)))
+    
+    def put(self, cache_id, source):
+        with self._lock.shared():
+            self._put(cache_id, source)
+        self._collect_garbage_if_over_budget()
+    
+    def _put(self, cache_id, source):
+        manifest_path = self._manifest_path(cache_id)
+        if os.path.exists(manifest_path) or os.path.exists(_cache_indicator(self._path(cache_id))):
+            return
+        
+        pool = ThreadPool(self._workers)
+        try:
+            entries = []
+            _read_manifest_entries(source, "", entries, pool, self._blob_store)
+        finally:
+            pool.close()
+            pool.join()
+        
+        for entry in entries:
+            if entry["type"] == "file":
+                entry["blob"] = entry["blob"].get()
+        
+        write_json_atomically(manifest_path, {"entries": entries})
+    
+    def _materialize(self, entries, target):
+        mkdir_p(target)
+        pool = ThreadPool(self._workers)
+        try:
+            file_results = []
+            for entry in entries:
+                path = os.path.join(target, entry["path"])
+                if entry["type"] == "dir":
+                    mkdir_p(path)
+                elif entry["type"] == "symlink":
+                    if os.path.lexists(path):
+                        os.remove(path)
+                    os.symlink(entry["target"], path)
+                else:
+                    file_result = pool.apply_async(
+                        materialize_file,
+                        (self._blob_store.path(entry["blob"]), path, self._materialization),
+                    )
+                    file_results.append((entry, path, file_result))
+        finally:
+            pool.close()
+            pool.join()
+        
+        result = MaterializationResult()
+        for entry, path, file_result in file_results:
+            method = file_result.get()
+            # Hard links have to keep the read-only mode of the blob
+            if method != "hardlink":
+                os.chmod(path, entry["mode"])
+            result.add_file(method, self._blob_store.size(entry["blob"]))
+            self.materialization_counts[method] = \
+                self.materialization_counts.get(method, 0) + 1
+        count_materialization(result)
+        
+        # Set permissions last in case the directories are read-only
+        for entry in reversed(entries):
+            if entry["type"] == "dir":
+                os.chmod(os.path.join(target, entry["path"]), entry["mode"])
+    
+    def _entries(self):
+        entries = []
+        for cache_id in _cache_ids(self._cacher_dir, _manifest_suffix):
+            manifest_path = self._manifest_path(cache_id)
+            manifest = _read_manifest(manifest_path)
+            if manifest is not None:
+                blob_sizes = dict(
+                    (blob_id, self._blob_store.size(blob_id))
+                    for blob_id in _manifest_blob_ids(manifest)
+                )
+                entries.append(self._entry(cache_id, manifest_path, blob_sizes))
+        
+        return entries + self._directory_cacher._entries()
+    
+    def _evict(self, entry):
+        manifest_path = self._manifest_path(entry.cache_id)
+        if os.path.exists(manifest_path):
+            # Blobs are removed once they're no longer referenced
+            os.remove(manifest_path)
+            return 0
+        else:
+            return self._directory_cacher._evict(entry)
+    
+    def _sweep(self):
+        referenced_blob_ids = set()
+        for cache_id in _cache_ids(self._cacher_dir, _manifest_suffix):
+            manifest = _read_manifest(self._manifest_path(cache_id))
+            if manifest is not None:
+                referenced_blob_ids.update(_manifest_blob_ids(manifest))
+        
+        return _EvictingCacher._sweep(self) + self._blob_store.sweep(referenced_blob_ids)
+    
+    def _manifest_path(self, cache_id):
+        return "{0}{1}".format(self._path(cache_id), _manifest_suffix)
+
+
+def _read_manifest_entries(dir_path, relative_dir_path, entries, pool, blob_store):
+    # Parent directories always come before their contents
+    for entry in sorted(scandir(dir_path), key=lambda entry: entry.name):
+        relative_path = os.path.join(relative_dir_path, entry.name)
+        if entry.is_symlink():
+            entries.append({
+                "path": relative_path,
+                "type": "symlink",
+                "target": os.readlink(entry.path),
+            })
+        elif entry.is_dir():
+            entries.append({
+                "path": relative_path,
+                "type": "dir",
+                "mode": stat.S_IMODE(entry.stat().st_mode),
+            })
+            _read_manifest_entries(entry.path, relative_path, entries, pool, blob_store)
+        elif entry.is_file():
+            entries.append({
+                "path": relative_path,
+                "type": "file",
+                "mode": stat.S_IMODE(entry.stat().st_mode),
+                "blob": pool.apply_async(blob_store.put, (entry.path, )),
+            })
+
+
+def _read_manifest(path):
+    try:
+        with open(path) as manifest_file:
+            return json.load(manifest_file)
+    except (IOError, ValueError):
+        return None
+
+
+def _manifest_blob_ids(manifest):
+    return [
+        entry["blob"]
+        for entry in manifest["entries"]
+        if entry["type"] == "file"
+    ]
+
+
+_manifest_suffix = ".manifest"
+
+
+class NoFileCachingStrategy(object):
+    def fetch(self, cache_id, destination):
+        return CacheMiss()
+    
+    def fetch_or_create(self, cache_id, destination, create):
+        temp_path = temporary_sibling_path(destination)
+        try:
+            create(temp_path)
+            os.rename(temp_path, destination)
+        finally:
+            _remove_if_exists(temp_path)
+
+
+# Uses the same layout as catchy.DirectoryCacher, so existing caches are
+# still used, but files are written into the cache once and then cloned
+# into place rather than copied where possible. Hard linking has to be
+# chosen explicitly, since the linked files can't be modified.
+class DirectoryFileCacher(_EvictingCacher):
+    def __init__(self, cacher_dir, materialization="reflink", budget=None, lock=None,
+            single_flight_locks=None):
+        if lock is None:
+            lock = NoLock()
+        if single_flight_locks is None:
+            single_flight_locks = NoSingleFlightLocks()
+        self._cacher_dir = cacher_dir
+        self._materialization = materialization
+        self._budget = budget
+        self._lock = lock
+        self._single_flight_locks = single_flight_locks
+    
+    def fetch(self, cache_id, destination):
+        with self._lock.shared():
+            return self._fetch(cache_id, destination)
+    
+    def _fetch(self, cache_id, destination):
+        path = self._path(cache_id)
+        if os.path.exists(_cache_indicator(path)):
+            self._materialize(path, destination)
+            _touch(_cache_indicator(path))
+            return CacheHit()
+        else:
+            return CacheMiss()
+    
+    def _materialize(self, path, destination):
+        method = materialize_file(path, destination, self._materialization)
+        if method != "hardlink":
+            # Cached files are read-only, but copies belong to the caller
+            os.chmod(destination, stat.S_IMODE(os.stat(destination).st_mode) | stat.S_IWUSR)
+    
+    def fetch_or_create(self, cache_id, destination, create):
+        if self.fetch(cache_id, destination).cache_hit:
+            return
+        
+        # Wait for any other process creating the same entry, and then
+        # use its result rather than creating the entry again
+        with self._single_flight_locks.hold(cache_id):
+            with self._lock.shared():
+                created = self._fetch_or_create(cache_id, destination, create)
+        if created:
+            self._collect_garbage_if_over_budget()
+    
+    def _fetch_or_create(self, cache_id, destination, create):
+        if self._fetch(cache_id, destination).cache_hit:
+            return False
+        
+        path = self._path(cache_id)
+        mkdir_p(self._cacher_dir)
+        staged_path = temporary_sibling_path(path)
+        try:
+            create(staged_path)
+            # Files may be hard linked into place, so make sure that
+            # modifying them doesn't silently modify the cache
+            os.chmod(staged_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(staged_path, path)
+            open(_cache_indicator(path), "w").close()
+        finally:
+            _remove_if_exists(staged_path)
+        self._materialize(path, destination)
+        return True
+    
+    def _entries(self):
+        return [
+            self._entry(cache_id, _cache_indicator(self._path(cache_id)), {
+                cache_id: os.stat(self._path(cache_id)).st_size,
+            })
+            for cache_id in _cache_ids(self._cacher_dir, _cache_indicator_suffix)
+        ]
+    
+    def _evict(self, entry):
+        path = self._path(entry.cache_id)
+        os.remove(_cache_indicator(path))
+        os.remove(path)
+        return entry.blob_sizes[entry.cache_id]
+
+
+def _cache_indicator(path):
+    return "{0}{1}".format(path, _cache_indicator_suffix)
+
+
+_cache_indicator_suffix = ".cached"
+
+
+def _pin_marker(path):
+    return "{0}.pinned".format(path)
+
+
+def _cache_ids(cacher_dir, suffix):
+    if not os.path.isdir(cacher_dir):
+        return []
+    return sorted(
+        name[:-len(suffix)]
+        for name in os.listdir(cacher_dir)
+        if name.endswith(suffix)
+    )
+
+
+def _touch(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        # Access times are only used to choose what to evict, so carry on
+        # without updating them
+        pass
+
+
+def _dir_size(path):
+    size = 0
+    for dir_path, dir_names, file_names in os.walk(path):
+        for file_name in file_names:
+            size += os.lstat(os.path.join(dir_path, file_name)).st_size
+    return size
+
+
+def _remove_temporary_paths(dir_path):
+    # Only called while the cache is locked exclusively, so any temporary
+    # paths have been left behind by processes that failed part way through
+    freed_bytes = 0
+    if os.path.isdir(dir_path):
+        for name in os.listdir(dir_path):
+            if name.endswith(temporary_suffix):
+                path = os.path.join(dir_path, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    freed_bytes += _dir_size(path)
+                    delete_dir(path)
+                else:
+                    freed_bytes += os.lstat(path).st_size
+                    os.remove(path)
+    return freed_bytes
+
+
+def _remove_if_exists(path):
+    if os.path.exists(path):
+        os.remove(path)
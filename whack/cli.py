@@ -4,33 +4,80 @@ import argparse
 import sys
 
 import whack.args
+import whack.stats
+from whack.tracing import default_tracer
 from whack.errors import WhackUserError
+from whack.files import materialization_modes
+from whack.caching import cache_names
+from whack.manifests import read_install_manifest
+from whack.tarballs import compressions
+from whack.xdg import xdg_cache_dir
 
 env_default = whack.args.env_default(prefix="WHACK")
 
 
 def main(argv, create_operations):
     args = parse_args(argv)
+    if args.trace is not None:
+        default_tracer.enable()
     operations = create_operations(
         caching_enabled=args.caching_enabled,
         indices=args.indices,
         enable_build=args.enable_build,
+        index_cache_ttl=args.index_cache_ttl,
+        package_materialization=args.package_materialization,
+        download_materialization=args.download_materialization,
+        cache_max_bytes=args.cache_max_size,
+        cache_max_entries=args.cache_max_entries,
+        index_timeout=args.index_timeout,
+        index_miss_cache_ttl=args.index_miss_cache_ttl,
+        cache_limits=_cache_limits(args),
     )
     try:
         exit(args.func(operations, args))
     except WhackUserError as error:
         sys.stderr.write("{0}: {1}\n".format(type(error).__name__, error.message))
         exit(1)
+    finally:
+        _write_stats(args)
+        if args.trace is not None:
+            default_tracer.write(args.trace)
+
+
+def _cache_limits(args):
+    return dict(
+        (name, {
+            "max_bytes": getattr(args, "{0}_cache_max_size".format(_dest_name(name))),
+            "max_entries": getattr(args, "{0}_cache_max_entries".format(_dest_name(name))),
+        })
+        for name in cache_names
+    )
+
+
+def _dest_name(name):
+    return name.replace("-", "_")
+
+
+def _write_stats(args):
+    stats = whack.stats.collect_stats()
+    if args.stats_json is not None:
+        whack.stats.write_stats_json(args.stats_json, stats)
+    if args.caching_enabled:
+        whack.stats.add_to_cumulative_stats(xdg_cache_dir("stats.json"), stats)
 
 
 def parse_args(argv):
     commands = [
         InstallCommand("install"),
         InstallCommand("get-package"),
+        InstallManyCommand(),
+        PrefetchCommand(),
         DeployCommand(),
         CreateSourceTarballCommand(),
         GetPackageTarballCommand(),
+        BuildMatrixCommand(),
         TestCommand(),
+        CacheCommand(),
     ]
     
     parser = argparse.ArgumentParser()
@@ -38,7 +85,10 @@ def parse_args(argv):
     
     for command in commands:
         subparser = subparsers.add_parser(command.name)
-        _add_common_args(subparser)
+        # Commands with subcommands add the common arguments to each
+        # subcommand instead
+        if not getattr(command, "has_subcommands", False):
+            _add_common_args(subparser)
         subparser.set_defaults(func=command.execute)
         command.create_parser(subparser)
 
@@ -86,6 +136,29 @@ class InstallCommand(object):
         operation(args.package_source, args.target_dir, params=args.params)
 
 
+class InstallManyCommand(object):
+    name = "install-many"
+    
+    def create_parser(self, subparser):
+        subparser.add_argument("manifest")
+        subparser.add_argument("--workers", type=int, default=4)
+    
+    def execute(self, operations, args):
+        installs = read_install_manifest(args.manifest)
+        operations.install_many(installs, workers=args.workers)
+
+
+class PrefetchCommand(object):
+    name = "prefetch"
+    
+    def create_parser(self, subparser):
+        subparser.add_argument('package_source', metavar="package-source")
+        _add_build_params_args(subparser)
+    
+    def execute(self, operations, args):
+        operations.prefetch(args.package_source, params=args.params)
+
+
 class DeployCommand(object):
     name = "deploy"
     
@@ -106,11 +179,13 @@ class CreateSourceTarballCommand(object):
     def create_parser(self, subparser):
         subparser.add_argument('package_source', metavar="package-source")
         subparser.add_argument("source_tarball_dir", metavar="source-tarball-dir")
+        _add_compression_args(subparser)
         
     def execute(self, operations, args):
         source_tarball = operations.create_source_tarball(
             args.package_source,
-            args.source_tarball_dir
+            args.source_tarball_dir,
+            compression=args.compression,
         )
         print(source_tarball.full_name)
         print(source_tarball.path)
@@ -123,16 +198,60 @@ class GetPackageTarballCommand(object):
         subparser.add_argument("package")
         subparser.add_argument("package_tarball_dir", metavar="package-tarball-dir")
         _add_build_params_args(subparser)
+        _add_compression_args(subparser)
         
     def execute(self, operations, args):
         package_tarball = operations.get_package_tarball(
             args.package,
             args.package_tarball_dir,
             params=args.params,
+            compression=args.compression,
         )
         print(package_tarball.path)
 
 
+class ParamGridAction(argparse.Action):
+    def __call__(self, parser, namespace, values, option_string=None):
+        if getattr(namespace, self.dest, None) is None:
+            setattr(namespace, self.dest, {})
+        
+        grid = getattr(namespace, self.dest)
+        key, _, grid_values = values.partition("=")
+        grid[key] = grid_values.split(",")
+
+
+class BuildMatrixCommand(object):
+    name = "build-matrix"
+    
+    def create_parser(self, subparser):
+        subparser.add_argument('package_source', metavar="package-source")
+        subparser.add_argument("package_tarball_dir", metavar="package-tarball-dir")
+        subparser.add_argument(
+            "--param-grid",
+            action=ParamGridAction,
+            dest="param_grid",
+            default={},
+            metavar="KEY=VALUE[,VALUE...]",
+        )
+        _add_build_params_args(subparser)
+        subparser.add_argument("--workers", type=int)
+        subparser.add_argument("--memory-per-build", type=_byte_size, metavar="SIZE")
+        _add_compression_args(subparser)
+    
+    def execute(self, operations, args):
+        package_tarballs = operations.build_matrix(
+            args.package_source,
+            args.package_tarball_dir,
+            args.param_grid,
+            params=args.params,
+            workers=args.workers,
+            memory_per_build=args.memory_per_build,
+            compression=args.compression,
+        )
+        for package_tarball in package_tarballs:
+            print(package_tarball.path)
+
+
 class TestCommand(object):
     name = "test"
     
@@ -148,14 +267,108 @@ class TestCommand(object):
             return 1
 
 
+class CacheCommand(object):
+    name = "cache"
+    has_subcommands = True
+    
+    def create_parser(self, subparser):
+        cache_subparsers = subparser.add_subparsers(dest="cache_command")
+        cache_subparsers.required = True
+        
+        _add_common_args(cache_subparsers.add_parser("stats"))
+        _add_common_args(cache_subparsers.add_parser("gc"))
+        
+        pin_parser = cache_subparsers.add_parser("pin")
+        _add_common_args(pin_parser)
+        pin_parser.add_argument('package_source', metavar="package-source")
+        pin_parser.add_argument("--unpin", action="store_false", dest="pinned")
+        _add_build_params_args(pin_parser)
+    
+    def execute(self, operations, args):
+        if args.cache_command == "stats":
+            for name, stats in sorted(operations.cache_stats().items()):
+                print("{0}: {1} entries, {2} pinned, {3} bytes".format(
+                    name, stats.entries, stats.pinned_entries, stats.total_bytes
+                ))
+        elif args.cache_command == "gc":
+            for name, collection in sorted(operations.collect_cache_garbage().items()):
+                print("{0}: evicted {1} entries, freed {2} bytes".format(
+                    name, len(collection.evicted), collection.freed_bytes
+                ))
+        elif args.cache_command == "pin":
+            print(operations.pin_package(
+                args.package_source,
+                params=args.params,
+                pinned=args.pinned,
+            ))
+        else:
+            raise Exception("Unrecognised cache command")
+
+
 def _add_common_args(parser):
     _add_caching_args(parser)
     _add_index_args(parser)
     _add_build_args(parser)
+    _add_stats_args(parser)
 
 
 def _add_caching_args(parser):
     parser.add_argument("--disable-cache", action="store_false", dest="caching_enabled")
+    parser.add_argument(
+        "--index-cache-ttl",
+        action=env_default,
+        type=int,
+        metavar="SECONDS",
+    )
+    parser.add_argument(
+        "--index-miss-cache-ttl",
+        action=env_default,
+        type=int,
+        metavar="SECONDS",
+    )
+    parser.add_argument(
+        "--package-materialization",
+        action=env_default,
+        choices=materialization_modes,
+    )
+    parser.add_argument(
+        "--download-materialization",
+        action=env_default,
+        choices=materialization_modes,
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        action=env_default,
+        type=_byte_size,
+        metavar="SIZE",
+    )
+    parser.add_argument(
+        "--cache-max-entries",
+        action=env_default,
+        type=int,
+        metavar="ENTRIES",
+    )
+    for name in cache_names:
+        parser.add_argument(
+            "--{0}-cache-max-size".format(name),
+            action=env_default,
+            type=_byte_size,
+            metavar="SIZE",
+        )
+        parser.add_argument(
+            "--{0}-cache-max-entries".format(name),
+            action=env_default,
+            type=int,
+            metavar="ENTRIES",
+        )
+
+
+def _byte_size(value):
+    units = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    number, unit = value.rstrip("KMGTkmgt"), value[len(value.rstrip("KMGTkmgt")):].upper()
+    if not number.isdigit() or unit not in units:
+        raise argparse.ArgumentTypeError("invalid size: {0}".format(value))
+    return int(number) * units[unit]
 
 
 def _add_index_args(parser):
@@ -166,12 +379,23 @@ def _add_index_args(parser):
         dest="indices",
         metavar="INDEX",
     )
+    parser.add_argument(
+        "--index-timeout",
+        action=env_default,
+        type=float,
+        metavar="SECONDS",
+    )
 
 
 def _add_build_args(parser):
     parser.add_argument("--disable-build", action="store_false", dest="enable_build")
 
 
+def _add_stats_args(parser):
+    parser.add_argument("--stats-json", action=env_default, metavar="PATH")
+    parser.add_argument("--trace", action=env_default, metavar="PATH")
+
+
 def _add_build_params_args(parser):
     parser.add_argument(
         "--add-parameter", "-p",
@@ -179,3 +403,12 @@ def _add_build_params_args(parser):
         dest="params",
         metavar="KEY=VALUE",
     )
+
+
+def _add_compression_args(parser):
+    parser.add_argument(
+        "--compression",
+        action=env_default,
+        metavar="CODEC[:LEVEL]",
+        help="one of: {0}".format(", ".join(compressions)),
+    )
@@ -3,11 +3,19 @@ import stat
 
 from .common import WHACK_ROOT
 from .files import copy_dir
+from .stats import default_counters
+from .tracing import default_tracer
 from . import local
 
 
 class PackageDeployer(object):
     def deploy(self, package_dir, target_dir=None):
+        default_counters.increment("deploy.count")
+        with default_tracer.span("deploy", package_dir=package_dir), \
+                default_counters.time("deploy"):
+            self._deploy(package_dir, target_dir)
+    
+    def _deploy(self, package_dir, target_dir):
         if target_dir is None:
             install_dir = package_dir
         else:
@@ -51,6 +59,7 @@ def _create_directly_executable_dir(install_dir, bin_dir_name):
                     'exec "$MY_ROOT/run" "$TARGET" "$@"\n'
                 )
             os.chmod(bin_file_path, 0o755)
+            default_counters.increment("deploy.wrappers")
 
 def _list_missing_executable_files(root_dir, dot_bin_dir, bin_dir):
     def is_missing(filename):
@@ -1,10 +1,14 @@
 import os.path
 import hashlib
 import re
+import threading
+from multiprocessing.pool import ThreadPool
 from six.moves.urllib.parse import urlparse
 
-from .tempdir import create_temporary_dir
-from .files import mkdir_p, copy_file
+from .files import mkdir_p
+from .stats import default_counters
+from .tracing import default_tracer
+from . import httpclient
 from . import local
 
 
@@ -13,39 +17,74 @@ class DownloadError(Exception):
 
 
 class Downloader(object):
-    def __init__(self, cacher):
+    def __init__(self, cacher, max_workers=4, max_workers_per_host=2, http_client=None):
+        if http_client is None:
+            http_client = httpclient.default_client
         self._cacher = cacher
+        self._http_client = http_client
+        self._max_workers = max_workers
+        self._max_workers_per_host = max_workers_per_host
+        self._host_semaphores = {}
+        self._host_semaphores_lock = threading.Lock()
     
     def fetch_downloads(self, downloads_file_path, build_env, target_dir):
-        downloads_file = _read_downloads_file(downloads_file_path, build_env)
-        for download_line in downloads_file:
-            self.download(
-                download_line.url,
-                os.path.join(target_dir, download_line.filename)
-            )
+        with default_tracer.span("downloads_script"):
+            downloads_file = _read_downloads_file(downloads_file_path, build_env)
+        if not downloads_file:
+            return
+        
+        pool = ThreadPool(min(self._max_workers, len(downloads_file)))
+        try:
+            results = [
+                pool.apply_async(self._download_with_host_limit, (
+                    download_line.url,
+                    os.path.join(target_dir, download_line.filename),
+                ))
+                for download_line in downloads_file
+            ]
+        finally:
+            pool.close()
+            pool.join()
+        
+        # Raise the error for the first failed download in the file,
+        # regardless of which finished first
+        for result in results:
+            result.get()
+    
+    def _download_with_host_limit(self, url, destination):
+        with self._host_semaphore(urlparse(url).netloc):
+            self.download(url, destination)
+    
+    def _host_semaphore(self, host):
+        with self._host_semaphores_lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(
+                    self._max_workers_per_host
+                )
+            return self._host_semaphores[host]
 
     def download(self, url, destination):
         url_hash = hashlib.sha1(url.encode("utf8")).hexdigest()
         mkdir_p(os.path.dirname(destination))
-        cache_result = self._cacher.fetch(url_hash, destination)
-        if cache_result.cache_hit:
-            return
-        else:
-            # TODO: writing directly to the cache would be quicker
-            # Don't write directly to the destination to avoid any possible
-            # modification
-            with create_temporary_dir() as temp_dir:
-                temp_file_path = os.path.join(temp_dir, url_hash)
-                try:
-                    local.run(["curl", url, "--output", temp_file_path, "--location", "--fail"])
-                except local.RunProcessError as error:
-                    if error.return_code == 22: # 404
-                        raise DownloadError("File not found: {0}".format(url))
-                    else:
-                        raise
-                    
-                copy_file(temp_file_path, destination)
-                self._cacher.put(url_hash, temp_file_path)
+        
+        missed_cache = []
+        
+        def fetch_url(path):
+            missed_cache.append(True)
+            default_counters.increment("downloads.cache_misses")
+            try:
+                self._http_client.download(url, path)
+            except httpclient.HttpError as error:
+                if error.status_code == 404:
+                    raise DownloadError("File not found: {0}".format(url))
+                else:
+                    raise DownloadError(str(error))
+            default_counters.increment("downloads.bytes", os.path.getsize(path))
+        
+        with default_tracer.span("download", url=url):
+            self._cacher.fetch_or_create(url_hash, destination, fetch_url)
+        if not missed_cache:
+            default_counters.increment("downloads.cache_hits")
         
 
 class Download(object):
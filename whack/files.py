@@ -1,8 +1,16 @@
 import os
 import errno
+import json
 import shutil
+import uuid
+from multiprocessing.pool import ThreadPool
 
-from . import local
+from .stats import default_counters
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 def read_file(path):
@@ -15,13 +23,204 @@ def write_file(path, contents):
         f.write(contents)
 
 
-copy_file = shutil.copyfile
+def copy_file(source, destination):
+    if hasattr(os, "copy_file_range"):
+        try:
+            _copy_file_range(source, destination)
+            return
+        except OSError as error:
+            if error.errno not in _copy_file_range_unsupported_errnos:
+                raise
+    shutil.copyfile(source, destination)
+
+
+def _copy_file_range(source, destination):
+    with open(source, "rb") as source_file:
+        with open(destination, "wb") as destination_file:
+            while os.copy_file_range(source_file.fileno(), destination_file.fileno(), _copy_chunk_size):
+                pass
+
+
+_copy_file_range_unsupported_errnos = set([
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+])
+
+_copy_chunk_size = 64 * 1024 * 1024
+
+
+# From linux/fs.h
+_FICLONE = 0x40049409
+
+
+def clone_file(source, destination):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Cloning files is not supported")
+    
+    with open(source, "rb") as source_file:
+        with open(destination, "wb") as destination_file:
+            try:
+                fcntl.ioctl(destination_file.fileno(), _FICLONE, source_file.fileno())
+            except:
+                os.remove(destination)
+                raise
 
 
 def copy_dir(source, destination):
-    # TODO: should be pure Python, but there isn't a stdlib function
-    # that allows the destination to already exist
-    local.run(["cp", "-rT", source, destination])
+    return materialize_dir(source, destination, "copy")
+
+
+# Methods of materializing a file, in order of preference, for each mode
+_materialization_methods = {
+    "copy": ["copy"],
+    "reflink": ["reflink", "copy"],
+    "hardlink": ["hardlink", "reflink", "copy"],
+}
+
+
+materialization_modes = sorted(_materialization_methods)
+
+
+def materialize_dir(source, destination, mode, workers=8):
+    # Directories and symlinks are created while walking the source, and
+    # files are materialized on a thread pool in the meantime
+    methods = _materialization_methods[mode]
+    result = MaterializationResult()
+    created_dirs = []
+    file_results = []
+    
+    pool = ThreadPool(workers)
+    try:
+        pending_dirs = [(source, destination)]
+        while pending_dirs:
+            source_dir, destination_dir = pending_dirs.pop()
+            if not os.path.isdir(destination_dir):
+                os.mkdir(destination_dir)
+                created_dirs.append((source_dir, destination_dir))
+            
+            for entry in scandir(source_dir):
+                destination_path = os.path.join(destination_dir, entry.name)
+                if entry.is_symlink():
+                    _copy_symlink(entry.path, destination_path)
+                elif entry.is_dir():
+                    pending_dirs.append((entry.path, destination_path))
+                elif entry.is_file():
+                    file_result = pool.apply_async(
+                        _materialize_file,
+                        (entry.path, destination_path, methods),
+                    )
+                    file_results.append((entry.stat().st_size, file_result))
+    finally:
+        pool.close()
+        pool.join()
+    
+    for size, file_result in file_results:
+        result.add_file(file_result.get(), size)
+    
+    # Set permissions last in case the source directories are read-only
+    for source_dir, destination_dir in reversed(created_dirs):
+        shutil.copymode(source_dir, destination_dir)
+    
+    count_materialization(result)
+    return result
+
+
+def count_materialization(result):
+    default_counters.increment("materialize.files", result.files)
+    default_counters.increment("materialize.bytes", result.bytes)
+    for method, count in result.methods.items():
+        default_counters.increment("materialize.{0}".format(method), count)
+
+
+class MaterializationResult(object):
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.methods = {}
+    
+    def add_file(self, method, size):
+        self.files += 1
+        self.bytes += size
+        self.methods[method] = self.methods.get(method, 0) + 1
+
+
+def materialize_file(source, destination, mode):
+    return _materialize_file(source, destination, _materialization_methods[mode])
+
+
+def _materialize_file(source, destination, methods):
+    # Always write to a temporary path and rename so that an existing
+    # destination that's linked to another file is replaced rather than
+    # overwritten
+    temp_path = "{0}.{1}.tmp".format(destination, uuid.uuid4())
+    for method in methods:
+        try:
+            _file_materializers[method](source, temp_path)
+        except (IOError, OSError):
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+            if method == methods[-1]:
+                raise
+        else:
+            os.rename(temp_path, destination)
+            return method
+
+
+def _copy_file_with_mode(source, destination):
+    copy_file(source, destination)
+    shutil.copymode(source, destination)
+
+
+def _clone_file_with_mode(source, destination):
+    clone_file(source, destination)
+    shutil.copymode(source, destination)
+
+
+_file_materializers = {
+    "copy": _copy_file_with_mode,
+    "reflink": _clone_file_with_mode,
+    "hardlink": os.link,
+}
+
+
+def _copy_symlink(source, destination):
+    if os.path.islink(destination) or os.path.isfile(destination):
+        os.remove(destination)
+    os.symlink(os.readlink(source), destination)
+
+
+def scandir(path):
+    return list(_scandir_entries(path))
+
+
+if hasattr(os, "scandir"):
+    def _scandir_entries(path):
+        with os.scandir(path) as entries:
+            for entry in entries:
+                yield entry
+else:
+    def _scandir_entries(path):
+        return [_DirEntry(path, name) for name in os.listdir(path)]
+
+
+class _DirEntry(object):
+    def __init__(self, dir_path, name):
+        self.name = name
+        self.path = os.path.join(dir_path, name)
+        
+    def is_dir(self):
+        return os.path.isdir(self.path)
+        
+    def is_file(self):
+        return os.path.isfile(self.path)
+        
+    def is_symlink(self):
+        return os.path.islink(self.path)
+        
+    def stat(self):
+        return os.stat(self.path)
 
 
 def mkdir_p(path):
@@ -37,6 +236,30 @@ def delete_dir(path):
         shutil.rmtree(path)
 
 
+def temporary_sibling_path(path):
+    # Staged next to the final path, so that it can be renamed into place
+    return "{0}.{1}{2}".format(path, uuid.uuid4(), temporary_suffix)
+
+
+temporary_suffix = ".part"
+
+
+def write_json_atomically(path, value, **dump_kwargs):
+    # Readers never see a partially written file, and each writer has its
+    # own temporary file, even within the same process
+    directory = os.path.dirname(path)
+    if directory:
+        mkdir_p(directory)
+    temp_path = temporary_sibling_path(path)
+    try:
+        with open(temp_path, "w") as json_file:
+            json.dump(value, json_file, **dump_kwargs)
+        os.rename(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
 def write_files(root_dir, file_descriptions):
     for file_description in file_descriptions:
         path = os.path.join(root_dir, file_description.path)
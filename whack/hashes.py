@@ -1,24 +1,155 @@
 import os
 import hashlib
+import binascii
+import json
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from .files import scandir, write_json_atomically
+from .stats import default_counters
 
 
 class Hasher(object):
-    def __init__(self):
+    def __init__(self, file_digest_cache=None):
+        if file_digest_cache is None:
+            file_digest_cache = NoFileDigestCache()
         self._hash = hashlib.sha1()
+        self._file_digest_cache = file_digest_cache
     
     def update(self, arg):
         self._hash.update(_sha1(arg))
     
     def update_with_dir(self, dir_path):
+        file_digests = self._file_digest_cache.for_dir(dir_path)
         for file_path in _all_files(dir_path):
             self.update(os.path.relpath(file_path, dir_path))
-            with open(file_path) as f:
-                self.update(f.read())
+            self._hash.update(file_digests.digest(file_path))
+        file_digests.save()
     
     def ascii_digest(self):
         return integer_to_ascii(int(self._hash.hexdigest(), 16))
 
 
+class MerkleHasher(object):
+    def __init__(self, file_digest_cache=None, workers=None):
+        if file_digest_cache is None:
+            file_digest_cache = NoFileDigestCache()
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self._hash = hashlib.sha1()
+        self._file_digest_cache = file_digest_cache
+        self._workers = workers
+    
+    def update(self, arg):
+        self._hash.update(_sha1(arg))
+    
+    def update_with_dir(self, dir_path):
+        file_digests = self._file_digest_cache.for_dir(dir_path)
+        pool = ThreadPool(self._workers)
+        
+        def hash_file(path):
+            return pool.apply_async(file_digests.digest, (path, ))
+        
+        try:
+            tree = _read_tree(dir_path, hash_file)
+            self._hash.update(_tree_digest(tree))
+        finally:
+            pool.close()
+            pool.join()
+        file_digests.save()
+    
+    def ascii_digest(self):
+        return integer_to_ascii(int(self._hash.hexdigest(), 16))
+
+
+def _read_tree(dir_path, hash_file):
+    # File digests are computed asynchronously while the rest of the tree
+    # is being read
+    tree = []
+    for entry in sorted(_scandir(dir_path), key=lambda entry: entry.name):
+        if entry.is_dir():
+            if not entry.is_symlink():
+                tree.append((b"d", entry.name, _read_tree(entry.path, hash_file)))
+        else:
+            tree.append((b"f", entry.name, hash_file(entry.path)))
+    return tree
+
+
+def _tree_digest(tree):
+    tree_hash = hashlib.sha1()
+    for entry_type, name, value in tree:
+        if entry_type == b"d":
+            digest = _tree_digest(value)
+        else:
+            digest = value.get()
+        tree_hash.update(entry_type)
+        tree_hash.update(_sha1(name))
+        tree_hash.update(digest)
+    return tree_hash.digest()
+
+
+class NoFileDigestCache(object):
+    def for_dir(self, dir_path):
+        return UncachedFileDigests()
+
+
+class UncachedFileDigests(object):
+    def digest(self, file_path):
+        return file_digest(file_path)
+        
+    def save(self):
+        pass
+
+
+class FileDigestCache(object):
+    def __init__(self, cache_dir):
+        self._cache_dir = cache_dir
+        
+    def for_dir(self, dir_path):
+        dir_hash = hashlib.sha1(os.path.abspath(dir_path).encode("utf8")).hexdigest()
+        cache_path = os.path.join(self._cache_dir, dir_hash)
+        return CachedFileDigests(dir_path, cache_path)
+
+
+class CachedFileDigests(object):
+    # Files modified this recently might be modified again without their
+    # mtime changing, so their digests aren't stored
+    _minimum_age_in_seconds = 2
+    
+    def __init__(self, dir_path, cache_path):
+        self._dir_path = dir_path
+        self._cache_path = cache_path
+        self._cached_entries = _read_json_file(cache_path)
+        self._entries = {}
+        self._now = time.time()
+        
+    def digest(self, file_path):
+        relative_path = os.path.relpath(file_path, self._dir_path)
+        stat = os.stat(file_path)
+        key = [stat.st_size, _mtime_ns(stat), stat.st_ino]
+        cached_entry = self._cached_entries.get(relative_path)
+        if cached_entry is not None and cached_entry[:3] == key:
+            digest = binascii.unhexlify(cached_entry[3])
+            default_counters.increment("hash.cached_files")
+        else:
+            digest = file_digest(file_path)
+        
+        if self._now - stat.st_mtime >= self._minimum_age_in_seconds:
+            self._entries[relative_path] = key + [binascii.hexlify(digest).decode("ascii")]
+        return digest
+        
+    def save(self):
+        if self._entries == self._cached_entries:
+            return
+            
+        try:
+            write_json_atomically(self._cache_path, self._entries)
+        except (IOError, OSError):
+            # The files are hashed again next time instead
+            pass
+
+
 def integer_to_ascii(value):
     characters = "0123456789abcdefghijklmnopqrstuvwxyz"
     
@@ -36,14 +167,67 @@ def integer_to_ascii(value):
 
 
 def _all_files(top):
-    all_files = []
-    
-    for root, dirs, files in os.walk(top):
-        for name in files:
-            all_files.append(os.path.join(root, name))
-    
-    return sorted(all_files)
-    
+    # Yields the same order as sorting every path found by os.walk, but
+    # only holds the entries of one directory at a time
+    for entry in sorted(_scandir(top), key=_walk_order_key):
+        if entry.is_dir():
+            if not entry.is_symlink():
+                for file_path in _all_files(entry.path):
+                    yield file_path
+        else:
+            yield entry.path
+
+
+def _scandir(path):
+    try:
+        return scandir(path)
+    except OSError:
+        # Consistent with os.walk, which ignores unreadable directories
+        return []
+
+
+def _walk_order_key(entry):
+    if entry.is_dir() and not entry.is_symlink():
+        return entry.name + "/"
+    else:
+        return entry.name
+
+
+def file_digest(file_path, counter="hash"):
+    file_hash = hashlib.sha1()
+    buffer = bytearray(_chunk_size)
+    view = memoryview(buffer)
+    total_length = 0
+    with open(file_path, "rb") as f:
+        while True:
+            length = f.readinto(buffer)
+            if not length:
+                break
+            file_hash.update(view[:length])
+            total_length += length
+    default_counters.increment("{0}.files".format(counter))
+    default_counters.increment("{0}.bytes".format(counter), total_length)
+    return file_hash.digest()
+
+
+_chunk_size = 64 * 1024
+
+
+def _mtime_ns(stat):
+    mtime_ns = getattr(stat, "st_mtime_ns", None)
+    if mtime_ns is None:
+        return int(stat.st_mtime * 1000000000)
+    else:
+        return mtime_ns
+
+
+def _read_json_file(path):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
 
 def _sha1(value):
     if not isinstance(value, bytes):
@@ -0,0 +1,91 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+__all__ = ["HttpClient", "HttpError", "RequestError", "default_client"]
+
+
+class HttpError(Exception):
+    def __init__(self, url, status_code):
+        message = "{0} returned status code {1}".format(url, status_code)
+        Exception.__init__(self, message)
+        self.url = url
+        self.status_code = status_code
+
+
+RequestError = requests.RequestException
+
+
+class HttpClient(object):
+    def __init__(self, max_connections_per_host=16):
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=max_connections_per_host,
+            pool_maxsize=max_connections_per_host,
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._counters_lock = threading.Lock()
+        self.requests = 0
+        self.bytes_received = 0
+        self.seconds_elapsed = 0.0
+    
+    def get(self, url, headers=None, stream=False):
+        start_time = time.time()
+        response = self._session.get(url, headers=headers, stream=stream)
+        if stream:
+            # The body is only read once the caller consumes it, so count
+            # the bytes as they're read
+            response.iter_content = self._counting_iter_content(response.iter_content)
+            self._record(bytes_received=0, start_time=start_time)
+        else:
+            self._record(bytes_received=len(response.content), start_time=start_time)
+        return response
+    
+    def _counting_iter_content(self, iter_content):
+        def counting_iter_content(*args, **kwargs):
+            for chunk in iter_content(*args, **kwargs):
+                with self._counters_lock:
+                    self.bytes_received += len(chunk)
+                yield chunk
+        
+        return counting_iter_content
+    
+    def download(self, url, path):
+        with open(path, "wb") as output_file:
+            self.copy_to(url, output_file)
+    
+    def copy_to(self, url, output_file):
+        start_time = time.time()
+        # Save the body exactly as served, as curl would, rather than
+        # letting the server apply a content encoding
+        headers = {"Accept-Encoding": "identity"}
+        response = self._session.get(url, headers=headers, stream=True)
+        try:
+            if response.status_code != 200:
+                raise HttpError(url, response.status_code)
+            bytes_received = 0
+            while True:
+                chunk = response.raw.read(_chunk_size)
+                if not chunk:
+                    break
+                output_file.write(chunk)
+                bytes_received += len(chunk)
+        finally:
+            response.close()
+        self._record(bytes_received=bytes_received, start_time=start_time)
+    
+    def _record(self, bytes_received, start_time):
+        with self._counters_lock:
+            self.requests += 1
+            self.bytes_received += bytes_received
+            self.seconds_elapsed += time.time() - start_time
+
+
+_chunk_size = 64 * 1024
+
+
+default_client = HttpClient()
@@ -1,80 +1,472 @@
+import os
+import json
+import time
+import hashlib
+import codecs
+import sys
+import threading
+import logging
+
+import six
 from six.moves.urllib.parse import urljoin
+from six.moves.html_parser import HTMLParser
 
-import requests
-from bs4 import BeautifulSoup
+import dodge
 
 from .common import SOURCE_URI_SUFFIX, PACKAGE_URI_SUFFIX
 from . import slugs
 from .platform import Platform
-from . import lists
+from . import httpclient
+from .files import write_json_atomically
+from .tracing import default_tracer
+
+
+_logger = logging.getLogger(__name__)
 
 
-def read_index(index_uri):
-    index_response = requests.get(index_uri)
-    if index_response.status_code != 200:
+def read_index(index_uri, index_cache=None):
+    with default_tracer.span("read_index", uri=index_uri):
+        if index_cache is None:
+            index_string, index = _read_index_response(index_uri, _get_index(index_uri))
+            return index
+        else:
+            return index_cache.read(index_uri)
+
+
+def _get_index(index_uri, headers=None):
+    index_response = httpclient.default_client.get(index_uri, headers=headers, stream=True)
+    if index_response.status_code not in (200, 304):
         # TODO: should we log and carry on? Definitely shouldn't swallow
         # silently
         raise Exception("Index {0} returned status code {1}".format(
             index_uri, index_response.status_code
         ))
-    return read_index_string(index_uri, index_response.text)
+    return index_response
+
+
+def find_in_indices(index_uris, find_entry, index_cache=None, timeout=None,
+        miss_cache=None, lookup_key=None):
+    # All indices are read at once, but the entry from the first index in
+    # the given order that has one is used. Once an entry has been found,
+    # later indices are no longer waited for. An index that doesn't respond
+    # within the timeout is skipped.
+    if lookup_key is None:
+        miss_cache = None
+    lookups = [
+        _IndexLookup(index_uri, find_entry, index_cache, miss_cache, lookup_key, timeout)
+        for index_uri in index_uris
+    ]
+    for lookup in lookups:
+        lookup.start()
+    
+    try:
+        for lookup in lookups:
+            entry = lookup.result()
+            if entry is not None:
+                return entry
+        return None
+    finally:
+        for lookup in lookups:
+            lookup.cancel()
+
+
+class _IndexLookup(object):
+    # Reads that have already started can't be interrupted, so cancelled
+    # lookups finish in the background and their results are ignored
+    def __init__(self, index_uri, find_entry, index_cache, miss_cache, lookup_key, timeout):
+        self._index_uri = index_uri
+        self._find_entry = find_entry
+        self._index_cache = index_cache
+        self._miss_cache = miss_cache
+        self._lookup_key = lookup_key
+        self._timeout = timeout
+        self._deadline = None
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._entry = None
+        self._error = None
+    
+    def start(self):
+        if self._timeout is not None:
+            self._deadline = time.time() + self._timeout
+        self._thread.start()
+    
+    def cancel(self):
+        self._cancelled.set()
+    
+    def result(self):
+        if self._deadline is None:
+            self._thread.join()
+        else:
+            self._thread.join(max(0, self._deadline - time.time()))
+        
+        if self._thread.is_alive():
+            self.cancel()
+            _logger.warning(
+                "Skipping index %s: no response within %s seconds",
+                self._index_uri, self._timeout,
+            )
+            return None
+        elif self._error is not None:
+            six.reraise(*self._error)
+        else:
+            return self._entry
+    
+    def _run(self):
+        try:
+            if self._cancelled.is_set() or self._is_known_miss():
+                return
+            index = read_index(self._index_uri, self._index_cache)
+            if not self._cancelled.is_set():
+                self._entry = self._find_entry(index)
+                if self._entry is None and self._miss_cache is not None:
+                    self._miss_cache.add(self._index_uri, self._lookup_key)
+        except:
+            self._error = sys.exc_info()
+    
+    def _is_known_miss(self):
+        return (
+            self._miss_cache is not None and
+            self._miss_cache.contains(self._index_uri, self._lookup_key)
+        )
+
+
+# Remembers lookups that found nothing in an index so that the index isn't
+# read again for the same lookup. Misses expire after the TTL, or as soon
+# as the cached copy of the index changes.
+class IndexMissCache(object):
+    def __init__(self, cache_dir, index_cache, ttl):
+        self._cache_dir = cache_dir
+        self._index_cache = index_cache
+        self._ttl = ttl
+    
+    def contains(self, index_uri, lookup_key):
+        validator = self._index_cache.validator(index_uri)
+        entry = _read_cache_file(self._entry_path(index_uri))
+        if validator is None or entry is None or entry["validator"] != validator:
+            return False
+        missed_at = entry["misses"].get(lookup_key)
+        return missed_at is not None and time.time() - missed_at < self._ttl
+    
+    def add(self, index_uri, lookup_key):
+        validator = self._index_cache.validator(index_uri)
+        if validator is None:
+            return
+        
+        now = time.time()
+        entry = _read_cache_file(self._entry_path(index_uri))
+        if entry is None or entry["validator"] != validator:
+            misses = {}
+        else:
+            misses = dict(
+                (key, missed_at)
+                for key, missed_at in entry["misses"].items()
+                if now - missed_at < self._ttl
+            )
+        misses[lookup_key] = now
+        _write_cache_file(self._entry_path(index_uri), {
+            "validator": validator,
+            "misses": misses,
+        })
+    
+    def _entry_path(self, index_uri):
+        return _cache_file_path(self._cache_dir, index_uri)
+
+
+# Reads each index at most once for the lifetime of the cache, so that
+# installing many packages in one process doesn't read the same index
+# repeatedly. Concurrent reads of the same index wait for the first read.
+class MemoizedIndexCache(object):
+    def __init__(self, index_cache=None):
+        self._index_cache = index_cache
+        self._indices = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+    
+    def reset_locks(self):
+        # Indices that were being read when the process forked are read
+        # again, since the threads reading them don't exist in the child
+        self._locks = {}
+        self._lock = threading.Lock()
+    
+    def validator(self, index_uri):
+        if self._index_cache is None:
+            return None
+        else:
+            return self._index_cache.validator(index_uri)
+    
+    def read(self, index_uri):
+        with self._lock:
+            if index_uri not in self._locks:
+                self._locks[index_uri] = threading.Lock()
+            index_lock = self._locks[index_uri]
+        
+        with index_lock:
+            if index_uri not in self._indices:
+                self._indices[index_uri] = read_index(index_uri, self._index_cache)
+            return self._indices[index_uri]
+
+
+class IndexCache(object):
+    def __init__(self, cache_dir, ttl=0):
+        self._cache_dir = cache_dir
+        self._ttl = ttl
+        
+    def read(self, index_uri):
+        entry = self._read_entry(index_uri)
+        now = time.time()
+        if entry is not None and now - entry["fetchedAt"] < self._ttl:
+            return _read_index_entry(index_uri, entry)
+        
+        try:
+            response = _get_index(index_uri, headers=_validator_headers(entry))
+        except httpclient.RequestError:
+            # Use the copy from when the index could last be reached
+            if entry is None:
+                raise
+            return _read_index_entry(index_uri, entry)
+        if response.status_code == 304 and entry is not None:
+            entry["fetchedAt"] = now
+            index = _read_index_entry(index_uri, entry)
+        else:
+            index_string, index = _read_index_response(index_uri, response)
+            entry = {
+                "fetchedAt": now,
+                "etag": response.headers.get("etag"),
+                "lastModified": response.headers.get("last-modified"),
+                "contentType": response.headers.get("content-type"),
+                "body": index_string,
+            }
+        self._write_entry(index_uri, entry)
+        return index
+    
+    def validator(self, index_uri):
+        # Identifies the version of the index that's cached, if any
+        entry = self._read_entry(index_uri)
+        if entry is None:
+            return None
+        elif entry.get("etag") is not None:
+            return entry["etag"]
+        else:
+            return hashlib.sha1(entry["body"].encode("utf8")).hexdigest()
+    
+    def _read_entry(self, index_uri):
+        return _read_cache_file(self._entry_path(index_uri))
+    
+    def _write_entry(self, index_uri, entry):
+        _write_cache_file(self._entry_path(index_uri), entry)
+        
+    def _entry_path(self, index_uri):
+        return _cache_file_path(self._cache_dir, index_uri)
+
+
+def _cache_file_path(cache_dir, index_uri):
+    uri_hash = hashlib.sha1(index_uri.encode("utf8")).hexdigest()
+    return os.path.join(cache_dir, uri_hash)
+
+
+def _read_cache_file(path):
+    try:
+        with open(path) as cache_file:
+            return json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_cache_file(path, value):
+    try:
+        write_json_atomically(path, value)
+    except (IOError, OSError):
+        # The index is read again next time instead
+        pass
+
+
+def _validator_headers(entry):
+    headers = {}
+    if entry is not None:
+        if entry.get("etag") is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("lastModified") is not None:
+            headers["If-Modified-Since"] = entry["lastModified"]
+    return headers
+    
+    
+def _read_index_entry(index_uri, entry):
+    return read_index_string(index_uri, entry["body"], entry.get("contentType"))
+
+
+def _read_index_response(index_uri, response):
+    content_type = response.headers.get("content-type")
+    if _is_json_content_type(content_type):
+        index_string = response.text
+        return index_string, read_json_index_string(index_uri, index_string)
+    else:
+        # Parse the HTML as it arrives rather than waiting for the whole body
+        parser = _IndexLinkParser(index_uri)
+        index_string_parts = []
+        for index_string_part in _iter_text(response):
+            index_string_parts.append(index_string_part)
+            parser.feed(index_string_part)
+        parser.close()
+        return "".join(index_string_parts), Index(parser.entries)
+
+
+def _iter_text(response):
+    decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(errors="replace")
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+def _is_json_content_type(content_type):
+    if content_type is None:
+        return False
+    else:
+        media_type = content_type.split(";", 1)[0].strip().lower()
+        return media_type == "application/json" or media_type.endswith("+json")
+
+
+def read_index_string(index_url, index_string, content_type=None):
+    if _is_json_content_type(content_type):
+        return read_json_index_string(index_url, index_string)
+    
+    parser = _IndexLinkParser(index_url)
+    parser.feed(index_string)
+    parser.close()
+    return Index(parser.entries)
+
+
+class _IndexLinkParser(HTMLParser):
+    def __init__(self, index_url):
+        if six.PY2:
+            HTMLParser.__init__(self)
+        else:
+            HTMLParser.__init__(self, convert_charrefs=True)
+        self._index_url = index_url
+        self._href = None
+        self._link_text = None
+        self.entries = []
+    
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            self._href = dict(attrs).get("href") or ""
+            self._link_text = []
+    
+    def handle_endtag(self, tag):
+        if tag == "a" and self._link_text is not None:
+            url = urljoin(self._index_url, self._href)
+            link_text = "".join(self._link_text).strip()
+            self.entries.append(IndexEntry(link_text, url))
+            self._href = None
+            self._link_text = None
     
+    def handle_data(self, data):
+        if self._link_text is not None:
+            self._link_text.append(data)
     
-def read_index_string(index_url, index_string):
-    html_document = BeautifulSoup(index_string)
+    def close(self):
+        HTMLParser.close(self)
+        self.handle_endtag("a")
     
-    def link_to_index_entry(link):
-        url = urljoin(index_url, link.get("href"))
-        link_text = link.get_text().strip()
-        return IndexEntry(link_text, url)
+    # Only called on Python 2, where HTMLParser can't convert references
+    # itself. HTMLParser.unescape was removed in Python 3.9.
     
-    return Index(lists.map(link_to_index_entry, html_document.find_all("a")))
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape("&{0};".format(name)))
     
+    def handle_charref(self, name):
+        self.handle_data(self.unescape("&#{0};".format(name)))
+
+
+def read_json_index_string(index_url, index_string):
+    def read_entry(entry):
+        platform = entry.get("platform")
+        if platform is not None:
+            platform = dodge.dict_to_obj(platform, Platform)
+        return IndexEntry(
+            entry["name"],
+            urljoin(index_url, entry["url"]),
+            size=entry.get("size"),
+            hash=entry.get("hash"),
+            platform=platform,
+        )
+    
+    return Index([read_entry(entry) for entry in json.loads(index_string)["entries"]])
+
 
 class Index(object):
     def __init__(self, entries):
-        self._entries = entries
+        # Entries are matched by name first, then by the filename in their
+        # URL, so each has its own lookup table
+        self._entries_by_name = _index_entries(entries, _entry_name)
+        self._entries_by_url_filename = _index_entries(entries, _entry_url_filename)
+        self._packages_by_name = _index_packages(entries, _entry_name)
+        self._packages_by_url_filename = _index_packages(entries, _entry_url_filename)
     
     def find_package_source_by_name(self, name):
         package_source_filename = name + SOURCE_URI_SUFFIX
         return self._find_by_name(package_source_filename)
         
     def find_package(self, params_hash, platform):
-        def _is_package(entry_name):
-            if entry_name.endswith(PACKAGE_URI_SUFFIX):
-                package_name = entry_name[:-len(PACKAGE_URI_SUFFIX)]
-                parts = slugs.split(package_name)
-                if len(parts) < 4:
-                    return False
-                else:
-                    entry_params_hash = parts[-1]
-                    entry_platform = parts[-4:-1]
-                    return (
-                        entry_params_hash == params_hash and
-                        platform.can_use(Platform.load_list(entry_platform))
-                    )
-            else:
-                return False
+        for packages in [self._packages_by_name, self._packages_by_url_filename]:
+            for entry_platform, entry in packages.get(params_hash, []):
+                if platform.can_use(entry_platform):
+                    return entry
         
-        return self._find(_is_package)
+        return None
     
     def _find_by_name(self, name):
-        return self._find(lambda entry_name: entry_name == name)
-        
-    def _find(self, predicate):
-        for entry in self._entries:
-            if predicate(entry.name):
-                return entry
-                
-        for entry in self._entries:
-            url_parts = entry.url.rsplit("/", 1)
-            if predicate(url_parts[-1]):
-                return entry
-                
-        return None
+        entry = self._entries_by_name.get(name)
+        if entry is None:
+            return self._entries_by_url_filename.get(name)
+        else:
+            return entry
+
+
+def _entry_name(entry):
+    return entry.name
+
+
+def _entry_url_filename(entry):
+    return entry.url.rsplit("/", 1)[-1]
+
+
+def _index_entries(entries, read_key):
+    entries_by_key = {}
+    for entry in entries:
+        entries_by_key.setdefault(read_key(entry), entry)
+    return entries_by_key
+
+
+def _index_packages(entries, read_key):
+    packages = {}
+    for entry in entries:
+        package = _parse_package_filename(read_key(entry))
+        if package is not None:
+            params_hash, platform = package
+            if entry.platform is not None:
+                platform = entry.platform
+            packages.setdefault(params_hash, []).append((platform, entry))
+    return packages
+
+
+def _parse_package_filename(filename):
+    if filename.endswith(PACKAGE_URI_SUFFIX):
+        package_name = filename[:-len(PACKAGE_URI_SUFFIX)]
+        parts = slugs.split(package_name)
+        if len(parts) >= 4:
+            params_hash = parts[-1]
+            platform = Platform.load_list(parts[-4:-1])
+            return params_hash, platform
+    
+    return None
 
 
 class IndexEntry(object):
-    def __init__(self, name, url):
+    def __init__(self, name, url, size=None, hash=None, platform=None):
         self.name = name
         self.url = url
+        self.size = size
+        self.hash = hash
+        self.platform = platform
@@ -1,11 +1,55 @@
+import sys
+import subprocess
+
 import spur
 
+from .tracing import default_tracer
+
 
-__all__ = ["run", "RunProcessError"]
+__all__ = ["run", "spawn", "RunProcessError"]
 
 
 local_shell = spur.LocalShell()
 
-run = local_shell.run
+
+def run(command, *args, **kwargs):
+    with default_tracer.span("run", category="process", argv=command):
+        return local_shell.run(command, *args, **kwargs)
+
+
+# Starts a process that's streamed to or from. The process is traced in the
+# same way as commands that are run to completion, until it's waited for.
+def spawn(command, **kwargs):
+    span = default_tracer.span("run", category="process", argv=command)
+    span.__enter__()
+    try:
+        process = subprocess.Popen(command, **kwargs)
+    except:
+        span.__exit__(*sys.exc_info())
+        raise
+    return SpawnedProcess(process, span)
+
+
+class SpawnedProcess(object):
+    def __init__(self, process, span):
+        self._process = process
+        self._span = span
+        self.stdin = process.stdin
+        self.stdout = process.stdout
+    
+    def wait(self):
+        try:
+            return self._process.wait()
+        finally:
+            self._end_span()
+    
+    def kill(self):
+        self._process.kill()
+    
+    def _end_span(self):
+        if self._span is not None:
+            self._span.__exit__(None, None, None)
+            self._span = None
+
 
 RunProcessError = spur.RunProcessError
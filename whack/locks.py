@@ -0,0 +1,91 @@
+import os
+import errno
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# A lock that can be held by many processes at once, or by a single
+# process exclusively. Caches are read and written while holding the lock
+# shared, and entries are only removed while holding the lock exclusively.
+class ReadWriteFileLock(object):
+    def __init__(self, path):
+        self._path = path
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self._lock("LOCK_SH", blocking=True):
+            yield
+
+    @contextlib.contextmanager
+    def exclusive(self, blocking=True):
+        with self._lock("LOCK_EX", blocking=blocking) as acquired:
+            yield acquired
+
+    @contextlib.contextmanager
+    def _lock(self, operation_name, blocking):
+        if fcntl is None:
+            yield True
+            return
+        
+        operation = getattr(fcntl, operation_name)
+        _mkdir_p(os.path.dirname(self._path))
+        lock_file = open(self._path, "a")
+        try:
+            if not blocking:
+                operation |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_file.fileno(), operation)
+            except IOError:
+                if blocking:
+                    raise
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        finally:
+            lock_file.close()
+
+
+class NoLock(object):
+    @contextlib.contextmanager
+    def shared(self):
+        yield
+
+    @contextlib.contextmanager
+    def exclusive(self, blocking=True):
+        yield True
+
+
+# One lock per key, such as a package name, so that only one process at a
+# time does the work for that key while the others wait and then reuse the
+# result. The locks are released by the kernel when the holding process
+# exits, so a crashed holder never leaves a stale lock behind. Lock files
+# are never removed, since a process may be waiting on the file.
+class SingleFlightLocks(object):
+    def __init__(self, lock_dir):
+        self._lock_dir = lock_dir
+
+    def hold(self, key, blocking=True):
+        lock_path = os.path.join(self._lock_dir, "{0}.lock".format(key))
+        return ReadWriteFileLock(lock_path).exclusive(blocking=blocking)
+
+
+class NoSingleFlightLocks(object):
+    @contextlib.contextmanager
+    def hold(self, key, blocking=True):
+        yield True
+
+
+# Duplicated from whack.files to avoid a circular import
+def _mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as error:
+        if not (error.errno == errno.EEXIST and os.path.isdir(path)):
+            raise
@@ -0,0 +1,71 @@
+import os
+import json
+
+from .errors import WhackUserError
+
+
+class InvalidManifest(WhackUserError):
+    pass
+
+
+class PackageInstall(object):
+    def __init__(self, source, target_dir, params=None):
+        if params is None:
+            params = {}
+        self.source = source
+        self.target_dir = target_dir
+        self.params = params
+
+    def __eq__(self, other):
+        return (self.source, self.target_dir, self.params) == \
+            (other.source, other.target_dir, other.params)
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __repr__(self):
+        return "PackageInstall({0!r}, {1!r}, {2!r})".format(
+            self.source, self.target_dir, self.params
+        )
+
+
+def read_install_manifest(path):
+    try:
+        with open(path) as manifest_file:
+            return read_install_manifest_string(manifest_file.read())
+    except IOError as error:
+        raise InvalidManifest("Could not read manifest {0}: {1}".format(path, error.strerror))
+
+
+def read_install_manifest_string(manifest_string):
+    try:
+        entries = json.loads(manifest_string)
+    except ValueError as error:
+        raise InvalidManifest("Manifest is not valid JSON: {0}".format(error))
+
+    if not isinstance(entries, list):
+        raise InvalidManifest("Manifest should be a list of installs")
+
+    installs = [_read_install(entry) for entry in entries]
+    _check_target_dirs_are_unique(installs)
+    return installs
+
+
+def _read_install(entry):
+    if not isinstance(entry, dict) or "source" not in entry or "target" not in entry:
+        raise InvalidManifest("Each install should have a source and a target")
+
+    params = entry.get("params", {})
+    if not isinstance(params, dict):
+        raise InvalidManifest("Params of {0} should be an object".format(entry["source"]))
+
+    return PackageInstall(entry["source"], entry["target"], params)
+
+
+def _check_target_dirs_are_unique(installs):
+    target_dirs = set()
+    for install in installs:
+        target_dir = os.path.abspath(install.target_dir)
+        if target_dir in target_dirs:
+            raise InvalidManifest("Target is used more than once: {0}".format(install.target_dir))
+        target_dirs.add(target_dir)
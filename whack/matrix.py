@@ -0,0 +1,63 @@
+import itertools
+import multiprocessing
+
+from .errors import WhackUserError
+
+
+class BuildMatrixError(WhackUserError):
+    def __init__(self, failures):
+        message = "Failed to build {0} package(s):\n{1}".format(
+            len(failures),
+            "\n".join(
+                "{0}: {1}".format(_describe_params(params), error)
+                for params, error in failures
+            ),
+        )
+        WhackUserError.__init__(self, message)
+
+
+def expand_param_grid(param_grid, params=None):
+    if params is None:
+        params = {}
+
+    names = sorted(param_grid)
+    combinations = []
+    for values in itertools.product(*[param_grid[name] for name in names]):
+        combination = params.copy()
+        combination.update(zip(names, values))
+        combinations.append(combination)
+    return combinations
+
+
+def admitted_workers(workers, memory_per_build=None, available_memory=None):
+    # Don't start more builds than there's memory for, but always allow
+    # at least one build to run
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if memory_per_build is None:
+        return workers
+    if available_memory is None:
+        available_memory = read_available_memory()
+    if available_memory is None:
+        return workers
+    return max(1, min(workers, available_memory // memory_per_build))
+
+
+def read_available_memory():
+    try:
+        with open("/proc/meminfo") as meminfo_file:
+            for line in meminfo_file:
+                name, _, value = line.partition(":")
+                if name == "MemAvailable":
+                    # Values are in kibibytes
+                    return int(value.split()[0]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _describe_params(params):
+    return " ".join(
+        "{0}={1}".format(key, params[key])
+        for key in sorted(params)
+    )
@@ -0,0 +1,204 @@
+import os
+import re
+import hashlib
+
+import mayo.uri_parser
+
+from .files import mkdir_p, delete_dir, temporary_sibling_path
+from .tempdir import create_temporary_dir
+from .locks import NoSingleFlightLocks
+from .stats import default_counters
+from .tracing import default_tracer
+from . import local
+
+
+# Keeps a local mirror of each repository, which is brought up to date by
+# fetching just the new revisions, and caches the source tree of each
+# commit. Resolving a revision whose source tree is already cached only
+# asks the remote repository which commit the revision refers to. If the
+# remote repository can't be reached, revisions are resolved using the
+# mirror as it was last fetched.
+class SourceControlMirrors(object):
+    def __init__(self, mirrors_dir, tree_cacher, single_flight_locks=None):
+        if single_flight_locks is None:
+            single_flight_locks = NoSingleFlightLocks()
+        self._mirrors_dir = mirrors_dir
+        self._tree_cacher = tree_cacher
+        self._single_flight_locks = single_flight_locks
+        self._systems = {"git": GitMirror(), "hg": HgMirror()}
+    
+    def archive(self, source_name, destination_dir):
+        uri = mayo.uri_parser.parse(source_name)
+        system = self._systems[uri.vcs]
+        mirror_name = "{0}-{1}".format(
+            uri.vcs,
+            hashlib.sha1(uri.repo_uri.encode("utf8")).hexdigest(),
+        )
+        
+        try:
+            commit = system.resolve_remote(uri.repo_uri, uri.revision)
+            remote_available = True
+        except (local.RunProcessError, OSError):
+            default_counters.increment("mirrors.remote_failures")
+            commit = None
+            remote_available = False
+        
+        if commit is not None and self._fetch_tree(uri.vcs, commit, destination_dir):
+            return
+        
+        # Only one process updates each mirror at a time
+        with self._single_flight_locks.hold(mirror_name):
+            mirror_path = os.path.join(self._mirrors_dir, mirror_name)
+            if remote_available or not os.path.exists(mirror_path):
+                with default_tracer.span("update_mirror", source=source_name):
+                    self._update(system, uri.repo_uri, mirror_path)
+            commit = system.resolve(mirror_path, uri.revision)
+            if not self._fetch_tree(uri.vcs, commit, destination_dir):
+                default_counters.increment("source_trees.cache_misses")
+                system.archive(mirror_path, commit, destination_dir)
+                self._tree_cacher.put(_tree_cache_id(uri.vcs, commit), destination_dir)
+    
+    def _fetch_tree(self, vcs, commit, destination_dir):
+        if self._tree_cacher.fetch(_tree_cache_id(vcs, commit), destination_dir).cache_hit:
+            default_counters.increment("source_trees.cache_hits")
+            return True
+        else:
+            return False
+    
+    def _update(self, system, repo_uri, mirror_path):
+        if os.path.exists(mirror_path):
+            default_counters.increment("mirrors.fetches")
+            try:
+                system.fetch(mirror_path)
+            except (local.RunProcessError, OSError):
+                # The revision may already be in the mirror
+                default_counters.increment("mirrors.remote_failures")
+        else:
+            default_counters.increment("mirrors.clones")
+            # Clone alongside the mirror so that a failed clone is never
+            # mistaken for a mirror
+            temp_path = temporary_sibling_path(mirror_path)
+            mkdir_p(self._mirrors_dir)
+            try:
+                system.clone(repo_uri, temp_path)
+                os.rename(temp_path, mirror_path)
+            finally:
+                if os.path.exists(temp_path):
+                    delete_dir(temp_path)
+
+
+class GitMirror(object):
+    # The same default as fetching without a mirror, rather than the
+    # remote HEAD
+    default_revision = "master"
+    
+    def resolve_remote(self, repo_uri, revision):
+        if _is_full_commit_id(revision):
+            return revision
+        
+        if revision is None:
+            revision = self.default_revision
+        # Prefer branches to tags, as resolve does, and tags to the commits
+        # they point at
+        refs = [
+            "refs/heads/{0}".format(revision),
+            "refs/tags/{0}^{{}}".format(revision),
+            "refs/tags/{0}".format(revision),
+        ]
+        
+        output = _run(["git", "ls-remote", repo_uri, revision])
+        commits = {}
+        for line in output.splitlines():
+            commit, _, ref = line.partition("\t")
+            commits[ref] = commit
+        for ref in refs:
+            if ref in commits:
+                return commits[ref]
+        return None
+    
+    def clone(self, repo_uri, mirror_path):
+        _run(["git", "clone", "--mirror", "--quiet", repo_uri, mirror_path])
+    
+    def fetch(self, mirror_path):
+        _run(["git", "--git-dir", mirror_path, "fetch", "--prune", "--quiet"])
+    
+    def resolve(self, mirror_path, revision):
+        if revision is None:
+            revision = self.default_revision
+        # git itself would prefer tags to branches with the same name
+        candidates = [
+            "refs/heads/{0}".format(revision),
+            "refs/tags/{0}".format(revision),
+            revision,
+        ]
+        
+        for candidate in candidates[:-1]:
+            result = local.run(self._rev_parse(mirror_path, candidate), allow_error=True)
+            if result.return_code == 0:
+                return result.output.decode("utf8").strip()
+        return _run(self._rev_parse(mirror_path, candidates[-1])).strip()
+    
+    def _rev_parse(self, mirror_path, revision):
+        return [
+            "git", "--git-dir", mirror_path,
+            "rev-parse", "--verify", "--quiet", "{0}^{{commit}}".format(revision),
+        ]
+    
+    def archive(self, mirror_path, commit, destination_dir):
+        # Check out the commit as a clone would, since git archive applies
+        # export-ignore and export-subst attributes, which would change the
+        # source hash. A temporary index keeps the mirror unchanged.
+        mkdir_p(destination_dir)
+        with create_temporary_dir() as temp_dir:
+            local.run(
+                [
+                    "git", "--git-dir", mirror_path, "--work-tree", destination_dir,
+                    "checkout", "--force", commit, "--", ".",
+                ],
+                update_env={"GIT_INDEX_FILE": os.path.join(temp_dir, "index")},
+            )
+
+
+class HgMirror(object):
+    def resolve_remote(self, repo_uri, revision):
+        if _is_full_commit_id(revision):
+            return revision
+        
+        return _run([
+            "hg", "identify", "--debug", "--id",
+            "--rev", revision or "default",
+            repo_uri,
+        ]).strip() or None
+    
+    def clone(self, repo_uri, mirror_path):
+        _run(["hg", "clone", "--noupdate", "--quiet", repo_uri, mirror_path])
+    
+    def fetch(self, mirror_path):
+        _run(["hg", "pull", "--quiet", "--repository", mirror_path])
+    
+    def resolve(self, mirror_path, revision):
+        return _run([
+            "hg", "log", "--repository", mirror_path,
+            "--rev", revision or "default",
+            "--template", "{node}",
+        ]).strip()
+    
+    def archive(self, mirror_path, commit, destination_dir):
+        _run([
+            "hg", "archive", "--repository", mirror_path,
+            "--config", "ui.archivemeta=False",
+            "--rev", commit, "--type", "files",
+            destination_dir,
+        ])
+
+
+def _tree_cache_id(vcs, commit):
+    return "{0}-{1}".format(vcs, commit)
+
+
+def _is_full_commit_id(revision):
+    return revision is not None and re.match(r"^[0-9a-f]{40}$", revision) is not None
+
+
+def _run(command):
+    return local.run(command).output.decode("utf8")
@@ -1,7 +1,10 @@
 import os
 import sys
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 import dodge
+import six
 
 from .sources import PackageSourceFetcher, create_source_tarball
 from .providers import create_package_provider
@@ -10,62 +13,210 @@ from .tempdir import create_temporary_dir
 from .files import read_file
 from .tarballs import create_tarball
 from .packagerequests import create_package_request, PackageDescription
-from .caching import create_cacher_factory
+from .caching import create_cacher_factory, CacheBudget, cache_names
+from .indices import MemoizedIndexCache
 from .testing import TestResult
 from .env import params_to_env
 from . import local
+from . import httpclient
+from . import platform
+from .stats import default_counters
 from .errors import PackageNotAvailableError
+from .tracing import default_tracer
+from .matrix import expand_param_grid, admitted_workers, BuildMatrixError
 
 
-def create(caching_enabled, indices=None, enable_build=True):
-    cacher_factory = create_cacher_factory(caching_enabled=caching_enabled)
+def create(caching_enabled, indices=None, enable_build=True, index_cache_ttl=None,
+        package_materialization=None, download_materialization=None, cache_max_bytes=None,
+        cache_max_entries=None, index_timeout=None, index_miss_cache_ttl=None,
+        cache_limits=None):
+    if index_cache_ttl is None:
+        index_cache_ttl = 0
+    if index_miss_cache_ttl is None:
+        index_miss_cache_ttl = 60
     
-    package_source_fetcher = PackageSourceFetcher(indices)
+    if cache_limits is None:
+        cache_limits = {}
+    
+    # Limits given for a single cache take priority over the limits for
+    # every cache
+    budgets = {}
+    for name in cache_names:
+        limits = cache_limits.get(name, {})
+        max_bytes = _first_given(limits.get("max_bytes"), cache_max_bytes)
+        max_entries = _first_given(limits.get("max_entries"), cache_max_entries)
+        if max_bytes is not None or max_entries is not None:
+            budgets[name] = CacheBudget(max_bytes=max_bytes, max_entries=max_entries)
+    
+    cacher_factory = create_cacher_factory(
+        caching_enabled=caching_enabled,
+        materializations={
+            "packages": package_materialization,
+            "downloads": download_materialization,
+        },
+        budgets=budgets,
+    )
+    # Each index is read at most once per process, however many packages
+    # are installed
+    index_cache = MemoizedIndexCache(cacher_factory.create_index_cache(ttl=index_cache_ttl))
+    
+    package_source_fetcher = PackageSourceFetcher(
+        indices,
+        file_digest_cache=cacher_factory.create_file_digest_cache(),
+        index_cache=index_cache,
+        index_timeout=index_timeout,
+        source_mirrors=cacher_factory.create_source_mirrors(),
+        source_tree_cacher=cacher_factory.create("source-trees"),
+    )
     package_provider = create_package_provider(
         cacher_factory,
         enable_build=enable_build,
         indices=indices,
+        index_cache=index_cache,
+        index_timeout=index_timeout,
+        index_miss_cache=cacher_factory.create_index_miss_cache(ttl=index_miss_cache_ttl),
     )
     deployer = PackageDeployer()
     
-    return Operations(package_source_fetcher, package_provider, deployer)
+    caches = {}
+    if caching_enabled:
+        caches = {
+            "packages": cacher_factory.create("packages"),
+            "downloads": cacher_factory.create_file_cacher("downloads"),
+            "source-trees": cacher_factory.create("source-trees"),
+        }
+    
+    return Operations(package_source_fetcher, package_provider, deployer, caches, index_cache)
+
+
+def _first_given(*values):
+    for value in values:
+        if value is not None:
+            return value
+    return None
 
 
 class Operations(object):
-    def __init__(self, package_source_fetcher, package_provider, deployer):
+    def __init__(self, package_source_fetcher, package_provider, deployer, caches=None,
+            index_cache=None):
+        if caches is None:
+            caches = {}
         self._package_source_fetcher = package_source_fetcher
         self._package_provider = package_provider
         self._deployer = deployer
+        self._caches = caches
+        self._index_cache = index_cache
         
     def install(self, source_name, install_dir, params=None):
-        self.get_package(source_name, install_dir, params)
-        self.deploy(install_dir)
+        with default_tracer.span("install", source=source_name):
+            self.get_package(source_name, install_dir, params)
+            self.deploy(install_dir)
+        
+    def install_many(self, installs, workers=4):
+        with default_tracer.span("install_many", installs=len(installs)):
+            if not installs:
+                return
+            
+            pool = ThreadPool(min(workers, len(installs)))
+            try:
+                results = [
+                    pool.apply_async(self.install, (install.source, install.target_dir, install.params))
+                    for install in installs
+                ]
+            finally:
+                pool.close()
+                pool.join()
+            
+            # Raise the error for the first failed install in the manifest,
+            # regardless of which finished first
+            for result in results:
+                result.get()
         
     def get_package(self, source_name, install_dir, params=None):
-        with self._package_source_fetcher.fetch(source_name) as package_source:
-            request = create_package_request(package_source, params)
-            if not self._package_provider.provide_package(request, install_dir):
-                raise PackageNotAvailableError()
+        with default_tracer.span("get_package", source=source_name):
+            with self._package_source_fetcher.fetch(source_name) as package_source:
+                request = create_package_request(package_source, params)
+                if not self._package_provider.provide_package(request, install_dir):
+                    raise PackageNotAvailableError()
+        
+    def prefetch(self, source_name, params=None):
+        with default_tracer.span("prefetch", source=source_name):
+            with self._package_source_fetcher.fetch(source_name) as package_source:
+                request = create_package_request(package_source, params)
+                self._package_provider.prefetch_package(request)
         
     def deploy(self, package_dir, target_dir=None):
         return self._deployer.deploy(package_dir, target_dir)
         
-    def create_source_tarball(self, source_name, tarball_dir):
+    def create_source_tarball(self, source_name, tarball_dir, compression=None):
         with self._package_source_fetcher.fetch(source_name) as package_source:
-            return create_source_tarball(package_source, tarball_dir)
+            return create_source_tarball(package_source, tarball_dir, compression=compression)
         
-    def get_package_tarball(self, package_name, tarball_dir, params=None):
+    def get_package_tarball(self, package_name, tarball_dir, params=None, compression=None):
+        with default_tracer.span("get_package_tarball", source=package_name):
+            return self._get_package_tarball(package_name, tarball_dir, params, compression)
+    
+    def _get_package_tarball(self, package_name, tarball_dir, params, compression):
         with create_temporary_dir() as package_dir:
             self.get_package(package_name, package_dir, params=params)
-            package_description = dodge.loads(
-                read_file(os.path.join(package_dir, ".whack-package.json")),
-                PackageDescription
-            )
-            package_name = package_description.name
-            package_filename = "{0}.whack-package".format(package_name)
-            package_tarball_path = os.path.join(tarball_dir, package_filename)
-            create_tarball(package_tarball_path, package_dir, rename_dir=package_name)
-            return PackageTarball(package_tarball_path)
+            return _write_package_tarball(package_dir, tarball_dir, compression)
+    
+    def build_matrix(self, source_name, tarball_dir, param_grid, params=None, workers=None,
+            memory_per_build=None, compression=None):
+        with default_tracer.span("build_matrix", source=source_name):
+            with self._package_source_fetcher.fetch(source_name) as package_source:
+                # Hash the source before forking, even if there's no package
+                # cache to look in, so that the build processes don't each
+                # hash it again
+                package_source.source_hash()
+                requests = [
+                    create_package_request(package_source, combination)
+                    for combination in expand_param_grid(param_grid, params)
+                ]
+                
+                tarballs = [
+                    self._package_tarball_from_cache(request, tarball_dir, compression)
+                    for request in requests
+                ]
+                uncached_indices = [
+                    index
+                    for index, tarball in enumerate(tarballs)
+                    if tarball is None
+                ]
+                results = _build_in_processes(
+                    self,
+                    [requests[index] for index in uncached_indices],
+                    tarball_dir,
+                    compression,
+                    admitted_workers(workers, memory_per_build),
+                )
+                
+                failures = []
+                for index, (tarball, error) in zip(uncached_indices, results):
+                    if error is None:
+                        tarballs[index] = tarball
+                    else:
+                        failures.append((requests[index].params(), error))
+                if failures:
+                    raise BuildMatrixError(failures)
+                return tarballs
+    
+    def _package_tarball_from_cache(self, request, tarball_dir, compression):
+        cacher = self._caches.get("packages")
+        if cacher is None:
+            return None
+        
+        with create_temporary_dir() as package_dir:
+            if cacher.fetch(request.name(), package_dir).cache_hit:
+                return _write_package_tarball(package_dir, tarball_dir, compression)
+            else:
+                return None
+    
+    def _build_package_tarball(self, request, tarball_dir, compression):
+        with create_temporary_dir() as package_dir:
+            if not self._package_provider.provide_package(request, package_dir):
+                raise PackageNotAvailableError()
+            return _write_package_tarball(package_dir, tarball_dir, compression)
             
     def test(self, source_name, params=None):
         with self._package_source_fetcher.fetch(source_name) as package_source:
@@ -85,6 +236,97 @@ class Operations(object):
                 passed = return_code == 0
                 return TestResult(passed=passed)
 
+    
+    def cache_stats(self):
+        return dict(
+            (name, cache.stats())
+            for name, cache in six.iteritems(self._caches)
+        )
+    
+    def collect_cache_garbage(self, budget=None):
+        return dict(
+            (name, cache.collect_garbage(budget=budget))
+            for name, cache in six.iteritems(self._caches)
+        )
+    
+    def pin_package(self, source_name, params=None, pinned=True):
+        with self._package_source_fetcher.fetch(source_name) as package_source:
+            package_name = create_package_request(package_source, params).name()
+        if "packages" in self._caches:
+            self._caches["packages"].pin(package_name, pinned=pinned)
+        return package_name
+
+
+def _write_package_tarball(package_dir, tarball_dir, compression):
+    package_description = dodge.loads(
+        read_file(os.path.join(package_dir, ".whack-package.json")),
+        PackageDescription
+    )
+    package_name = package_description.name
+    package_filename = "{0}.whack-package".format(package_name)
+    package_tarball_path = os.path.join(tarball_dir, package_filename)
+    create_tarball(
+        package_tarball_path,
+        package_dir,
+        rename_dir=package_name,
+        compression=compression,
+    )
+    return PackageTarball(package_tarball_path)
+
+
+# Set before forking the build processes of a build matrix, since the
+# operations and requests can't be pickled
+_matrix_build = None
+
+
+def _build_in_processes(operations, requests, tarball_dir, compression, workers):
+    global _matrix_build
+    
+    if not requests:
+        return []
+    
+    # The source has already been fetched and hashed, and the platform
+    # detected, so each process starts with them
+    _matrix_build = (operations, requests, tarball_dir, compression)
+    try:
+        pool = _fork_context().Pool(min(workers, len(requests)), initializer=_reset_after_fork)
+        try:
+            return pool.map(_build_matrix_entry, range(len(requests)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _matrix_build = None
+
+
+def _reset_after_fork():
+    # Only the forking thread survives in each build process, so locks held
+    # by other threads, such as index lookups, would never be released, and
+    # pooled connections would be shared with the parent
+    operations = _matrix_build[0]
+    httpclient.default_client = httpclient.HttpClient()
+    if operations._index_cache is not None:
+        operations._index_cache.reset_locks()
+    platform.reset_generated_platform_lock()
+    default_counters.reset_lock()
+    default_tracer.reset_lock()
+
+
+def _build_matrix_entry(index):
+    operations, requests, tarball_dir, compression = _matrix_build
+    try:
+        return operations._build_package_tarball(requests[index], tarball_dir, compression), None
+    except Exception as error:
+        # Errors are reported as strings since not all of them can be pickled
+        return None, "{0}: {1}".format(type(error).__name__, error)
+
+
+def _fork_context():
+    if hasattr(multiprocessing, "get_context"):
+        return multiprocessing.get_context("fork")
+    else:
+        return multiprocessing
+
 
 class PackageTarball(object):
     def __init__(self, path):
@@ -3,7 +3,6 @@ import json
 import dodge
 
 from .hashes import Hasher
-from . import local
 from .platform import generate_platform, Platform
 from . import slugs
 
@@ -64,7 +63,7 @@ class PackageRequest(object):
             source_name=self._package_source.name(),
             source_hash=self._package_source.source_hash(),
             params=self.params(),
-            platform=generate_platform(),
+            platform=self.platform(),
         )
         
     def _generate_param_part(self, slug, params):
@@ -81,10 +80,6 @@ def _generate_install_id_using_hash(package_source, params):
     return hasher.ascii_digest()
 
 
-def _uname(arg):
-    return local.run(["uname", arg]).output
-
-
 PackageDescription = dodge.data_class("PackageDescription", [
     "name",
     "source_name",
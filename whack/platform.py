@@ -1,14 +1,101 @@
+import os
 import re
+import threading
 
 import dodge
 
 from .local import local_shell
+from .xdg import xdg_cache_dir
+from .files import write_json_atomically
 from . import slugs
 
 
 def generate_platform():
-    generator = PlatformGenerator(local_shell)
-    return generator.platform()
+    with _generated_platform_lock:
+        if not _generated_platform:
+            _generated_platform.append(_default_platform_probe().platform())
+        return _generated_platform[0]
+
+
+_generated_platform = []
+_generated_platform_lock = threading.Lock()
+
+
+def reset_generated_platform_lock():
+    global _generated_platform_lock
+    _generated_platform_lock = threading.Lock()
+
+
+def _default_platform_probe():
+    return PlatformProbe(
+        system=os,
+        fallback=PlatformGenerator(local_shell),
+        cache=PlatformFileCache(xdg_cache_dir("platform")),
+    )
+
+
+class PlatformProbe(object):
+    def __init__(self, system, fallback, cache=None):
+        self._system = system
+        self._fallback = fallback
+        self._cache = cache
+        
+    def platform(self):
+        uname = self._read_uname()
+        libc = self._read_libc()
+        if uname is not None and libc is not None:
+            return Platform(
+                os_name=_normalise(uname[0]),
+                architecture=_normalise(uname[4]),
+                libc=_normalise(libc),
+            )
+        else:
+            return self._platform_from_fallback(uname)
+    
+    def _platform_from_fallback(self, uname):
+        if self._cache is None or uname is None:
+            return self._fallback.platform()
+        
+        kernel_release = uname[2]
+        platform = self._cache.read(kernel_release)
+        if platform is None:
+            platform = self._fallback.platform()
+            self._cache.write(kernel_release, platform)
+        return platform
+        
+    def _read_uname(self):
+        try:
+            return self._system.uname()
+        except (AttributeError, OSError):
+            return None
+            
+    def _read_libc(self):
+        try:
+            return self._system.confstr("CS_GNU_LIBC_VERSION")
+        except (AttributeError, ValueError, OSError):
+            return None
+
+
+class PlatformFileCache(object):
+    def __init__(self, cache_dir):
+        self._cache_dir = cache_dir
+        
+    def read(self, kernel_release):
+        try:
+            with open(self._path(kernel_release)) as cache_file:
+                return dodge.loads(cache_file.read(), Platform)
+        except (IOError, OSError, ValueError):
+            return None
+            
+    def write(self, kernel_release, platform):
+        try:
+            write_json_atomically(self._path(kernel_release), dodge.obj_to_dict(platform))
+        except (IOError, OSError):
+            # The platform is detected again next time instead
+            pass
+        
+    def _path(self, kernel_release):
+        return os.path.join(self._cache_dir, kernel_release.replace("/", "-"))
 
 
 class PlatformGenerator(object):
@@ -26,7 +113,11 @@ class PlatformGenerator(object):
         
     def _run(self, command):
         output =  self._shell.run(command).output.decode("ascii")
-        return output.strip().lower().replace("_", "-").replace(" ", "-")
+        return _normalise(output)
+
+
+def _normalise(value):
+    return value.strip().lower().replace("_", "-").replace(" ", "-")
 
 
 Platform = dodge.data_class("Platform", ["os_name", "architecture", "libc"])
@@ -1,39 +1,76 @@
 from .builder import Builder
 from .tarballs import extract_tarball
-from .indices import read_index
+from .indices import find_in_indices
 from .downloads import Downloader
-from . import lists
+from .locks import NoSingleFlightLocks
+from .tempdir import create_temporary_dir
+from .stats import default_counters
+from .tracing import default_tracer
 
 
-def create_package_provider(cacher_factory, enable_build=True, indices=None):
+def create_package_provider(cacher_factory, enable_build=True, indices=None, index_cache=None,
+        index_timeout=None, index_miss_cache=None):
     if indices is None:
         indices = []
     
-    underlying_providers = lists.map(IndexPackageProvider, indices)
+    underlying_providers = []
+    if indices:
+        underlying_providers.append(IndexPackageProvider(
+            indices,
+            index_cache,
+            index_timeout,
+            index_miss_cache,
+        ))
     if enable_build:
-        downloader = Downloader(cacher_factory.create("downloads"))
+        downloader = Downloader(cacher_factory.create_file_cacher("downloads"))
         underlying_providers.append(BuildingPackageProvider(Builder(downloader)))
     return CachingPackageProvider(
         cacher_factory.create("packages"),
         MultiplePackageProviders(underlying_providers),
+        single_flight_locks=cacher_factory.create_single_flight_locks("packages"),
     )
 
 
 class IndexPackageProvider(object):
-    def __init__(self, index_uri):
-        self._index_uri = index_uri
+    def __init__(self, index_uris, index_cache=None, timeout=None, miss_cache=None):
+        self._index_uris = index_uris
+        self._index_cache = index_cache
+        self._timeout = timeout
+        self._miss_cache = miss_cache
         
     def provide_package(self, package_request, package_dir):
-        index = read_index(self._index_uri)
-        package_entry = index.find_package(package_request.params_hash(), package_request.platform())
+        def find_package(index):
+            return index.find_package(package_request.params_hash(), package_request.platform())
+        
+        package_entry = find_in_indices(
+            self._index_uris,
+            find_package,
+            index_cache=self._index_cache,
+            timeout=self._timeout,
+            miss_cache=self._miss_cache,
+            lookup_key="{0}_{1}".format(
+                package_request.params_hash(),
+                package_request.platform().dumps(),
+            ),
+        )
         if package_entry is None:
             return None
         else:
-            self._fetch_and_extract(package_entry.url, package_dir)
+            self._fetch_and_extract(package_entry, package_dir)
             return True
+    
+    def prefetch_package(self, package_request, package_dir):
+        # Pre-built packages are cheap to fetch, so fetch the whole package
+        return self.provide_package(package_request, package_dir)
         
-    def _fetch_and_extract(self, url, package_dir):
-        extract_tarball(url, package_dir, strip_components=1)
+    def _fetch_and_extract(self, package_entry, package_dir):
+        extract_tarball(
+            package_entry.url,
+            package_dir,
+            strip_components=1,
+            size=package_entry.size,
+            hash=package_entry.hash,
+        )
         
         
 class MultiplePackageProviders(object):
@@ -42,11 +79,20 @@ class MultiplePackageProviders(object):
         
     def provide_package(self, package_request, package_dir):
         for underlying_provider in self._providers:
-            package = underlying_provider.provide_package(package_request, package_dir)
+            provider_name = type(underlying_provider).__name__
+            with default_tracer.span("provide_package", provider=provider_name):
+                package = underlying_provider.provide_package(package_request, package_dir)
             if package:
                 return package
         
         return None
+    
+    def prefetch_package(self, package_request, package_dir):
+        for underlying_provider in self._providers:
+            if underlying_provider.prefetch_package(package_request, package_dir):
+                return True
+        
+        return False
         
 
 class BuildingPackageProvider(object):
@@ -56,21 +102,53 @@ class BuildingPackageProvider(object):
     def provide_package(self, package_request, package_dir):
         self._builder.build(package_request, package_dir)
         return True
+    
+    def prefetch_package(self, package_request, package_dir):
+        # Only the inputs to the build are fetched, so there's no package
+        self._builder.prefetch(package_request)
+        return False
 
 
 class CachingPackageProvider(object):
-    def __init__(self, cacher, underlying_provider):
+    def __init__(self, cacher, underlying_provider, single_flight_locks=None):
+        if single_flight_locks is None:
+            single_flight_locks = NoSingleFlightLocks()
         self._cacher = cacher
         self._underlying_provider = underlying_provider
+        self._single_flight_locks = single_flight_locks
     
     def provide_package(self, package_request, package_dir):
         package_name = package_request.name()
-        result = self._cacher.fetch(package_name, package_dir)
-        
-        if result.cache_hit:
+        if self._fetch(package_name, package_dir):
             return True
-        else:
+        
+        # If another process is already providing the same package, wait
+        # for it to finish and then use the cached package
+        with self._single_flight_locks.hold(package_name):
+            if self._fetch(package_name, package_dir):
+                return True
+            
+            default_counters.increment("packages.cache_misses")
             package = self._underlying_provider.provide_package(package_request, package_dir)
             if package:
-                self._cacher.put(package_name, package_dir)
+                with default_tracer.span("cache_put", package=package_name):
+                    self._cacher.put(package_name, package_dir)
             return package
+    
+    def prefetch_package(self, package_request):
+        package_name = package_request.name()
+        if self._cacher.contains(package_name):
+            default_counters.increment("packages.cache_hits")
+            return
+        
+        with create_temporary_dir() as package_dir:
+            if self._underlying_provider.prefetch_package(package_request, package_dir):
+                with default_tracer.span("cache_put", package=package_name):
+                    self._cacher.put(package_name, package_dir)
+    
+    def _fetch(self, package_name, package_dir):
+        with default_tracer.span("cache_fetch", package=package_name):
+            result = self._cacher.fetch(package_name, package_dir)
+        if result.cache_hit:
+            default_counters.increment("packages.cache_hits")
+        return result.cache_hit
@@ -4,19 +4,23 @@ import tempfile
 import uuid
 import re
 import errno
+import hashlib
 
 import mayo
 
-from .hashes import Hasher
+from .hashes import Hasher, MerkleHasher
 from .files import copy_dir, copy_file, delete_dir
 from .tarballs import extract_tarball, create_tarball
-from .indices import read_index
+from .indices import find_in_indices
+from .caching import NoCachingStrategy
 from .errors import FileNotFoundError, WhackUserError
 from .tempdir import create_temporary_dir
 from .uris import is_local_path, is_http_uri
 from . import slugs
+from . import httpclient
 from .common import SOURCE_URI_SUFFIX
-from . import lists
+from .stats import default_counters
+from .tracing import default_tracer
 
 
 class PackageSourceNotFound(WhackUserError):
@@ -34,19 +38,40 @@ class SourceHashMismatch(WhackUserError):
         Exception.__init__(self, message)
 
 
+class UnsupportedSourceHashVersion(WhackUserError):
+    def __init__(self, version):
+        message = "Unsupported source hash version: {0}".format(version)
+        Exception.__init__(self, message)
+
+
 class PackageSourceFetcher(object):
-    def __init__(self, indices=None):
+    def __init__(self, indices=None, file_digest_cache=None, index_cache=None, index_timeout=None,
+            source_mirrors=None, source_tree_cacher=None):
         if indices is None:
             self._indices = []
         else:
             self._indices = indices
+        if source_tree_cacher is None:
+            source_tree_cacher = NoCachingStrategy()
+        self._file_digest_cache = file_digest_cache
+        self._index_cache = index_cache
+        self._index_timeout = index_timeout
+        self._source_mirrors = source_mirrors
+        self._source_tree_cacher = source_tree_cacher
     
     def fetch(self, source_name):
-        index_fetchers = lists.map(IndexFetcher, self._indices)
+        index_fetchers = []
+        if self._indices:
+            index_fetchers.append(IndexFetcher(
+                self._indices,
+                self._index_cache,
+                self._index_timeout,
+                self._source_tree_cacher,
+            ))
         fetchers = index_fetchers + [
-            SourceControlFetcher(),
-            HttpFetcher(),
-            LocalPathFetcher(),
+            SourceControlFetcher(self._source_mirrors),
+            HttpFetcher(self._source_tree_cacher),
+            LocalPathFetcher(self._file_digest_cache),
         ]
         for fetcher in fetchers:
             package_source = self._fetch_with_fetcher(fetcher, source_name)
@@ -61,7 +86,9 @@ class PackageSourceFetcher(object):
         
     def _fetch_with_fetcher(self, fetcher, source_name):
         if fetcher.can_fetch(source_name):
-            return fetcher.fetch(source_name)
+            fetcher_name = type(fetcher).__name__
+            with default_tracer.span("fetch_source", fetcher=fetcher_name, source=source_name):
+                return fetcher.fetch(source_name)
         else:
             return None
             
@@ -75,33 +102,56 @@ class PackageSourceFetcher(object):
 
 
 class IndexFetcher(object):
-    def __init__(self, index_uri):
-        self._index_uri = index_uri
+    def __init__(self, index_uris, index_cache=None, timeout=None, source_tree_cacher=None):
+        self._index_uris = index_uris
+        self._index_cache = index_cache
+        self._timeout = timeout
+        self._source_tree_cacher = source_tree_cacher
     
     def can_fetch(self, source_name):
         return re.match(r"^[a-z0-9\-_]+$", source_name)
         
     def fetch(self, source_name):
-        index = read_index(self._index_uri)
-        package_source_entry = index.find_package_source_by_name(source_name)
+        def find_package_source(index):
+            return index.find_package_source_by_name(source_name)
+        
+        package_source_entry = find_in_indices(
+            self._index_uris,
+            find_package_source,
+            index_cache=self._index_cache,
+            timeout=self._timeout,
+        )
         if package_source_entry is None:
             return None
         else:
-            return HttpFetcher().fetch(package_source_entry.url)
+            return HttpFetcher(self._source_tree_cacher).fetch(
+                package_source_entry.url,
+                size=package_source_entry.size,
+                hash=package_source_entry.hash,
+            )
     
 
 class SourceControlFetcher(object):
+    def __init__(self, mirrors=None):
+        self._mirrors = mirrors
+        
     def can_fetch(self, source_name):
         return mayo.is_source_control_uri(source_name)
         
     def fetch(self, source_name):
         def fetch_archive(destination_dir):
-            mayo.archive(source_name, destination_dir)
+            if self._mirrors is None:
+                mayo.archive(source_name, destination_dir)
+            else:
+                self._mirrors.archive(source_name, destination_dir)
         
         return _create_temporary_package_source(source_name, fetch_archive)
         
         
 class LocalPathFetcher(object):
+    def __init__(self, file_digest_cache=None):
+        self._file_digest_cache = file_digest_cache
+        
     def can_fetch(self, source_name):
         return is_local_path(source_name)
         
@@ -109,7 +159,7 @@ class LocalPathFetcher(object):
         if os.path.isfile(source_name):
             return self._fetch_package_from_tarball(source_name)
         else:
-            return PackageSource.local(source_name)
+            return PackageSource.local(source_name, self._file_digest_cache)
     
     def _fetch_package_from_tarball(self, tarball_path):
         def fetch_directory(destination_dir):
@@ -119,15 +169,49 @@ class LocalPathFetcher(object):
         return _create_temporary_package_source(tarball_path, fetch_directory)
         
 
+# Source trees are cached by URL, and by hash if the index gives one. A
+# cached tree is only used in place of fetching the URL if its content is
+# pinned by a hash. Otherwise, it's only used if the URL can't be reached.
 class HttpFetcher(object):
+    def __init__(self, tree_cacher=None):
+        if tree_cacher is None:
+            tree_cacher = NoCachingStrategy()
+        self._tree_cacher = tree_cacher
+    
     def can_fetch(self, source_name):
         return is_http_uri(source_name)
         
-    def fetch(self, source_name):
+    def fetch(self, source_name, size=None, hash=None):
+        cache_id = _http_source_cache_id(source_name, hash)
+        is_pinned = hash is not None or source_name.endswith(SOURCE_URI_SUFFIX)
+        
         def fetch_directory(temp_dir):
-            extract_tarball(source_name, temp_dir, strip_components=1)
+            if is_pinned and self._fetch_tree(cache_id, temp_dir):
+                return
+            
+            try:
+                extract_tarball(source_name, temp_dir, strip_components=1, size=size, hash=hash)
+            except httpclient.RequestError:
+                if is_pinned or not self._fetch_tree(cache_id, temp_dir):
+                    raise
+                return
+            default_counters.increment("source_trees.cache_misses")
+            self._tree_cacher.put(cache_id, temp_dir)
             
         return _create_temporary_package_source(source_name, fetch_directory)
+    
+    def _fetch_tree(self, cache_id, temp_dir):
+        if self._tree_cacher.fetch(cache_id, temp_dir).cache_hit:
+            default_counters.increment("source_trees.cache_hits")
+            return True
+        else:
+            return False
+
+
+def _http_source_cache_id(uri, hash):
+    if hash is not None:
+        uri = "{0}#{1}".format(uri, hash)
+    return "http-{0}".format(hashlib.sha1(uri.encode("utf8")).hexdigest())
 
 
 def _create_temporary_package_source(uri, fetch_package_source_dir):
@@ -150,14 +234,16 @@ def _is_tarball(path):
 
 class PackageSource(object):
     @staticmethod
-    def local(path):
-        return PackageSource(path, path, is_temp=False)
+    def local(path, file_digest_cache=None):
+        return PackageSource(path, path, is_temp=False, file_digest_cache=file_digest_cache)
     
-    def __init__(self, path, uri, is_temp):
+    def __init__(self, path, uri, is_temp, file_digest_cache=None):
         self.path = path
         self.uri = uri
         self._description = _read_package_description(path)
         self._is_temp = is_temp
+        self._file_digest_cache = file_digest_cache
+        self._source_hash = None
     
     def name(self):
         return self._description.name()
@@ -168,11 +254,22 @@ class PackageSource(object):
         return slugs.join([name, source_hash])
     
     def source_hash(self):
-        hasher = Hasher()
-        for source_path in self._source_paths():
-            absolute_source_path = os.path.join(self.path, source_path)
-            hasher.update_with_dir(absolute_source_path)
-        return hasher.ascii_digest()
+        if self._source_hash is None:
+            self._source_hash = self._generate_source_hash()
+        return self._source_hash
+    
+    def _generate_source_hash(self):
+        default_counters.increment("source_hash.computations")
+        with default_tracer.span("hash_source", path=self.path), \
+                default_counters.time("source_hash"):
+            hasher = _create_source_hasher(
+                self._description.source_hash_version(),
+                self._file_digest_cache,
+            )
+            for source_path in self._source_paths():
+                absolute_source_path = os.path.join(self.path, source_path)
+                hasher.update_with_dir(absolute_source_path)
+            return hasher.ascii_digest()
     
     def write_to(self, target_dir):
         for source_dir in self._source_paths():
@@ -202,6 +299,15 @@ class PackageSource(object):
             delete_dir(self.path)
 
 
+def _create_source_hasher(version, file_digest_cache):
+    if version == 1:
+        return Hasher(file_digest_cache)
+    elif version == 2:
+        return MerkleHasher(file_digest_cache)
+    else:
+        raise UnsupportedSourceHashVersion(version)
+
+
 def _copy_dir_or_file(source, destination):
     if os.path.isdir(source):
         copy_dir(source, destination)
@@ -232,6 +338,9 @@ class DictBackedPackageDescription(object):
     def source_paths(self):
         return self._values.get("sourcePaths", ["whack"])
         
+    def source_hash_version(self):
+        return self._values.get("sourceHashVersion", 1)
+        
     def default_params(self):
         return self._values.get("defaultParams", {})
         
@@ -239,13 +348,13 @@ class DictBackedPackageDescription(object):
         return self._values.get("test", None)
 
 
-def create_source_tarball(package_source, tarball_dir):
+def create_source_tarball(package_source, tarball_dir, compression=None):
     with create_temporary_dir() as source_dir:
         package_source.write_to(source_dir)
         full_name = package_source.full_name()
         filename = "{0}{1}".format(full_name, SOURCE_URI_SUFFIX)
         path = os.path.join(tarball_dir, filename)
-        create_tarball(path, source_dir)
+        create_tarball(path, source_dir, compression=compression)
         return SourceTarball(full_name, path)
 
 
@@ -0,0 +1,88 @@
+import json
+import time
+import threading
+import contextlib
+
+from .locks import ReadWriteFileLock
+from . import httpclient
+
+
+class Counters(object):
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    @contextlib.contextmanager
+    def time(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.increment("{0}.seconds".format(name), time.time() - start_time)
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def reset_lock(self):
+        self._lock = threading.Lock()
+
+
+default_counters = Counters()
+
+
+def collect_stats(counters=None, http_client=None):
+    if counters is None:
+        counters = default_counters
+    if http_client is None:
+        http_client = httpclient.default_client
+
+    values = counters.values()
+    values["http.requests"] = http_client.requests
+    values["http.bytes_received"] = http_client.bytes_received
+    values["http.seconds"] = http_client.seconds_elapsed
+    return values
+
+
+def write_stats_json(path, values):
+    _write_json(path, {"counters": values})
+
+
+def add_to_cumulative_stats(path, values):
+    try:
+        with ReadWriteFileLock("{0}.lock".format(path)).exclusive():
+            cumulative = _read_json(path)
+            counters = cumulative.get("counters", {})
+            for name, value in values.items():
+                counters[name] = counters.get(name, 0) + value
+            _write_json(path, {
+                "runs": cumulative.get("runs", 0) + 1,
+                "counters": counters,
+            })
+    except (IOError, OSError):
+        # The cumulative stats are only used for monitoring, so carry on
+        # without them
+        pass
+
+
+def _read_json(path):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _write_json(path, value):
+    # whack.files counts what it does using the stats, so it can only be
+    # imported once both modules have loaded
+    from .files import write_json_atomically
+    write_json_atomically(path, value, indent=4, sort_keys=True)
@@ -1,41 +1,239 @@
 import os
-import shutil
+import errno
+import uuid
+import hashlib
+import subprocess
+import tempfile
+import zlib
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
-import requests
+try:
+    import lzma
+except ImportError:
+    lzma = None
 
-from .files import mkdir_p
-from .tempdir import create_temporary_dir
+from .files import mkdir_p, delete_dir
+from . import httpclient
+from .errors import WhackUserError
 from . import local
 from .uris import is_http_uri
+from .stats import default_counters
+from .tracing import default_tracer
 
 
-def extract_tarball(tarball_uri, destination_dir, strip_components):
-    if is_http_uri(tarball_uri):
-        with create_temporary_dir() as temp_dir:
-            tarball_path = _download_tarball(tarball_uri, temp_dir)
-            extract_tarball(tarball_path, destination_dir, strip_components)
+class UnsupportedCompression(WhackUserError):
+    pass
+
+
+class TarballVerificationError(WhackUserError):
+    pass
+
+
+def extract_tarball(tarball_uri, destination_dir, strip_components, size=None, hash=None):
+    verifier = _TarballVerifier(tarball_uri, size, hash)
+    mkdir_p(destination_dir)
+    default_counters.increment("tarballs.extracted")
+    with default_tracer.span("extract_tarball", uri=tarball_uri), \
+            default_counters.time("tarballs.extract"):
+        if is_http_uri(tarball_uri):
+            _extract_tarball_from_http(tarball_uri, destination_dir, strip_components, verifier)
+        else:
+            if verifier.is_enabled:
+                with open(tarball_uri, "rb") as tarball_file:
+                    for block in _read_blocks(tarball_file):
+                        verifier.update(block)
+                verifier.verify()
+            # tar detects the compression of files by itself
+            local.run(_extract_command("", tarball_uri, destination_dir, strip_components))
+            default_counters.increment("tarballs.bytes", os.path.getsize(tarball_uri))
+
+
+class _TarballVerifier(object):
+    # Checks the size and hash of a tarball given by an index, where the
+    # hash is written as "<algorithm>:<hex digest>", such as "sha1:..."
+
+    def __init__(self, tarball_uri, size, hash):
+        self._tarball_uri = tarball_uri
+        self._expected_size = size
+        self._expected_hash = hash
+        self._size = 0
+        self.is_enabled = size is not None or hash is not None
+        if hash is None:
+            self._hasher = None
+        else:
+            algorithm, separator, digest = hash.partition(":")
+            if not separator or algorithm not in hashlib.algorithms_available:
+                raise TarballVerificationError(
+                    "Unsupported hash for {0}: {1}".format(tarball_uri, hash)
+                )
+            self._hasher = hashlib.new(algorithm)
+            self._expected_digest = digest.lower()
+
+    def update(self, data):
+        self._size += len(data)
+        if self._hasher is not None:
+            self._hasher.update(data)
+
+    def verify(self):
+        if self._expected_size is not None and self._size != self._expected_size:
+            raise TarballVerificationError(
+                "Expected {0} to be {1} bytes, but was {2} bytes".format(
+                    self._tarball_uri, self._expected_size, self._size
+                )
+            )
+        if self._hasher is not None and self._hasher.hexdigest() != self._expected_digest:
+            raise TarballVerificationError(
+                "Expected {0} to have hash {1}, but was {2}".format(
+                    self._tarball_uri, self._expected_hash, self._hasher.hexdigest()
+                )
+            )
+
+
+def _extract_command(compression_flag, tarball_path, destination_dir, strip_components):
+    return [
+        "tar", "x{0}f".format(compression_flag), tarball_path,
+        "--directory", destination_dir,
+        "--strip-components", str(strip_components)
+    ]
+
+
+def _extract_tarball_from_http(url, destination_dir, strip_components, verifier):
+    # The tarball can only be verified once it's been read, so it's
+    # extracted alongside the existing contents of the destination, and
+    # only moved into place once it's been verified
+    if not verifier.is_enabled:
+        _stream_tarball_from_http(url, destination_dir, strip_components, verifier)
+        return
+    
+    staging_dir = os.path.join(destination_dir, ".whack-extract-{0}".format(uuid.uuid4()))
+    mkdir_p(staging_dir)
+    try:
+        _stream_tarball_from_http(url, staging_dir, strip_components, verifier)
+        _move_contents(staging_dir, destination_dir)
+    finally:
+        delete_dir(staging_dir)
+
+
+def _move_contents(source_dir, destination_dir):
+    for name in os.listdir(source_dir):
+        source_path = os.path.join(source_dir, name)
+        destination_path = os.path.join(destination_dir, name)
+        if _is_dir(source_path) and _is_dir(destination_path):
+            _move_contents(source_path, destination_path)
+        else:
+            os.rename(source_path, destination_path)
+
+
+def _is_dir(path):
+    return os.path.isdir(path) and not os.path.islink(path)
+
+
+def _stream_tarball_from_http(url, destination_dir, strip_components, verifier):
+    # Pipe the response straight into tar so that the download and
+    # extraction happen at the same time
+    with tempfile.TemporaryFile() as stderr_file:
+        extraction = _StreamingExtraction(destination_dir, strip_components, stderr_file, verifier)
+        try:
+            httpclient.default_client.copy_to(url, extraction)
+        except IOError as error:
+            # tar has exited early, so report its error below
+            if error.errno != errno.EPIPE:
+                extraction.kill()
+                raise
+        except:
+            extraction.kill()
+            raise
+
+        return_code = extraction.wait()
+        default_counters.increment("tarballs.bytes", extraction.bytes_written)
+        if return_code != 0:
+            stderr_file.seek(0)
+            raise local.RunProcessError(return_code, b"", stderr_file.read())
+        verifier.verify()
+
+
+class _StreamingExtraction(object):
+    # tar can't detect the compression of its stdin, so the start of the
+    # tarball is read to find the compression before starting tar
+
+    def __init__(self, destination_dir, strip_components, stderr_file, verifier):
+        self._destination_dir = destination_dir
+        self._strip_components = strip_components
+        self._stderr_file = stderr_file
+        self._verifier = verifier
+        self._header = b""
+        self._process = None
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        self._verifier.update(data)
+        if self._process is None:
+            self._header += data
+            if len(self._header) >= _magic_length:
+                self._start()
+        else:
+            self._process.stdin.write(data)
+
+    def wait(self):
+        if self._process is None:
+            self._start()
+        _close(self._process.stdin)
+        return self._process.wait()
+
+    def kill(self):
+        if self._process is not None:
+            _close(self._process.stdin)
+            self._process.kill()
+            self._process.wait()
+
+    def _start(self):
+        command = _extract_command(
+            _compression_flag(self._header),
+            "-",
+            self._destination_dir,
+            self._strip_components,
+        )
+        self._process = local.spawn(
+            command,
+            stdin=subprocess.PIPE,
+            stderr=self._stderr_file,
+        )
+        self._process.stdin.write(self._header)
+
+
+def _compression_flag(header):
+    if header.startswith(_gzip_magic):
+        return "z"
+    elif header.startswith(_xz_magic):
+        return "J"
     else:
-        mkdir_p(destination_dir)
-        local.run([
-            "tar", "xzf", tarball_uri,
-            "--directory", destination_dir,
-            "--strip-components", str(strip_components)
-        ])
-
-
-def _download_tarball(url, tarball_dir):
-    tarball_path = os.path.join(tarball_dir, "tarball.tar.gz")
-    response = requests.get(url, stream=True)
-    if response.status_code != 200:
-        raise Exception("Status code was: {0}".format(response.status_code))
-    with open(tarball_path, "wb") as tarball_file:
-        shutil.copyfileobj(response.raw, tarball_file)
-    return tarball_path
+        return ""
+
+
+_gzip_magic = b"\x1f\x8b"
+_xz_magic = b"\xfd7zXZ\x00"
+_magic_length = max(len(_gzip_magic), len(_xz_magic))
+
+
+def _close(pipe):
+    try:
+        pipe.close()
+    except IOError:
+        pass
+
 
+def create_tarball(tarball_path, source, rename_dir=None, compression=None):
+    with default_tracer.span("create_tarball", path=tarball_path, compression=compression):
+        return _create_tarball(tarball_path, source, rename_dir, compression)
 
-def create_tarball(tarball_path, source, rename_dir=None):
+
+def _create_tarball(tarball_path, source, rename_dir, compression):
+    codec = read_compression(compression)
     args = [
-        "tar", "czf", tarball_path,
+        "tar", "cf", "-",
         "--directory", os.path.dirname(source),
         os.path.basename(source)
     ]
@@ -44,5 +242,135 @@ def create_tarball(tarball_path, source, rename_dir=None):
             "--transform",
             "s/^{0}/{1}/".format(os.path.basename(source), rename_dir),
         ]
-    local.run(args)
+
+    with tempfile.TemporaryFile() as stderr_file:
+        process = local.spawn(args, stdout=subprocess.PIPE, stderr=stderr_file)
+        try:
+            with open(tarball_path, "wb") as tarball_file:
+                codec.compress(process.stdout, tarball_file)
+        except:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            process.stdout.close()
+
+        return_code = process.wait()
+        if return_code != 0:
+            stderr_file.seek(0)
+            raise local.RunProcessError(return_code, b"", stderr_file.read())
+
     return tarball_path
+
+
+def read_compression(compression):
+    if compression is None:
+        compression = "gzip"
+
+    name, separator, level = compression.partition(":")
+    if name not in _codecs or (level and not level.isdigit()):
+        raise UnsupportedCompression("Unsupported compression: {0}".format(compression))
+
+    create_codec, default_level = _codecs[name]
+    if level and default_level is None:
+        # The codec doesn't have levels
+        raise UnsupportedCompression("Unsupported compression: {0}".format(compression))
+    if level:
+        level = int(level)
+    else:
+        level = default_level
+
+    if level is not None and not 0 <= level <= 9:
+        raise UnsupportedCompression("Unsupported compression: {0}".format(compression))
+    return create_codec(level)
+
+
+class NoCompression(object):
+    def __init__(self, level):
+        pass
+
+    def compress(self, input_file, output_file):
+        for block in _read_blocks(input_file):
+            output_file.write(block)
+
+
+class GzipCompression(object):
+    def __init__(self, level):
+        self._level = level
+
+    def compress(self, input_file, output_file):
+        compressor = _gzip_compressor(self._level)
+        for block in _read_blocks(input_file):
+            output_file.write(compressor.compress(block))
+        output_file.write(compressor.flush())
+
+
+class ParallelGzipCompression(object):
+    # Blocks are compressed independently as separate gzip members. A file
+    # with several members is still a valid gzip file.
+
+    def __init__(self, level, workers=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self._level = level
+        self._workers = workers
+
+    def compress(self, input_file, output_file):
+        pool = ThreadPool(self._workers)
+        try:
+            # Limit the number of blocks in memory at once
+            pending_blocks = collections.deque()
+            for block in _read_blocks(input_file, _parallel_block_size):
+                if len(pending_blocks) >= self._workers * 2:
+                    output_file.write(pending_blocks.popleft().get())
+                pending_blocks.append(pool.apply_async(self._compress_block, (block, )))
+
+            while pending_blocks:
+                output_file.write(pending_blocks.popleft().get())
+        finally:
+            pool.close()
+            pool.join()
+
+    def _compress_block(self, block):
+        compressor = _gzip_compressor(self._level)
+        return compressor.compress(block) + compressor.flush()
+
+
+class XzCompression(object):
+    def __init__(self, level):
+        if lzma is None:
+            raise UnsupportedCompression("xz compression requires the lzma module")
+        self._level = level
+
+    def compress(self, input_file, output_file):
+        compressor = lzma.LZMACompressor(preset=self._level)
+        for block in _read_blocks(input_file):
+            output_file.write(compressor.compress(block))
+        output_file.write(compressor.flush())
+
+
+def _gzip_compressor(level):
+    # A window size of 16 + 15 makes zlib write a gzip header and trailer
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _read_blocks(input_file, block_size=64 * 1024):
+    while True:
+        block = input_file.read(block_size)
+        if not block:
+            return
+        yield block
+
+
+_parallel_block_size = 1024 * 1024
+
+
+_codecs = {
+    "none": (NoCompression, None),
+    "gzip": (GzipCompression, 6),
+    "parallel-gzip": (ParallelGzipCompression, 6),
+    "xz": (XzCompression, 6),
+}
+
+
+compressions = sorted(_codecs)
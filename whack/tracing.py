@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import threading
+
+
+# Records spans in the Chrome trace event format, which can be loaded into
+# chrome://tracing or Perfetto. Spans cost almost nothing while tracing is
+# disabled.
+class Tracer(object):
+    def __init__(self):
+        self.enabled = False
+        self._events = []
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def span(self, name, category="whack", **args):
+        if self.enabled:
+            return _Span(self, name, category, args)
+        else:
+            return _no_span
+
+    def reset_lock(self):
+        self._lock = threading.Lock()
+
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def write(self, path):
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": self.events(), "displayTimeUnit": "ms"}, trace_file)
+
+    def _add_event(self, event):
+        with self._lock:
+            self._events.append(event)
+
+
+default_tracer = Tracer()
+
+
+class _Span(object):
+    def __init__(self, tracer, name, category, args):
+        self._tracer = tracer
+        self._name = name
+        self._category = category
+        self._args = args
+
+    def __enter__(self):
+        self._start = _now_in_microseconds()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        args = self._args
+        if exception_type is not None:
+            args = dict(args, error=exception_type.__name__)
+        self._tracer._add_event({
+            "name": self._name,
+            "cat": self._category,
+            "ph": "X",
+            "ts": self._start,
+            "dur": _now_in_microseconds() - self._start,
+            "pid": os.getpid(),
+            "tid": threading.current_thread().ident,
+            "args": args,
+        })
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        pass
+
+
+_no_span = _NoSpan()
+
+
+def _now_in_microseconds():
+    return int(time.time() * 1000000)
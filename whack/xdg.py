@@ -0,0 +1,6 @@
+import os
+
+
+def xdg_cache_dir(name):
+    xdg_cache_home = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(xdg_cache_home, "whack", name)